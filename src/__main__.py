@@ -1,4 +1,5 @@
 # System imports
+import asyncio
 import logging
 import sys
 import time
@@ -7,16 +8,19 @@ import pdb
 import os # exit
 
 # ResumeNet imports
+from logpipe import LogPipe
 from localevent import MessageDispatcher
 
-from messages import RouteByNumericID, RouteByCPE
+from messages import RouteByNumericID, RouteByCPE, RoutePointsByCPE
 from messages import SNPingMessage, InsertionRequest, LookupRequest
+from messages import BatchInsertionRequest
 
 from network import InRequestManager
 from node import NetNodeInfo, Node
 from nodeid import NumericID, NameID
 from equation import SpacePart, Component, Dimension, Range
 from routing import PidRange
+from metrics import LatencyMetrics
 
 import cProfile
 
@@ -24,8 +28,7 @@ import cProfile
 # ----------------------------------------------------------------------------
 
 # Module log abilities
-LOG_HANDLER = logging.StreamHandler()
-LOG_HANDLER.setLevel(logging.DEBUG)
+LOG_HANDLER = LogPipe.shared().handler
 
 LOGGER = logging.getLogger("__main__")
 LOGGER.setLevel(logging.DEBUG)
@@ -37,12 +40,18 @@ LOGGER.addHandler(LOG_HANDLER)
 
 class ThreadDispatcher(threading.Thread):
 
-    def __init__(self):
-        """Launches the processing part of the Node"""
+    """Threads processing application messages (0: on the dispatcher loop)."""
+    WORKERS = 4
+
+    def __init__(self, address):
+        """Launches the processing part of the Node, listening on 'address'
+        from the same event loop."""
         threading.Thread.__init__(self)
 
-        self.__dispatcher = MessageDispatcher(lnode)
+        self.__dispatcher = MessageDispatcher(lnode, self.WORKERS)
         lnode.dispatcher = self.__dispatcher
+        self.__listener = InRequestManager(address, self.__dispatcher)
+        lnode.sender.use_datagrams(self.__listener.datagram_channel)
 
     #
     # Properties
@@ -54,22 +63,10 @@ class ThreadDispatcher(threading.Thread):
     #
     # Overwritten
 
-    def run(self):
-        self.__dispatcher.dispatch()
-
-
-class ThreadListener(threading.Thread):
-
-    def __init__(self, address, dispatcher):
-        """Launches the listening part of the Node"""
-        threading.Thread.__init__(self)
-
-        self.__listener = InRequestManager(address, dispatcher)
-
     def run(self):
         try:
             self.__listener.serve_forever()
-        except:
+        except OSError:
             LOGGER.log(logging.ERROR, "The listener coudn't be started for %s." %
                        repr(self.__listener.address))
 
@@ -77,6 +74,10 @@ class ThreadListener(threading.Thread):
 #  ^ type this at (pdb) prompt to disengage interactive polling for input.
 class ThreadTalker(threading.Thread):
     instance=None
+
+    """Longest wait (in seconds) for the dispatcher loop to run a command."""
+    LOOP_TIMEOUT = 10
+
     def __init__(self):
         """Launches the talking part of the Node"""
         threading.Thread.__init__(self)
@@ -87,13 +88,17 @@ class ThreadTalker(threading.Thread):
         self.__menu = list()
         self.__menu.append(("Display local node information.", self.__display)) # 0
         self.__menu.append(("Add data to the local node", self.__add_data))     # 1
-        self.__menu.append(("Send a join message (SkipTree).", self.__send_join_skiptree))
+        self.__menu.append(("Send a join message (SkipTree).", self.__send_join_skiptree)) # 2
         self.__menu.append(("Send a leave message.", self.__send_leave))        # 3
         self.__menu.append(("Send data to the skiptree.", self.__send_data))    # 4
-        self.__menu.append(("check data on the skiptree.", self.__find_data))    # 5
+        self.__menu.append(("check data on the skiptree.", self.__find_data))   # 5
         self.__menu.append(("Dump data store", self.__dump_store))              # 6
         self.__menu.append(("Display Current Status",self.__dump_status))       # 7
-        self.__menu.append(("Debug",self.__debug))
+        self.__menu.append(("Debug",self.__debug))                              # 8
+        self.__menu.append(("Display latency histograms", self.__show_latency)) # 9
+        self.__menu.append(("Dump latency histograms (JSON)", self.__dump_latency)) # 10
+        self.__menu.append(("Reset latency histograms", self.__reset_latency))  # 11
+        self.__menu.append(("Send a batch of data to the skiptree.", self.__send_batch)) # 12
         self.debugging=False # turn this to true if you intend to debug SOME OTHER
         # thread
         self.uid=0
@@ -156,26 +161,74 @@ class ThreadTalker(threading.Thread):
         actions[index_action][1]()
 
     def __dump_status(self):
-        sys.stderr.write(lnode.status+"\n")
-        sys.stderr.write(lnode.cpe.__repr__())
-        sys.stderr.write("\n%s\n" % lnode.name_id)
+        status, cpe, name_id = self.__on_loop(lambda: (lnode.status, repr(lnode.cpe), lnode.name_id))
+        sys.stderr.write(status+"\n")
+        sys.stderr.write(cpe)
+        sys.stderr.write("\n%s\n" % name_id)
+
+    def __on_loop(self, function, *args):
+        """Call 'function' on the dispatcher loop and return its result: the
+        state of the node belongs to that loop, the talker never touches it."""
+        async def call():
+            return function(*args)
+        loop = lnode.dispatcher.loop
+        if (loop.is_running()):
+            return asyncio.run_coroutine_threadsafe(call(), loop).result(self.LOOP_TIMEOUT)
+        return loop.run_until_complete(call())
 
     def __report_status(self):
         """used to reply to MCP's heartbeat requests"""
-        print("0_0 name=%s--%x--%f"% (lnode.name_id,lnode.numeric_id,lnode.partition_id))
-        print("0_0 stat="+lnode.status)
-        print("0_0 cpe=%s"%lnode.cpe.pname)
-        for x in lnode.neighbourhood.get_all_unique_neighbours():
-            print("0_0 rtbl=%s"%x.pname)
-        print("0_0 nghb="+repr(lnode.neighbourhood))
+        lines = self.__on_loop(self.__status_lines)
+        for line in lines:
+            print(line)
         print("#_# beat")
         sys.stderr.write("%s replied to MCP's heartbeat"%lnode.name_id)
 
+    def __status_lines(self):
+        """Return the lines of the heartbeat reply."""
+        lines = []
+        lines.append("0_0 name=%s--%x--%f"% (lnode.name_id,lnode.numeric_id,lnode.partition_id))
+        lines.append("0_0 stat="+lnode.status)
+        lines.append("0_0 cpe=%s"%lnode.cpe.pname)
+        for x in lnode.neighbourhood.get_all_unique_neighbours():
+            lines.append("0_0 rtbl=%s"%x.pname)
+        lines.append("0_0 nghb="+repr(lnode.neighbourhood))
+        for node, depth in lnode.sender.queue_depths().items():
+            lines.append("0_0 sendq=%s:%i"%(node.name_id.name, depth))
+        for name, queue in sorted(lnode.dispatcher.queue_stats().items()):
+            lines.append("0_0 dispq=%s:%i, %i served, %.1fms mean wait, %.1fms max"%(
+                name, queue["depth"], queue["served"],
+                queue["mean_wait"] * 1000, queue["max_wait"] * 1000))
+        admission = lnode.dispatcher.admission_stats()
+        lines.append("0_0 admit=%i queued, %i admitted, %i rejected, %i pauses, %.1fs paused"%(
+            admission["depth"], admission["admitted"], admission["rejected"],
+            admission["pauses"], admission["paused_time"]))
+        pool = lnode.sender.pool_stats()
+        lines.append("0_0 pool=%i open, %.2f hit rate, %i evicted, %i expired"%(
+            pool["open"], pool["hit_rate"], pool["evicted"], pool["expired"]))
+        logs = LogPipe.shared().stats()
+        lines.append("0_0 logs=%i queued, %i dropped, %i suppressed, %i console dropped"%(
+            logs["depth"], logs["dropped"], logs["suppressed"], logs["console_dropped"]))
+        return lines
+
+    def __show_latency(self):
+        print(LatencyMetrics.shared().format())
+
+    def __dump_latency(self):
+        print("0_0 latency=%s"%LatencyMetrics.shared().dump())
+
+    def __reset_latency(self):
+        LatencyMetrics.shared().reset()
+        print("0_0 latency reset")
+
     def __dump_store(self):
-        lnode.data_store.print_debug()
+        self.__on_loop(lambda: lnode.data_store.print_debug())
 
     def __find_data(self):
         keypart = eval(input())
+        self.__on_loop(self.__lookup, keypart, input())
+
+    def __lookup(self, keypart, label):
         # even for a point query, some forking may be required, as
         #   we may encounter a CPE node that is defined on a dimension
         #   that we did not provided.
@@ -186,13 +239,13 @@ class ThreadTalker(threading.Thread):
         if (lnode.cpe.k<=0):
             raise ValueError("I should have a CPE to do that %s"%lnode.cpe.pname)
         findRQ = LookupRequest(keypart,lnode)
-        print("@_@ SEND %f - %s - %s"%(findRQ.nonce, input(),repr(keypart)))
+        print("@_@ SEND %f - %s - %s"%(findRQ.nonce, label, repr(keypart)))
         m = RouteByCPE(findRQ,keypart)
         m.forking=True
         p = lnode.partition_id
         m.limit=PidRange(p-1, p+1)
         m.trace=True
-        m.sign("leaving home %s"%lnode.pname)
+        m.sign("leaving home %s", lnode.pname)
         lnode.route_internal(m)
 
     def __send_data(self):
@@ -202,7 +255,14 @@ class ThreadTalker(threading.Thread):
         insertRQ = RouteByCPE(InsertionRequest(valuevector,keypart),searchpart)
         # watch out for undefined keypart, as RouteByCPE could change it.
         #  if you don't like it, use the plain "search" routing.
-        lnode.route_internal(insertRQ)
+        self.__on_loop(lnode.route_internal, insertRQ)
+
+    def __send_batch(self):
+        keyparts = eval(input())
+        # every key must be a point along the same dimensions.
+        valuevector=[lnode.net_info.get_port()]
+        batchRQ = BatchInsertionRequest.from_items([(key, valuevector) for key in keyparts])
+        self.__on_loop(lnode.route_internal, RoutePointsByCPE(batchRQ))
 
     def __sleep(self):
         seconds= int(input())
@@ -228,7 +288,7 @@ class ThreadTalker(threading.Thread):
         self.__get_action(display_actions)
 
     def __display_node(self):
-        print(lnode.__repr__())
+        print(self.__on_loop(repr, lnode))
 
     def __display_off(self):
         print("Echo off")
@@ -239,13 +299,13 @@ class ThreadTalker(threading.Thread):
         self.__interactive=True
 
     def __display_node_cpe(self):
-        print(lnode.cpe.__repr__())
+        print(self.__on_loop(lambda: repr(lnode.cpe)))
 
     def __add_data(self):
         keypart = eval(input())
         purevalues = eval(input()% "self.portno,self.uid")
         self.uid+=1
-        lnode.data_store.add(keypart, purevalues)
+        self.__on_loop(lambda: lnode.data_store.add(keypart, purevalues))
 #        pass
 
     def __send_join_skiptree(self):
@@ -256,11 +316,11 @@ class ThreadTalker(threading.Thread):
         print("Host (127.0.0.1):")
         host = input()
         boot_net_info = NetNodeInfo((host, port))
-        lnode.join(boot_net_info)
+        self.__on_loop(lnode.join, boot_net_info)
         print("Trying to join "+host+":"+str(port))
 
     def __send_leave(self):
-        lnode.leave()
+        self.__on_loop(lnode.leave)
 
     def __send_RouteByNumericID(self):
 
@@ -268,7 +328,9 @@ class ThreadTalker(threading.Thread):
         print("Enter the numeric ID :")
 
         num_id = NumericID(input())
+        self.__on_loop(self.__ping_numeric_id, num_id)
 
+    def __ping_numeric_id(self, num_id):
         payload_msg = SNPingMessage(lnode, 0)
         route_msg = RouteByNumericID(payload_msg, num_id)
         lnode.route_internal(route_msg)
@@ -333,6 +395,8 @@ def catcha(type, value, tb):
 def main():
 
     sys.excepthook = catcha
+    # the MCP may read stdout slowly: don't let print() stall the node.
+    LogPipe.shared().install_console()
 
     INDEX_LOCAL_IP, INDEX_LOCAL_PORT, INDEX_NAME_ID, INDEX_NUM_ID, WELCOME_IP, WELCOME_PORT, BATCH_FILE = range(1, 8)
 
@@ -353,11 +417,9 @@ def main():
     print("NumericID: ", lnode.numeric_id.get_numeric_id_hex(), " (", int(lnode.numeric_id), ")", sep="")
    
     # Create the sub-parts of the program
-    th_dispatcher = ThreadDispatcher()
+    th_dispatcher = ThreadDispatcher(local_address)
     threads.append(th_dispatcher)
 
-    th_listener = ThreadListener(local_address, th_dispatcher.dispatcher)
-    threads.append(th_listener)
     if (not batchmode):
         th_talker = ThreadTalker()
         threads.append(th_talker)
@@ -0,0 +1,321 @@
+"""
+Micro-benchmarks for the hot paths of a node.
+
+invoke as
+python3 benchmark.py [name ...]
+
+where each name is one of the benchmarks listed in BENCHMARKS (all of them
+are run when no name is given).
+"""
+
+# System imports
+import gzip
+import os
+import pickle
+import random
+import sys
+import timeit
+
+# ResumeNet imports
+from nodeid import NumericID, BitifiedByte
+
+# ------------------------------------------------------------------------------------------------
+
+class ByteListNumericID(object):
+    """Reference model of the former NumericID: a list of BitifiedByte that is
+    converted back to an integer through its hex string on every comparison."""
+
+    def __init__(self, value, nb_digit):
+        self.m_bytes = [BitifiedByte(b) for b in value.to_bytes(nb_digit // 8, "big")]
+
+    def get_digit(self, index):
+        return self.m_bytes[index // 8][index % 8]
+
+    def get_nb_digit(self):
+        return len(self.m_bytes) * 8
+
+    def get_longest_prefix_length(self, numeric_id):
+        length, up_bound = 0, max(self.get_nb_digit(), numeric_id.get_nb_digit())
+        for i in range(up_bound):
+            if(self.get_digit(i) != numeric_id.get_digit(i)):
+                break
+            else:
+                length += 1
+        return length
+
+    def __int__(self):
+        id_hex = ""
+        for i in range(len(self.m_bytes)):
+            id_hex += str(self.m_bytes[i])
+        return int(id_hex, 16)
+
+    def __eq__(self, other):
+        return int(self) == int(other)
+
+    def __hash__(self):
+        return int(self)
+
+
+def numeric_routing_workload(ids, dest):
+    """What Router.__by_numeric_get_next_hop does on every hop, plus the
+    dictionary lookups that neighbour tables perform on the same ids."""
+    seen = {}
+    best = ids[0]
+    level = -1
+    for current in ids:
+        if (dest == current):
+            break
+        common_bits = dest.get_longest_prefix_length(current)
+        if common_bits > level:
+            level = common_bits
+            best = current
+        elif abs(int(dest) - int(current)) < abs(int(dest) - int(best)):
+            best = current
+        seen[current] = common_bits
+    return best, level, len(seen)
+
+
+def bench_numeric_routing(nb_ids=2000, repeat=5):
+    """Compare the integer-backed NumericID with the byte-list model."""
+    values = [random.getrandbits(128) for i in range(nb_ids)]
+    dest_value = random.getrandbits(128)
+
+    compact = [NumericID(v, False, 128) for v in values]
+    legacy = [ByteListNumericID(v, 128) for v in values]
+    compact_dest = NumericID(dest_value, False, 128)
+    legacy_dest = ByteListNumericID(dest_value, 128)
+
+    assert (numeric_routing_workload(compact, compact_dest)[1] ==
+            numeric_routing_workload(legacy, legacy_dest)[1]), "models disagree"
+
+    t_legacy = min(timeit.repeat(lambda: numeric_routing_workload(legacy, legacy_dest),
+                                 number=1, repeat=repeat))
+    t_compact = min(timeit.repeat(lambda: numeric_routing_workload(compact, compact_dest),
+                                  number=1, repeat=repeat))
+
+    print("numeric routing, %i hops:" % nb_ids)
+    print("  byte list  : %8.3f ms" % (t_legacy * 1000))
+    print("  integer    : %8.3f ms" % (t_compact * 1000))
+    print("  speedup    : %8.1fx" % (t_legacy / t_compact))
+
+
+"""Fields of a telescope trace record used as dimensions (see csv2py.pl)."""
+TELESCOPE_FIELDS = {
+    "6": (("Iproto", 4), ("Isrc", 5), ("Idst", 6), ("Tsrc", 8), ("Tdst", 9), ("Tflags", 13)),
+    "11": (("Iproto", 4), ("Isrc", 5), ("Idst", 6), ("Usrc", 8), ("Udst", 9), ("Ulen", 10)),
+    "01": (("Iproto", 4), ("Isrc", 5), ("Idst", 6), ("Ctype", 8), ("Ccode", 9)),
+    }
+
+TELESCOPE_TRACE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "example.csv.gz")
+
+
+def telescope_key_parts(nb_records):
+    """Turn records of the telescope trace into SpacePart, as csv2py.pl does."""
+    from equation import SpacePart, Component, Dimension
+
+    parts = []
+    with gzip.open(TELESCOPE_TRACE, "rt") as trace:
+        for line in trace:
+            values = line.strip().split(",")
+            fields = TELESCOPE_FIELDS.get(values[4].lstrip("0") or "0")
+            if (fields == None):
+                continue
+            parts.append(SpacePart([Component(Dimension.get(name), values[i]) for name, i in fields]))
+            if (len(parts) == nb_records):
+                break
+    return parts
+
+
+def telescope_messages(nb_records):
+    """What a node sends while loading and querying a telescope trace: CPE-routed
+    insertions and traced lookups, plus the pings that keep routing tables fresh."""
+    from equation import InternalNode, Component, Dimension, Range, SpacePart
+    from messages import RouteByCPE, RouteDirect, InsertionRequest, LookupRequest, SNPingMessage
+    from node import Node, NetNodeInfo
+    from nodeid import NameID, NumericID
+    from routing import PidRange
+    from util import Direction
+
+    local = Node(NameID("seed"), NumericID("seed", True), NetNodeInfo(("139.165.223.18", 8080)))
+    other = Node(NameID("peer"), NumericID("peer", True), NetNodeInfo(("139.165.223.19", 8080)))
+    local.neighbourhood.sign("add(%s)" % other.name_id)
+    parts = telescope_key_parts(nb_records)
+    for i, name in enumerate(("Isrc", "Idst", "Tsrc")):
+        component = parts[i].get_component(Dimension.get(name))
+        direction = Direction.LEFT if (i % 2 == 0) else Direction.RIGHT
+        local.cpe.add_node(InternalNode(direction, component.dimension, component.value))
+
+    messages = []
+    for seq, keypart in enumerate(parts):
+        insertion = RouteByCPE(InsertionRequest(["0", seq], keypart), SpacePart(keypart.val2range()))
+        messages.append(insertion)
+
+        src, dst = keypart.get_component(Dimension.get("Isrc")), keypart.get_component(Dimension.get("Idst"))
+        query = SpacePart([Component(src.dimension, Range(src.value, src.value)),
+                           Component(dst.dimension, Range("00000000", "ffffffff"))])
+        lookup = RouteByCPE(LookupRequest(query, local), query)
+        lookup.forking = True
+        lookup.limit = PidRange(local.partition_id - 1, local.partition_id + 1)
+        lookup.trace = True
+        lookup.sign("leaving home %s", local.pname)
+        lookup.sign("@%s: %i destinations", local.partition_id, 2)
+        messages.append(lookup)
+
+        if (seq % 10 == 0):
+            messages.append(RouteDirect(SNPingMessage(local, 0), other))
+    return messages
+
+
+def bench_codec(nb_records=500, repeat=5):
+    """Compare the wire codec with pickle on telescope trace messages."""
+    from codec import WireCodec
+
+    codec = WireCodec.shared()
+    messages = telescope_messages(nb_records)
+
+    pickled = [pickle.dumps(m) for m in messages]
+    encoded = [codec.encode(m) for m in messages]
+    for frame in encoded:
+        assert codec.encode(codec.decode(frame)) == frame, "codec doesn't round-trip"
+
+    t_dumps = min(timeit.repeat(lambda: [pickle.dumps(m) for m in messages], number=1, repeat=repeat))
+    t_loads = min(timeit.repeat(lambda: [pickle.loads(f) for f in pickled], number=1, repeat=repeat))
+    t_encode = min(timeit.repeat(lambda: [codec.encode(m) for m in messages], number=1, repeat=repeat))
+    t_decode = min(timeit.repeat(lambda: [codec.decode(f) for f in encoded], number=1, repeat=repeat))
+
+    def forward_pickle():
+        for frame in pickled:
+            message = pickle.loads(frame)
+            message.decttl()
+            pickle.dumps(message)
+
+    def forward_codec():
+        for frame in encoded:
+            message = codec.decode(frame)
+            message.decttl()
+            codec.encode(message)
+
+    t_fw_pickle = min(timeit.repeat(forward_pickle, number=1, repeat=repeat))
+    t_fw_codec = min(timeit.repeat(forward_codec, number=1, repeat=repeat))
+
+    size_pickle = sum(len(f) for f in pickled)
+    size_codec = sum(len(f) for f in encoded)
+    print("wire codec, %i telescope trace messages:" % len(messages))
+    print("             %10s %10s %10s %10s" % ("bytes/msg", "encode us", "decode us", "hop us"))
+    print("  pickle     %10.1f %10.2f %10.2f %10.2f" % (size_pickle / len(messages),
+          t_dumps * 1e6 / len(messages), t_loads * 1e6 / len(messages),
+          t_fw_pickle * 1e6 / len(messages)))
+    print("  codec      %10.1f %10.2f %10.2f %10.2f" % (size_codec / len(messages),
+          t_encode * 1e6 / len(messages), t_decode * 1e6 / len(messages),
+          t_fw_codec * 1e6 / len(messages)))
+
+
+def deep_cpe(nb_dims, height, width=1000000):
+    """Return a CPE of 'height' internal nodes cycling through 'nb_dims'
+    dimensions, as a node deep in the tree gets, and the part of the space
+    it manages (a dict of [low, high] integers per dimension)."""
+    from equation import CPE, InternalNode, Dimension
+    from util import Direction
+
+    cpe = CPE()
+    bounds = dict(("d%i" % i, [0, width]) for i in range(nb_dims))
+    for depth in range(height):
+        name = "d%i" % (depth % nb_dims)
+        low, high = bounds[name]
+        if (high - low < 2):
+            continue
+        cut = random.randint(low + 1, high - 1)
+        direction = random.choice((Direction.LEFT, Direction.RIGHT))
+        cpe.add_node(InternalNode(direction, Dimension.get(name), "%07i" % cut))
+        if (direction == Direction.LEFT):
+            bounds[name][1] = cut
+        else:
+            bounds[name][0] = cut
+    return cpe, bounds
+
+
+def cpe_queries(bounds, nb_queries, width=1000000):
+    """Return space parts to orient: points and ranges around the region of
+    'bounds', some of them lacking a dimension."""
+    from equation import SpacePart, Component, Dimension, Range
+
+    queries = []
+    for i in range(nb_queries):
+        part = SpacePart()
+        for name, (low, high) in bounds.items():
+            if (i % 7 == 6 and name == "d0"):
+                continue # lookups don't always constrain every dimension.
+            centre = random.randint(max(0, low - (high - low)), min(width, high + (high - low)))
+            if (i % 2 == 0):
+                value = Range("%07i" % centre, "%07i" % centre)
+            else:
+                spread = random.randint(0, high - low + 1)
+                value = Range("%07i" % max(0, centre - spread), "%07i" % min(width, centre + spread))
+            part.set_component(Component(Dimension.get(name), value))
+        queries.append(part)
+    return queries
+
+
+def bench_cpe(nb_dims=6, height=96, nb_queries=2000, repeat=5):
+    """Compare the compiled CPE with the walk over its internal nodes."""
+    cpe, bounds = deep_cpe(nb_dims, height)
+    queries = cpe_queries(bounds, nb_queries)
+    assert cpe.compiled.nested, "a deep CPE should be nested"
+    for part in queries:
+        assert (cpe.which_side_space(part, True) ==
+                cpe.interpret_side_space(part, True)), "evaluators disagree on %s" % part
+
+    t_walk = min(timeit.repeat(lambda: [cpe.interpret_side_space(q, True) for q in queries],
+                               number=1, repeat=repeat))
+    t_compiled = min(timeit.repeat(lambda: [cpe.which_side_space(q, True) for q in queries],
+                                   number=1, repeat=repeat))
+
+    print("cpe orientation, height %i over %i dimensions, %i space parts:" % (
+        cpe.height, nb_dims, len(queries)))
+    print("  walk       : %8.2f us" % (t_walk * 1e6 / len(queries)))
+    print("  compiled   : %8.2f us" % (t_compiled * 1e6 / len(queries)))
+    print("  speedup    : %8.1fx" % (t_walk / t_compiled))
+
+
+def bench_points(nb_dims=6, height=96, nb_points=20000, repeat=5):
+    """Compare orienting a batch of points at once with orienting them one by one."""
+    import equation
+    from equation import SpacePart, Component, Dimension, PointBatch
+
+    cpe, bounds = deep_cpe(nb_dims, height)
+    columns = {}
+    for name, (low, high) in bounds.items():
+        columns[Dimension.get(name)] = [
+            "%07i" % random.randint(max(0, low - (high - low)), high + (high - low))
+            for i in range(nb_points)]
+    batch = PointBatch(columns)
+    parts = [SpacePart([Component(dim, values[i]) for dim, values in columns.items()])
+             for i in range(nb_points)]
+    masks = cpe.which_side_points(batch)
+    for i, part in enumerate(parts[:1000]):
+        assert [bool(m[i]) for m in masks] == list(cpe.which_side_space(part)), (
+            "batch disagrees on %s" % part)
+
+    t_single = min(timeit.repeat(lambda: [cpe.which_side_space(p) for p in parts],
+                                 number=1, repeat=repeat))
+    t_batch = min(timeit.repeat(lambda: cpe.which_side_points(batch),
+                                number=1, repeat=repeat))
+
+    print("point orientation, height %i over %i dimensions, %i points (%s):" % (
+        cpe.height, nb_dims, nb_points, "numpy" if equation.numpy != None else "no numpy"))
+    print("  one by one : %8.2f us" % (t_single * 1e6 / nb_points))
+    print("  batch      : %8.2f us" % (t_batch * 1e6 / nb_points))
+    print("  speedup    : %8.1fx" % (t_single / t_batch))
+
+
+BENCHMARKS = {
+    "numeric": bench_numeric_routing,
+    "codec": bench_codec,
+    "cpe": bench_cpe,
+    "points": bench_points,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
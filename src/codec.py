@@ -0,0 +1,628 @@
+"""
+The wire codec turns messages into compact binary frames and back.
+
+A frame is a version byte followed by one encoded value. Each value starts
+with a one-byte tag. Messages and the objects they carry (SpacePart, CPE,
+Range, ...) are encoded through a schema: the ordered list of their attribute
+names is known by both ends, so that only the values travel. A Node is written
+once per frame, later occurrences being back-references, and the fields that
+only have to name a node (e.g. the originator of a LookupRequest) carry its
+identifiers without its CPE. Dimensions, interned by name, are written as
+their name.
+
+The payload of a routed message is a frame of its own, nested in the frame of
+the envelope: a node that only forwards the message decodes it as a
+messages.WirePayload and writes it back untouched.
+
+Whatever has no encoder is pickled, and a frame starting like a pickle (0x80)
+is unpickled, so that nodes running the former protocol remain reachable.
+"""
+
+# System imports
+import pickle
+import struct
+
+# ResumeNet imports
+from nodeid import NameID, NumericID, PartitionID
+
+# ------------------------------------------------------------------------------------------------
+
+"""Value tags."""
+TAG_NONE, TAG_TRUE, TAG_FALSE, TAG_INT, TAG_FLOAT, TAG_STR, TAG_BYTES, \
+    TAG_LIST, TAG_TUPLE, TAG_DICT, TAG_SET, \
+    TAG_NAMEID, TAG_NUMERICID, TAG_PARTITIONID, \
+    TAG_NODE, TAG_NODEREF, TAG_BACKREF, TAG_OBJECT, TAG_PICKLE, TAG_ABSENT, \
+    TAG_WIREPAYLOAD, TAG_DIMENSION = range(22)
+
+"""How schema fields are written."""
+FIELD_VALUE, FIELD_REF, FIELD_PAYLOAD = range(3)
+
+"""The longest label kept for a payload."""
+LABEL_LENGTH = 120
+
+"""First byte of any pickle (protocol 2 and later)."""
+PICKLE_MARK = 0x80
+
+FLOAT = struct.Struct(">d")
+
+
+def put_uint(out, n):
+    """Append a non-negative integer as a base-128 varint."""
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def put_str(out, value):
+    """Append a string as its length and UTF-8 encoding."""
+    encoded = value.encode("utf8", "surrogatepass")
+    put_uint(out, len(encoded))
+    out += encoded
+
+
+class WireCodecError(ValueError):
+    """This error should be used to signal a frame that can't be decoded."""
+
+    def __init__(self, *args, **kwargs):
+        ValueError.__init__(self, *args, **kwargs)
+
+
+class FrameReader(object):
+    """Decoding state of one frame."""
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+        self.table = []     # objects back-references may point to
+
+    def uint(self):
+        data, pos = self.data, self.pos
+        n, shift = 0, 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        self.pos = pos
+        return n
+
+    def chunk(self):
+        length = self.uint()
+        start = self.pos
+        self.pos = start + length
+        return self.data[start:self.pos]
+
+
+class WireCodec(object):
+    """Encode and decode messages exchanged between nodes.
+
+    Message classes are declared with register(): a wire tag (that must never
+    be reused for another class), the attributes to transmit, and among them
+    those that only refer to a node. Attributes an object has beyond its
+    schema are sent by name, so nothing is lost when a message carries more
+    than what it was declared with.
+    """
+
+    VERSION = 1
+
+    """Values of TAG_NONE, TAG_TRUE and TAG_FALSE."""
+    CONSTANTS = (None, True, False)
+
+    __shared = None
+
+    def __init__(self):
+        self.__schemas = {}     # class -> (header, fields, field set)
+        self.__classes = {}     # tag -> (class, fields)
+        self.__writers = {
+            type(None): self.__write_none,
+            bool: self.__write_bool,
+            int: self.__write_int,
+            float: self.__write_float,
+            str: self.__write_str,
+            bytes: self.__write_bytes,
+            list: self.__write_list,
+            tuple: self.__write_tuple,
+            dict: self.__write_dict,
+            set: self.__write_set,
+            NameID: self.__write_name_id,
+            NumericID: self.__write_numeric_id,
+            PartitionID: self.__write_partition_id,
+            }
+        readers = {
+            TAG_NONE: lambda reader: None,
+            TAG_TRUE: lambda reader: True,
+            TAG_FALSE: lambda reader: False,
+            TAG_INT: self.__read_int,
+            TAG_FLOAT: self.__read_float,
+            TAG_STR: self.__read_str,
+            TAG_BYTES: lambda reader: bytes(reader.chunk()),
+            TAG_LIST: self.__read_list,
+            TAG_TUPLE: lambda reader: tuple(self.__read_list(reader)),
+            TAG_DICT: self.__read_dict,
+            TAG_SET: lambda reader: set(self.__read_list(reader)),
+            TAG_NAMEID: lambda reader: NameID(self.__read_str(reader)),
+            TAG_NUMERICID: self.__read_numeric_id,
+            TAG_PARTITIONID: self.__read_partition_id,
+            TAG_NODE: self.__read_node,
+            TAG_NODEREF: self.__read_node_ref,
+            TAG_BACKREF: lambda reader: reader.table[reader.uint()],
+            TAG_OBJECT: self.__read_object,
+            TAG_PICKLE: lambda reader: pickle.loads(reader.chunk()),
+            TAG_WIREPAYLOAD: self.__read_wire_payload,
+            TAG_DIMENSION: self.__read_dimension,
+            }
+        self.__readers = [readers.get(tag, self.__read_unknown) for tag in range(max(readers) + 1)]
+        self.__node_class = None
+        self.__dimension_class = None
+        self.__dimension_names = {}     # name of an interned Dimension -> its encoding
+        self.__wire_payload_class = None
+        self.__register_defaults()
+
+    @classmethod
+    def shared(cls):
+        """Return the codec instance used by the network layer."""
+        if (cls.__shared == None):
+            cls.__shared = cls()
+        return cls.__shared
+
+    def register(self, tag, cls, fields, refs=(), payloads=(), transients=()):
+        """Declare the attributes of 'cls' to transmit. 'refs' lists the
+        attributes holding a Node of which only the identifiers matter,
+        'payloads' those holding a message to encode as a nested frame, and
+        'transients' those that are never sent (e.g. caches)."""
+        if (tag in self.__classes):
+            raise ValueError("wire tag %i already used by %s" % (tag, self.__classes[tag][0]))
+        fields = tuple((name, FIELD_REF if name in refs else
+                        FIELD_PAYLOAD if name in payloads else FIELD_VALUE) for name in fields)
+        header = bytearray((TAG_OBJECT,))
+        put_uint(header, tag)
+        self.__schemas[cls] = (bytes(header), fields,
+                               frozenset(name for name, kind in fields) | frozenset(transients))
+        self.__classes[tag] = (cls, fields)
+        self.__writers[cls] = self.__write_object
+
+    def __register_defaults(self):
+        # imported here: node and join depend on network, that depends on us.
+        from equation import Range, Dimension, Component, InternalNode, SpacePart, CPE
+        from routing import PidRange
+        from tracing import TraceLog
+        from node import Node, NetNodeInfo
+        import messages
+        import join
+
+        self.__node_class = Node
+        self.__writers[Node] = self.__write_node
+        self.__dimension_class = Dimension
+        self.__wire_payload_class = messages.WirePayload
+
+        route = ("_RouteMessage__payload", "_RouteMessage__ttl")
+        payload = ("_RouteMessage__payload",)
+        ctrl = ("_CtrlMessage__log", "uid")
+
+        self.register(1, messages.RouteDirect, route + ("_RouteDirect__dst_node",),
+                      refs=("_RouteDirect__dst_node",), payloads=payload)
+        self.register(2, messages.RouteByNumericID, route + (
+            "_RouteByNumericID__dst_num_id", "_RouteByNumericID__best_node",
+            "_RouteByNumericID__start_node", "_RouteByNumericID__ring_level",
+            "_RouteByNumericID__final_destination"),
+                      refs=("_RouteByNumericID__best_node", "_RouteByNumericID__start_node"),
+                      payloads=payload)
+        self.register(3, messages.RouteByNameID, route + ("_RouteByNameID__dst_name_id",),
+                      payloads=payload)
+        self.register(4, messages.RouteByCPE, route + (
+            "_RouteByCPE__space_part", "_RouteByCPE__limit",
+            "_RouteByCPE__forking", "_RouteByCPE__log"), payloads=payload)
+        # the payload of a RouteByPayload routes it (and often is the message itself).
+        self.register(5, messages.RouteByPayload, route + ("_state",))
+        self.register(6, messages.RoutePointsByCPE, route, payloads=payload)
+
+        self.register(10, messages.InsertionRequest, (
+            "_InsertionRequest__data", "_InsertionRequest__key"))
+        self.register(11, messages.LookupRequest, (
+            "_LookupRequest__key", "_LookupRequest__nonce", "_LookupRequest__from"),
+                      refs=("_LookupRequest__from",))
+        self.register(12, messages.LookupReply, ("_LookupReply__data", "_LookupReply__nonce"))
+        self.register(13, messages.SNPingMessage, ctrl + (
+            "_SNPingMessage__src_node", "_SNPingMessage__ring_level", "_SNPingMessage__when",
+            "_SNPingMessage__ring_levels"))
+        self.register(14, messages.SNPingRequest, ctrl + ("source", "ring_level"))
+        self.register(15, messages.SNLeaveRequest, ctrl + ("_SNLeaveRequest__leaving_node",),
+                      refs=("_SNLeaveRequest__leaving_node",))
+        self.register(16, messages.SNLeaveReply, ctrl + (
+            "_SNLeaveReply__request", "_SNLeaveReply__contacted_node"))
+        self.register(17, messages.IdentityRequest, (
+            "_IdentityRequest__questioner_node", "_IdentityRequest__looked_name"))
+        self.register(18, messages.IdentityReply, ("_IdentityReply__neighbour_node",))
+        self.register(19, messages.EncapsulatedMessage, (
+            "_EncapsulatedMessage__encapsulated_message",))
+        self.register(20, messages.BatchInsertionRequest, (
+            "_BatchInsertionRequest__data", "_BatchInsertionRequest__columns"))
+
+        self.register(30, join.SNJoinRequest, ctrl + (
+            "_SNJoinRequest__phase", "_SNJoinRequest__joining_node"))
+        self.register(31, join.SNJoinReply, ctrl + (
+            "_SNJoinReply__request_msg", "_SNJoinReply__neighbours"))
+        self.register(32, join.SNFixupHigher, route + ("_state",) + ctrl + (
+            "_SNFixupHigher__src_node", "_SNFixupHigher__ring_level",
+            "_SNFixupHigher__direction", "_SNFixupHigher__neighbours",
+            "_SNFixupHigher__first_hop", "_SNFixupHigher__complete",
+            "_SNFixupHigher__nb_hops"))
+        self.register(33, join.STJoinRequest, ctrl + (
+            "_STJoinRequest__phase", "_STJoinRequest__joining_node"))
+        self.register(34, join.STJoinReply, ctrl + (
+            "_STJoinReply__contact_node", "_STJoinReply__cpe", "_STJoinReply__partition_id",
+            "_STJoinReply__data", "_STJoinReply__phase"))
+        self.register(35, join.STJoinError, ctrl + (
+            "_STJoinError__reason", "_STJoinError__original_message"))
+        self.register(36, join.STJoinData, ctrl + (
+            "_STJoinData__contact_node", "_STJoinData__transfer", "_STJoinData__seq",
+            "_STJoinData__chunk", "_STJoinData__compressed", "_STJoinData__last"),
+                      refs=("_STJoinData__contact_node",))
+        self.register(37, join.STJoinDataAck, ctrl + (
+            "_STJoinDataAck__joining_node", "_STJoinDataAck__transfer", "_STJoinDataAck__seq"),
+                      refs=("_STJoinDataAck__joining_node",))
+
+        range_fields = ("_Range__min", "_Range__max", "_Range__min_included", "_Range__max_included")
+        component_fields = ("_Component__dimension", "_Component__value", "_Component__virtual")
+        self.register(50, Range, range_fields)
+        self.register(51, PidRange, range_fields)
+        # Dimensions are written by name (TAG_DIMENSION) when it is a string.
+        self.register(52, Dimension, ("_Dimension__dimension",))
+        self.__writers[Dimension] = self.__write_dimension
+        self.register(53, Component, component_fields)
+        self.register(54, InternalNode, component_fields + ("_InternalNode__direction",))
+        self.register(55, SpacePart, ("_SpacePart__coordinates",))
+        self.register(56, CPE, ("_CPE__internal_nodes", "_CPE__dim_count"),
+                      transients=("_CPE__compiled",))
+        self.register(57, NetNodeInfo, ("_NetNodeInfo__address",))
+        self.register(58, TraceLog, ("_TraceLog__events", "_TraceLog__dropped"))
+
+    #
+    # Frames
+
+    def encode(self, message):
+        """Return the frame carrying 'message'."""
+        out = bytearray((self.VERSION,))
+        self.write(out, {}, message)
+        return bytes(out)
+
+    def decode(self, frame):
+        """Return the message carried by 'frame'."""
+        version = frame[0]
+        if (version == PICKLE_MARK):
+            return pickle.loads(frame)
+        if (version != self.VERSION):
+            raise WireCodecError("unsupported wire version %i" % version)
+        reader = FrameReader(frame, 1)
+        return self.read(reader)
+
+    def message_class(self, frame):
+        """Return the class of the object carried by 'frame' without decoding
+        it, or None if it isn't a registered class."""
+        if (len(frame) < 3 or frame[0] != self.VERSION or frame[1] != TAG_OBJECT):
+            return None
+        entry = self.__classes.get(FrameReader(frame, 2).uint())
+        return entry[0] if entry != None else None
+
+    def write(self, out, memo, value):
+        """Append 'value' to 'out'. 'memo' maps the objects already written
+        to their back-reference index."""
+        cls = value.__class__
+        if (cls is str):
+            # most values are short strings: don't go through __writers.
+            encoded = value.encode("utf8", "surrogatepass")
+            if (len(encoded) < 0x80):
+                out.append(TAG_STR)
+                out.append(len(encoded))
+                out += encoded
+                return
+        elif (value is None):
+            out.append(TAG_NONE)
+            return
+        writer = self.__writers.get(cls)
+        if (writer == None):
+            writer = self.__write_pickle
+        writer(out, memo, value)
+
+    def read(self, reader):
+        data, pos = reader.data, reader.pos
+        tag = data[pos]
+        if (tag == TAG_STR and data[pos + 1] < 0x80):
+            end = pos + 2 + data[pos + 1]
+            reader.pos = end
+            return str(data[pos + 2:end], "utf8", "surrogatepass")
+        if (tag == TAG_BACKREF and data[pos + 1] < 0x80):
+            reader.pos = pos + 2
+            return reader.table[data[pos + 1]]
+        reader.pos = pos + 1
+        if (tag <= TAG_FALSE):
+            return self.CONSTANTS[tag]
+        if (tag >= len(self.__readers)):
+            self.__read_unknown(reader)
+        return self.__readers[tag](reader)
+
+    def __read_unknown(self, reader):
+        raise WireCodecError("unknown tag %i at %i" % (reader.data[reader.pos - 1], reader.pos - 1))
+
+    #
+    # Plain values
+
+    def __write_none(self, out, memo, value):
+        out.append(TAG_NONE)
+
+    def __write_bool(self, out, memo, value):
+        out.append(TAG_TRUE if value else TAG_FALSE)
+
+    def __write_int(self, out, memo, value):
+        out.append(TAG_INT)
+        put_uint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+
+    def __read_int(self, reader):
+        n = reader.uint()
+        return (n >> 1) if not (n & 1) else -((n + 1) >> 1)
+
+    def __write_float(self, out, memo, value):
+        out.append(TAG_FLOAT)
+        out += FLOAT.pack(value)
+
+    def __read_float(self, reader):
+        pos = reader.pos
+        reader.pos = pos + 8
+        return FLOAT.unpack_from(reader.data, pos)[0]
+
+    def __write_str(self, out, memo, value):
+        out.append(TAG_STR)
+        if (len(value) < 0x80 and value.isascii()):
+            out.append(len(value))
+            out += value.encode("ascii")
+        else:
+            put_str(out, value)
+
+    def __read_str(self, reader):
+        return str(reader.chunk(), "utf8", "surrogatepass")
+
+    def __write_bytes(self, out, memo, value):
+        out.append(TAG_BYTES)
+        put_uint(out, len(value))
+        out += value
+
+    def __write_items(self, out, memo, tag, items):
+        out.append(tag)
+        put_uint(out, len(items))
+        write, writers = self.write, self.__writers
+        for item in items:
+            writers.get(item.__class__, write)(out, memo, item)
+
+    def __write_list(self, out, memo, value):
+        self.__write_items(out, memo, TAG_LIST, value)
+
+    def __write_tuple(self, out, memo, value):
+        self.__write_items(out, memo, TAG_TUPLE, value)
+
+    def __write_set(self, out, memo, value):
+        self.__write_items(out, memo, TAG_SET, value)
+
+    def __read_list(self, reader):
+        return [self.read(reader) for i in range(reader.uint())]
+
+    def __write_dict(self, out, memo, value):
+        out.append(TAG_DICT)
+        put_uint(out, len(value))
+        write, writers = self.write, self.__writers
+        for key, item in value.items():
+            writers.get(key.__class__, write)(out, memo, key)
+            writers.get(item.__class__, write)(out, memo, item)
+
+    def __read_dict(self, reader):
+        result = {}
+        for i in range(reader.uint()):
+            key = self.read(reader)
+            result[key] = self.read(reader)
+        return result
+
+    def __write_pickle(self, out, memo, value):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        out.append(TAG_PICKLE)
+        put_uint(out, len(pickled))
+        out += pickled
+
+    #
+    # Identifiers
+
+    def __write_name_id(self, out, memo, value):
+        out.append(TAG_NAMEID)
+        put_str(out, value.name)
+
+    def __write_numeric_id(self, out, memo, value):
+        out.append(TAG_NUMERICID)
+        put_uint(out, int(value))
+        put_uint(out, value.get_nb_digit())
+
+    def __read_numeric_id(self, reader):
+        value = reader.uint()
+        return NumericID(value, False, reader.uint())
+
+    def __write_partition_id(self, out, memo, value):
+        numerator, bits = value.__reduce__()[1]
+        out.append(TAG_PARTITIONID)
+        put_uint(out, (numerator << 1) if numerator >= 0 else ((-numerator << 1) - 1))
+        put_uint(out, bits)
+
+    def __read_partition_id(self, reader):
+        numerator = self.__read_int(reader)
+        return PartitionID(numerator, reader.uint())
+
+    def __write_dimension(self, out, memo, value):
+        # the dimensions of a SpacePart, keys and components alike, are most
+        #   of what a message holds: they are named rather than memoised, and
+        #   the encoding of the interned ones is kept.
+        name = value.dimension
+        encoded = self.__dimension_names.get(name)
+        if (encoded == None):
+            if (name.__class__ is not str):
+                self.__write_object(out, memo, value)
+                return
+            encoded = bytearray((TAG_DIMENSION,))
+            put_str(encoded, name)
+            encoded = bytes(encoded)
+            if (name in self.__dimension_class.all_dims):
+                self.__dimension_names[name] = encoded
+        out += encoded
+
+    def __read_dimension(self, reader):
+        name = self.__read_str(reader)
+        known = self.__dimension_class.all_dims
+        return known[name] if name in known else self.__dimension_class(name)
+
+    #
+    # Nodes
+
+    def __write_node(self, out, memo, node):
+        key = id(node)
+        if (key in memo):
+            out.append(TAG_BACKREF)
+            put_uint(out, memo[key])
+            return
+        memo[key] = len(memo)
+        out.append(TAG_NODE)
+        self.__write_node_ids(out, memo, node)
+        self.write(out, memo, node.cpe)
+
+    def __write_node_ref(self, out, memo, node):
+        """Write the identifiers of a node, leaving out its CPE."""
+        if (node.__class__ is not self.__node_class):
+            self.write(out, memo, node)
+            return
+        key = id(node)
+        index = memo.get(key)
+        if (index == None):
+            index = memo.get((TAG_NODEREF, key))
+        if (index != None):
+            out.append(TAG_BACKREF)
+            put_uint(out, index)
+            return
+        memo[(TAG_NODEREF, key)] = len(memo)
+        out.append(TAG_NODEREF)
+        self.__write_node_ids(out, memo, node)
+
+    def __write_node_ids(self, out, memo, node):
+        self.write(out, memo, node.name_id)
+        self.write(out, memo, node.numeric_id)
+        self.write(out, memo, node.net_info)
+        self.write(out, memo, node.partition_id)
+
+    def __read_node(self, reader, with_cpe=True):
+        index = len(reader.table)
+        reader.table.append(None)
+        name_id = self.read(reader)
+        numeric_id = self.read(reader)
+        net_info = self.read(reader)
+        partition_id = self.read(reader)
+        cpe = self.read(reader) if with_cpe else None
+        node = self.__node_class.remote(name_id, numeric_id, net_info, partition_id, cpe)
+        reader.table[index] = node
+        return node
+
+    def __read_node_ref(self, reader):
+        return self.__read_node(reader, False)
+
+    #
+    # Payloads
+
+    def __write_wire_payload(self, out, payload):
+        """Write a payload as a nested frame, or the one it was received as."""
+        if (payload.__class__ is self.__wire_payload_class):
+            raw = payload.raw
+        else:
+            raw = self.encode(payload)
+        out.append(TAG_WIREPAYLOAD)
+        put_str(out, repr(payload)[:LABEL_LENGTH])
+        put_uint(out, len(raw))
+        out += raw
+
+    def __read_wire_payload(self, reader):
+        label = self.__read_str(reader)
+        return self.__wire_payload_class(bytes(reader.chunk()), label)
+
+    #
+    # Schema objects
+
+    def __write_object(self, out, memo, obj):
+        count = len(memo)
+        index = memo.setdefault(id(obj), count)
+        if (index != count):
+            out.append(TAG_BACKREF)
+            put_uint(out, index)
+            return
+        header, fields, names = self.__schemas[obj.__class__]
+        out += header
+
+        # the field loop is the hot spot of encoding: constants and short
+        #   strings, most of the values, are written inline.
+        state = obj.__dict__
+        absent = 0
+        write = self.write
+        writers = self.__writers
+        append = out.append
+        for name, kind in fields:
+            value = state.get(name, state)    # the state itself tells an absent field
+            if (value is state):
+                append(TAG_ABSENT)
+                absent += 1
+            elif (kind == FIELD_VALUE):
+                cls = value.__class__
+                if (cls is str and len(value) < 0x80 and value.isascii()):
+                    append(TAG_STR)
+                    append(len(value))
+                    out += value.encode("ascii")
+                elif (cls is bool):
+                    append(TAG_TRUE if value else TAG_FALSE)
+                elif (value is None):
+                    append(TAG_NONE)
+                else:
+                    writers.get(cls, write)(out, memo, value)
+            elif (kind == FIELD_REF):
+                self.__write_node_ref(out, memo, value)
+            else:
+                self.__write_wire_payload(out, value)
+
+        if (len(fields) - absent == len(state)):
+            append(0)
+        else:
+            extra = [name for name in state if name not in names]
+            put_uint(out, len(extra))
+            for name in extra:
+                self.__write_str(out, memo, name)
+                write(out, memo, state[name])
+
+    def __read_object(self, reader):
+        tag = reader.uint()
+        try:
+            cls, fields = self.__classes[tag]
+        except KeyError:
+            raise WireCodecError("unknown class tag %i" % tag)
+        obj = cls.__new__(cls)
+        reader.table.append(obj)
+
+        state = obj.__dict__
+        data = reader.data
+        read = self.read
+        constants = self.CONSTANTS
+        for name, kind in fields:
+            pos = reader.pos
+            tag = data[pos]
+            if (tag <= TAG_FALSE):
+                state[name] = constants[tag]
+                reader.pos = pos + 1
+            elif (tag == TAG_ABSENT):
+                reader.pos = pos + 1
+            else:
+                state[name] = read(reader)
+
+        for i in range(reader.uint()):
+            name = read(reader)
+            state[name] = read(reader)
+        return obj
@@ -1,18 +1,24 @@
 # System imports
+import bisect
 import copy
 import logging
 import math
 import random
+import threading
 import avl  # see sourceforge.net/project/pyavl 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # batches of points are then tested one point at a time.
 
 # ResumeNet imports
+from logpipe import LogPipe
 from util import Direction
 
 # ------------------------------------------------------------------------------------------------
 
 # Module log abilities
-LOG_HANDLER = logging.StreamHandler()
-LOG_HANDLER.setLevel(logging.DEBUG)
+LOG_HANDLER = LogPipe.shared().handler
 
 LOGGER = logging.getLogger("equation")
 LOGGER.setLevel(logging.DEBUG)
@@ -402,15 +408,102 @@ class SpacePart(object):
             i = i + 1
 
 
+class PointBatch(object):
+    """PointBatch holds points (single values along each of their dimensions)
+    as one column of values per dimension, so that they can be tested against
+    a CPE all at once (see CPE.which_side_points).
+
+    With NumPy, columns are arrays and masks are arrays of booleans;
+    otherwise, they are lists. 'indices' are the positions of the points in
+    the batch a sub-batch was selected from.
+    """
+
+    def __init__(self, columns, indices=None):
+        """'columns' is a Dimension -> sequence of values dictionary."""
+        self.__columns = {}
+        size = None
+        for dimension, column in columns.items():
+            if (numpy != None):
+                column = numpy.asarray(column)
+            elif (column.__class__ != list):
+                column = list(column)
+            if (size != None and len(column) != size):
+                raise ValueError("column %s has %i values instead of %i"%(
+                    repr(dimension), len(column), size))
+            size = len(column)
+            self.__columns[dimension] = column
+        self.__size = size if size != None else 0
+        if (indices is None):
+            indices = numpy.arange(self.__size) if numpy != None else list(range(self.__size))
+        self.__indices = indices
+
+    def __len__(self):
+        return self.__size
+
+    #
+    # Properties
+
+    @property
+    def dimensions(self):
+        """Return the dimensions the points have a value for."""
+        return set(self.__columns.keys())
+
+    @property
+    def indices(self):
+        """Return the positions of the points in the original batch."""
+        return self.__indices
+
+    #
+    #
+
+    def column(self, dimension):
+        """Return the values of the points along 'dimension' (None if undefined)."""
+        return self.__columns.get(dimension)
+
+    def with_value(self, dimension, value):
+        """Return a PointBatch whose points all have 'value' along 'dimension'."""
+        columns = dict(self.__columns)
+        columns[dimension] = [value] * self.__size
+        return PointBatch(columns, self.__indices)
+
+    def split(self, mask):
+        """Return the PointBatch of the points 'mask' is True for, and the
+        PointBatch of the other ones."""
+        if (numpy != None):
+            mask = numpy.asarray(mask, dtype=bool)
+            rest = ~mask
+            return (PointBatch(dict((d, c[mask]) for d, c in self.__columns.items()), self.__indices[mask]),
+                    PointBatch(dict((d, c[rest]) for d, c in self.__columns.items()), self.__indices[rest]))
+        selected = [i for i in range(self.__size) if mask[i]]
+        others = [i for i in range(self.__size) if not mask[i]]
+        return (self.__take(selected), self.__take(others))
+
+    def __take(self, positions):
+        columns = dict((d, [c[i] for i in positions]) for d, c in self.__columns.items())
+        return PointBatch(columns, [self.__indices[i] for i in positions])
+
+    @staticmethod
+    def either(mask_a, mask_b):
+        """Return the mask of the points either 'mask_a' or 'mask_b' is True for."""
+        if (numpy != None):
+            return numpy.logical_or(mask_a, mask_b)
+        return [a or b for a, b in zip(mask_a, mask_b)]
+
+
 class DataStore(object):
     """ Provides a bare bone implementation of the local data store.
     Here, the store is backed by a flat list (__data), with no attempt
     to make add() or get() calls highly performant. Lots of room for
     improvement.
+
+    Lookups may run on several workers at once: get() only reads the list,
+    that add() merely appends to, while the calls updating or reading the
+    per-dimension counters hold the store lock.
     """
     def __init__(self, l_data=None):
         self.__data = list()
         self.__data_by_dimension = dict()
+        self.__lock = threading.RLock()
 
         if(l_data != None):
             for i in range(len(l_data)):
@@ -428,9 +521,17 @@ class DataStore(object):
                 values.append(pair[1])
         return values
 
-        
+    def items(self, start=0):
+        """Return the (space_part, data) pairs of the DataStore, in insertion
+        order, skipping the 'start' first ones."""
+        return [pair for space_part, pair in self.__data[start:]]
+
     def add(self, space_part, data):
         """Add a data in the DataStore."""
+        with self.__lock:
+            self.__add(space_part, data)
+
+    def __add(self, space_part, data):
         # Detect new dimension.
         dim_cpe = set(self.__data_by_dimension.keys())
         dim_msg = space_part.dimensions
@@ -458,6 +559,10 @@ class DataStore(object):
 
     def get_partition_value(self, cpe):
         """Return a pair [best dimension, best partition value, data from left, data from right]."""
+        with self.__lock:
+            return self.__get_partition_value(cpe)
+
+    def __get_partition_value(self, cpe):
         if(len(self.__data_by_dimension) <= 0):
             raise ValueError("There isn't any data in DataStore.")
 
@@ -908,10 +1013,125 @@ class CPEMissingDimension(CPEError):
         return self.__dimension
 
 
+class CompiledCPE(object):
+    """CompiledCPE is the form of a CPE which_side_space() works on.
+
+    The internal nodes are sorted per dimension into their LEFT cuts and
+    their RIGHT cuts, each kept in CPE order as (position, value) pairs.
+    Along a CPE, the cuts on a dimension are nested: a LEFT cut never lies
+    beyond the LEFT cuts before it, and likewise for RIGHT cuts. As a
+    consequence, whether a space part is on the wrong side of a cut only
+    changes once along such a list, and it can be found by bisection. A
+    space part is then oriented in O(dimensions x log(height)) instead of
+    walking every internal node.
+
+    'nested' is False if a CPE doesn't have that property (or its cuts
+    can't be ordered): CPE.which_side_space() then walks the internal nodes.
+    """
+
+    """Height below which walking the internal nodes is as fast."""
+    MIN_HEIGHT = 8
+
+    def __init__(self, internal_nodes):
+        self.__height = len(internal_nodes)
+        self.__cuts = {}    # dimension -> (LEFT cuts, RIGHT cuts)
+        self.nested = True
+        for position, inode in enumerate(internal_nodes):
+            lefts, rights = self.__cuts.setdefault(inode.dimension, ([], []))
+            value = inode.value
+            try:
+                if (inode.direction == Direction.LEFT):
+                    self.nested &= (len(lefts) == 0 or not lefts[-1][1] < value)
+                    lefts.append((position, value))
+                else:
+                    self.nested &= (len(rights) == 0 or not value < rights[-1][1])
+                    rights.append((position, value))
+            except TypeError:
+                self.nested = False
+
+    @staticmethod
+    def __first_crossed(cuts, crossed):
+        """Return the index of the first cut 'crossed' is True for, assuming
+        it remains True for the following ones (len(cuts) if there isn't any)."""
+        low, high = 0, len(cuts)
+        while (low < high):
+            middle = (low + high) // 2
+            if (crossed(cuts[middle][1])):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    @staticmethod
+    def __last_before(cuts, position):
+        """Return the last cut appearing before 'position' in the CPE (or None)."""
+        i = bisect.bisect_left(cuts, (position,))
+        return cuts[i - 1] if i > 0 else None
+
+    def which_side_space(self, space_part, forking=False):
+        """Return [left, here, right], as CPE.which_side_space() does."""
+        stop, stop_side = self.__height, None   # first cut the space part is beyond
+        present, missing = [], []
+        for dimension, (lefts, rights) in self.__cuts.items():
+            component = space_part.get_component(dimension)
+            if (component == None):
+                missing.append((dimension, lefts, rights))
+                continue
+            value = component.value
+            if (value.__class__ == Range):
+                is_left = lambda cut, value=value: (value.is_any_point_before_value(cut) or
+                                                    value.includes_value(cut))
+                is_right = value.is_any_point_after_value
+            else:
+                is_left = lambda cut, value=value: value <= cut
+                is_right = lambda cut, value=value: cut < value
+            present.append((lefts, rights, is_left, is_right))
+
+            # a LEFT cut holds what is at its left: the space part is beyond it
+            # if it's entirely on the right (and conversely).
+            i = self.__first_crossed(lefts, lambda cut: not is_left(cut))
+            if (i < len(lefts) and lefts[i][0] < stop):
+                stop, stop_side = lefts[i][0], Direction.RIGHT
+            i = self.__first_crossed(rights, lambda cut: not is_right(cut))
+            if (i < len(rights) and rights[i][0] < stop):
+                stop, stop_side = rights[i][0], Direction.LEFT
+
+        left = (stop_side == Direction.LEFT)
+        right = (stop_side == Direction.RIGHT)
+        missing.sort(key=lambda entry: min(cut[0] for cut in entry[1] + entry[2]))
+        for dimension, lefts, rights in missing:
+            if (min(cut[0] for cut in lefts + rights) >= stop):
+                break
+            if (not forking):
+                raise CPEMissingDimension(
+                    "Mandatory dimension %s isn't defined in %s"%
+                    (repr(dimension),repr(space_part)), dimension)
+            # no clue, a split is required on the side(s) of the cuts met.
+            right |= (len(lefts) > 0 and lefts[0][0] < stop)
+            left |= (len(rights) > 0 and rights[0][0] < stop)
+
+        # among the cuts met, the last ones are the most likely to see
+        # a part of the space part on their other side.
+        for lefts, rights, is_left, is_right in present:
+            cut = self.__last_before(lefts, stop)
+            if (cut != None and not right):
+                right = is_right(cut[1])
+            cut = self.__last_before(rights, stop)
+            if (cut != None and not left):
+                left = is_left(cut[1])
+
+        here = (stop == self.__height)
+        assert True == left | here | right, "The request coudn't be oriented."
+        return [left, here, right]
+
+
 class CPE(object):
     """The Characteristic Plane Equations (CPE) of a Node is all the Plane Equation assigned to \
 the Node that delimits the area managed by the Node."""
 
+    """The CompiledCPE of the current internal nodes (built when needed)."""
+    __compiled = None
+
     def __init__(self, dimensions=[]):
         self.__internal_nodes = list()
 
@@ -944,6 +1164,7 @@ the Node that delimits the area managed by the Node."""
         """Append a node in the CPE."""
         self.__update_dimension_count(inode.dimension, +1)
         self.__internal_nodes.append(inode)
+        self.__compiled = None
 
     def add_node_from_values(self, side, dimension, value):
         """Add a node in the CPE."""
@@ -957,6 +1178,7 @@ the Node that delimits the area managed by the Node."""
         if(0 < len(self.__internal_nodes)):
             inode = self.__internal_nodes.pop()
             self.__update_dimension_count(inode.dimension, -1)
+            self.__compiled = None
 
 
     def __update_dimension_count(self, dimension, value):
@@ -984,14 +1206,92 @@ the Node that delimits the area managed by the Node."""
                 break
         return (min_val, max_val)
 
+    def get_bounds(self):
+        """Return the region managed by the local node, as a Dimension -> (low, high)
+        dictionary: values are above 'low' and up to 'high' (None if unbounded)."""
+        bounds = {}
+        for inode in self.__internal_nodes:
+            low, high = bounds.get(inode.dimension, (None, None))
+            if (inode.direction == Direction.LEFT):
+                if (high == None or inode.value < high):
+                    high = inode.value
+            elif (low == None or inode.value > low):
+                low = inode.value
+            bounds[inode.dimension] = (low, high)
+        return bounds
+
     #
     #
 
+    @property
+    def compiled(self):
+        """Return the CompiledCPE of this CPE."""
+        compiled = self.__compiled
+        if (compiled == None):
+            compiled = self.__compiled = CompiledCPE(self.__internal_nodes)
+        return compiled
+
     def which_side_space(self, space_part, forking=False):
         """ Indicates to which side of the node belongs the 'space_part'.
             'Left' means one of the internal nodes would have to be followed
             to the left instead so that the desired part is reached.
         """
+        if (len(self.__internal_nodes) < CompiledCPE.MIN_HEIGHT):
+            return self.interpret_side_space(space_part, forking)
+        compiled = self.compiled
+        if (compiled.nested):
+            try:
+                return compiled.which_side_space(space_part, forking)
+            except TypeError:
+                pass # values that can't be compared: the walk reports it.
+        return self.interpret_side_space(space_part, forking)
+
+    def which_side_points(self, batch):
+        """Return the masks [left, here, right] of the points of 'batch' (a
+        PointBatch), each point being oriented as which_side_space() would.
+        """
+        size = len(batch)
+        columns = []
+        for inode in self.__internal_nodes:
+            column = batch.column(inode.dimension)
+            if (column is None): # (columns may be arrays)
+                raise CPEMissingDimension(
+                    "Mandatory dimension %s isn't defined in the batch"%
+                    repr(inode.dimension), inode.dimension)
+            columns.append(column)
+
+        # a point is at the left of the first internal node it isn't managed
+        #   by if that's a RIGHT node, at the right if that's a LEFT node.
+        if (numpy != None):
+            left = numpy.zeros(size, dtype=bool)
+            right = numpy.zeros(size, dtype=bool)
+            undecided = numpy.ones(size, dtype=bool)
+            for inode, column in zip(self.__internal_nodes, columns):
+                if (inode.direction == Direction.LEFT):
+                    beyond = undecided & (column > inode.value)
+                    right |= beyond
+                else:
+                    beyond = undecided & (column <= inode.value)
+                    left |= beyond
+                undecided &= ~beyond
+            return [left, undecided, right]
+
+        left, here, right = [False] * size, [True] * size, [False] * size
+        nodes = [(inode.direction == Direction.LEFT, inode.value, column)
+                 for inode, column in zip(self.__internal_nodes, columns)]
+        for i in range(size):
+            for is_left, cut, column in nodes:
+                if (is_left):
+                    if (column[i] > cut):
+                        here[i], right[i] = False, True
+                        break
+                elif (column[i] <= cut):
+                    here[i], left[i] = False, True
+                    break
+        return [left, here, right]
+
+    def interpret_side_space(self, space_part, forking=False):
+        """which_side_space() walking the internal nodes one by one."""
         nb_here = 0
         here, left, right = False, False, False
         for inode in self.__internal_nodes:
@@ -1072,6 +1372,15 @@ the Node that delimits the area managed by the Node."""
             m_repr += '/EQ'
         return m_repr
 
+    #
+    # Define special pickling behaviour.
+
+    def __getstate__(self):
+        """The compiled form isn't pickled: it's rebuilt when needed."""
+        state = copy.copy(self.__dict__)
+        state.pop('_CPE__compiled', None)
+        return state
+
     #
     # Overwritten
 
@@ -1,20 +1,24 @@
+import collections
 import copy
 import logging
 import sys
+import zlib
 
 from routing import Router, RoutingDeferred
 
+from codec import WireCodec
 from messages import VisitorMessage, CtrlMessage
-from messages import RouteDirect, RouteByNameID, RouteByPayload
+from messages import RouteDirect, RouteByNameID, RouteByPayload, RouteByCPE
+from messages import InsertionRequest # to re-route data inserted during a handoff.
 from messages import SNPingRequest, SNPingMessage # for delayed joins.
 
-from equation import InternalNode, DataStore # to split CPE on join
+from equation import InternalNode, DataStore, SpacePart # to split CPE on join
 from nodeid import NodeID, PartitionID
 from util import Direction
+from logpipe import LogPipe
 
 # Module log abilities
-LOG_HANDLER = logging.StreamHandler()
-LOG_HANDLER.setLevel(logging.DEBUG)
+LOG_HANDLER = LogPipe.shared().handler
 
 LOGGER = logging.getLogger("join")
 LOGGER.setLevel(logging.DEBUG)
@@ -87,6 +91,8 @@ class SNFixupHigher(RouteByPayload, CtrlMessage):
     message take a big role in the "Joining part" and the update part of the network.   
     """
 
+    datagram = True
+
     def __init__(self, src_node, ring_level, direction):
         RouteByPayload.__init__(self, self)
         CtrlMessage.__init__(self)
@@ -287,6 +293,106 @@ class STJoinReply(CtrlMessage):
         visitor.visit_STJoinReply(self)
 
 
+class STJoinData(CtrlMessage):
+    """One chunk of the data a contact node hands over to a joining node,
+    following a STJoinReply proposition (see DataHandoff). The chunks are
+    bulk messages: a joining node under load refuses them, and DataHandoff
+    sends them again when no acknowledgement comes in."""
+    control = False
+    bulk = True
+
+    def __init__(self, contact_node, transfer, seq, chunk, compressed=False, last=False):
+        CtrlMessage.__init__(self)
+
+        self.__contact_node = contact_node
+        self.__transfer = transfer
+        self.__seq = seq
+        self.__chunk = chunk
+        self.__compressed = compressed
+        self.__last = last
+
+    def __repr__(self):
+        return "<STJoinData #%i.%i%s>" % (self.__transfer, self.__seq, " last" if self.__last else "")
+
+    #
+    # Properties
+
+    @property
+    def contact_node(self):
+        """Return the node that hands the data over."""
+        return self.__contact_node
+
+    @property
+    def transfer(self):
+        """Return the uid of the STJoinReply the chunk belongs to."""
+        return self.__transfer
+
+    @property
+    def seq(self):
+        """Return the rank of the chunk in the transfer."""
+        return self.__seq
+
+    @property
+    def last(self):
+        """Return True if no chunk follows this one."""
+        return self.__last
+
+    @property
+    def size(self):
+        """Return the size of the chunk, as transmitted."""
+        return len(self.__chunk)
+
+    #
+    #
+
+    def items(self):
+        """Return the (space_part, data) pairs carried by the chunk."""
+        codec = WireCodec.shared()
+        chunk = zlib.decompress(self.__chunk) if self.__compressed else self.__chunk
+        return [codec.decode(frame) for frame in codec.decode(chunk)]
+
+    def accept(self, visitor):
+        visitor.visit_STJoinData(self)
+
+
+class STJoinDataAck(CtrlMessage):
+    """Acknowledge every chunk of a transfer up to (and including) 'seq'."""
+
+    def __init__(self, joining_node, transfer, seq):
+        CtrlMessage.__init__(self)
+
+        self.__joining_node = joining_node
+        self.__transfer = transfer
+        self.__seq = seq
+
+    def __repr__(self):
+        return "<STJoinDataAck #%i.%i>" % (self.__transfer, self.__seq)
+
+    #
+    # Properties
+
+    @property
+    def joining_node(self):
+        """Return the node that receives the data."""
+        return self.__joining_node
+
+    @property
+    def transfer(self):
+        """Return the uid of the STJoinReply the transfer follows."""
+        return self.__transfer
+
+    @property
+    def seq(self):
+        """Return the rank of the last chunk received in order (-1 if none)."""
+        return self.__seq
+
+    #
+    #
+
+    def accept(self, visitor):
+        visitor.visit_STJoinDataAck(self)
+
+
 class STJoinError(CtrlMessage):
     """sorry, you cannot join right here right now"""
     def __init__(self, original_message=None, reason=""):
@@ -329,6 +435,174 @@ class JoinException(Exception):
     def __str__(self):
         return repr(self.__message)
 
+
+class DataHandoff(object):
+    """Streams the data a contact node hands over to a joining node.
+
+    The data is cut into STJoinData chunks of about CHUNK_SIZE bytes, each
+    compressed with zlib when that makes it smaller. At most WINDOW chunks
+    are in flight at once, and STJoinDataAck acknowledges them cumulatively.
+    When no acknowledgement comes in for RESUME_DELAY seconds (typically the
+    connection broke), the chunks in flight are sent again, so the transfer
+    resumes where it stopped rather than from the start. After MAX_RESUMES
+    attempts without progress, 'abort' is called.
+    """
+
+    """Size of the encoded data carried by one chunk, before compression."""
+    CHUNK_SIZE = 64 * 1024
+
+    """Number of chunks sent ahead of the last acknowledgement."""
+    WINDOW = 4
+
+    """zlib level: chunks are compressed on the dispatcher loop."""
+    COMPRESS_LEVEL = 1
+
+    """Chunks smaller than this are sent as they are."""
+    COMPRESS_MIN = 512
+
+    RESUME_DELAY = 2.0
+    MAX_RESUMES = 8
+
+    def __init__(self, local_node, joining_node, proposal, data, abort=None):
+        self.__local_node = local_node
+        self.__joining_node = joining_node
+        self.__proposal = proposal
+        self.__abort = abort
+
+        self.__items = iter(data)
+        self.__lookahead = next(self.__items, None)
+        self.__next_seq = 0
+        self.__last_sent = False
+        self.__in_flight = collections.OrderedDict()
+        self.__acked = -1
+
+        self.__timer = None
+        self.__progress = False
+        self.__resumes = 0
+
+        # metrics
+        self.__items_sent = 0
+        self.__raw_bytes = 0
+        self.__wire_bytes = 0
+        self.__resent = 0
+
+    def __repr__(self):
+        return "<DataHandoff #%i to %s: %i items in %i chunks, %i/%i bytes, %i resent>" % (
+            self.__proposal.uid, self.__joining_node.pname, self.__items_sent, self.__next_seq,
+            self.__wire_bytes, self.__raw_bytes, self.__resent)
+
+    #
+    # Properties
+
+    @property
+    def transfer(self):
+        """Return the uid of the STJoinReply the transfer follows."""
+        return self.__proposal.uid
+
+    @property
+    def joining_node(self):
+        """Return the node the data is handed over to."""
+        return self.__joining_node
+
+    @property
+    def complete(self):
+        """Return True once every chunk has been acknowledged."""
+        return self.__last_sent and len(self.__in_flight) == 0
+
+    #
+    #
+
+    def start(self):
+        """Send the first chunks (the proposition must have been sent already)."""
+        self.__fill()
+        self.__arm()
+
+    def acknowledge(self, seq):
+        """Release the chunks up to 'seq' and send the next ones."""
+        if (seq <= self.__acked):
+            return
+        while (len(self.__in_flight) > 0 and next(iter(self.__in_flight)) <= seq):
+            self.__in_flight.popitem(last=False)
+        self.__acked = seq
+        self.__progress = True
+        if (self.complete):
+            self.close()
+        else:
+            self.__fill()
+
+    def close(self):
+        """Stop resuming the transfer."""
+        if (self.__timer != None):
+            self.__timer.cancel()
+            self.__timer = None
+
+    def __fill(self):
+        while (not self.__last_sent and len(self.__in_flight) < self.WINDOW):
+            chunk = self.__next_chunk()
+            self.__in_flight[chunk.seq] = chunk
+            self.__send(chunk)
+
+    def __next_chunk(self):
+        codec = WireCodec.shared()
+        frames, size = [], 0
+        while (self.__lookahead != None and size < self.CHUNK_SIZE):
+            frame = codec.encode(self.__lookahead)
+            frames.append(frame)
+            size += len(frame)
+            self.__lookahead = next(self.__items, None)
+
+        body = codec.encode(frames)
+        compressed = False
+        if (len(body) >= self.COMPRESS_MIN):
+            packed = zlib.compress(body, self.COMPRESS_LEVEL)
+            if (len(packed) < len(body)):
+                self.__raw_bytes += len(body)
+                body, compressed = packed, True
+        if (not compressed):
+            self.__raw_bytes += len(body)
+        self.__wire_bytes += len(body)
+        self.__items_sent += len(frames)
+
+        self.__last_sent = (self.__lookahead == None)
+        chunk = STJoinData(self.__local_node, self.__proposal.uid, self.__next_seq,
+                           body, compressed, self.__last_sent)
+        self.__next_seq += 1
+        return chunk
+
+    def __send(self, message):
+        self.__local_node.route_internal(RouteDirect(message, self.__joining_node))
+
+    def __arm(self):
+        dispatcher = self.__local_node.dispatcher
+        if (dispatcher != None and not self.complete):
+            self.__timer = dispatcher.loop.call_later(self.RESUME_DELAY, self.__resume)
+
+    def __resume(self):
+        self.__timer = None
+        if (self.complete):
+            return
+        if (self.__progress):
+            self.__progress = False
+            self.__resumes = 0
+            self.__arm()
+            return
+
+        self.__resumes += 1
+        if (self.__resumes > self.MAX_RESUMES):
+            LOGGER.warning("[DBG] giving up %s" % repr(self))
+            if (self.__abort != None):
+                self.__abort(self)
+            return
+
+        LOGGER.info("[DBG] resuming %s after chunk %i" % (repr(self), self.__acked))
+        if (self.__acked < 0):
+            # the proposition itself may have been lost.
+            self.__send(self.__proposal)
+        for chunk in self.__in_flight.values():
+            self.__resent += 1
+            self.__send(chunk)
+        self.__arm()
+
 ## ----------------------------------------------------------------
 ##  node internal processing of the SkipTree/SkipNet join requests.
 
@@ -336,6 +610,7 @@ class JoinProcessor(VisitorMessage):
 
     def __init__(self, node):
         self.__local_node = node
+        self.__handoff = None
         self.__reset_join_state()
         self.debugging=0
 
@@ -346,6 +621,14 @@ class JoinProcessor(VisitorMessage):
 
         self.__new_local_cpe = None
         self.__new_local_data = None
+        self.__split_size = 0
+        if (self.__handoff != None):
+            self.__handoff.close()
+        self.__handoff = None
+
+        self.__proposal = None
+        self.__staging = None
+        self.__staging_next = 0
 
     #
     #
@@ -388,24 +671,37 @@ class JoinProcessor(VisitorMessage):
 
                 join_cpe, join_data, self.__new_local_cpe, self.__new_local_data =\
                           self.compute_cpe_and_data(message,join_side)
+                self.__split_size = len(ln.data_store)
 
                 jm = self.__join_msg = STJoinReply(ln, STJoinReply.STATE_PROPOSE)
                 jm.partition_id = join_partition_id
                 jm.cpe = join_cpe
-                jm.data = join_data
+                jm.data = [] # streamed by the DataHandoff.
                 
                 route_msg = RouteDirect(jm, message.joining_node)
                 ln.sign("sending joinreply (ask phase)")
-                # this message is likely to be large. [network::]OutRequestManager 
-                #  may have a hard time transmitting this.
                 ln.route_internal(route_msg) 
-                ln.sign("sent joinreply (ask phase)")
+                # the local node keeps its CPE and its whole store until the
+                #  joining node accepts: lookups are still served meanwhile.
+                self.__handoff = DataHandoff(ln, message.joining_node, jm, join_data,
+                                             self.__handoff_failed)
+                self.__handoff.start()
+                ln.sign("sent joinreply (ask phase), streaming %i items"%len(join_data))
 
         elif(message.phase == STJoinRequest.STATE_ACCEPT):
             # blindly setup what the other node's compute_data_and_cpe has defined.
             ln.sign("Update the local node data");
+            if (self.__handoff != None):
+                print("0_0 handoff done: %s"%repr(self.__handoff))
+                self.__handoff.close()
+                self.__handoff = None
+            inserted = ln.data_store.items(self.__split_size)
             ln.cpe = self.__new_local_cpe
             ln.data_store = DataStore(self.__new_local_data)
+            # data inserted during the handoff is routed again along the new CPE.
+            for space_part, data in inserted:
+                request = InsertionRequest(data, space_part)
+                ln.route_internal(RouteByCPE(request, SpacePart(space_part.val2range())))
 
             print("0_0 Data Split accepted");
             local_node_status = ln.status_updater
@@ -435,6 +731,11 @@ class JoinProcessor(VisitorMessage):
 
         if(message.phase == STJoinReply.STATE_PROPOSE):
             self.__local_node.sign("join proposition received "+str(message.contact_node))
+            if(self.__proposal != None and self.__proposal.uid == message.uid and
+               self.__proposal.contact_node == message.contact_node):
+                # sent again by the DataHandoff: the first one was received.
+                return
+
             if(self.is_busy(message)):
                 # The local node is already busy with another joining node.
                 join_error = STJoinError(message, "Contacted node already busy with a join activity")
@@ -444,21 +745,18 @@ class JoinProcessor(VisitorMessage):
 
             else:
                 self.set_busy(message)
-                print("0_0 adding data in the local store ...")
-                self.__local_node.sign("inserting into local store")
-                # Set data received from contact node.
-                self.__local_node.partition_id = message.partition_id
-                self.__local_node.cpe = message.cpe
-                for data in message.data:
-                    self.__local_node.data_store.add(data[0],data[1])
-                # Send a reply to the contact node.
-                self.__join_msg = STJoinRequest(self.__local_node, STJoinRequest.STATE_ACCEPT)
-                self.__local_node.sign("accepting proposition")
-                route_msg = RouteDirect(self.__join_msg, message.contact_node)
-                self.__local_node.route_internal(route_msg)
+                self.__proposal = message
+                if(message.data):
+                    # the contact node sent all the data along its proposition.
+                    self.__accept_proposal(message.data)
+                else:
+                    print("0_0 receiving data from %s ..."%message.contact_node.pname)
+                    self.__staging = DataStore()
+                    self.__staging_next = 0
 
         elif(message.phase == STJoinReply.STATE_CONFIRM):
             self.set_busy(False)
+            self.__proposal = None
             print("0_0 connected, hopefully.")
             self.__local_node.status="connected through "+str(message.contact_node)
 
@@ -468,6 +766,61 @@ class JoinProcessor(VisitorMessage):
             route_msg = RouteDirect(join_error, message.joining_node)
             self.__local_node.route_internal(route_msg)
 
+    def visit_STJoinData(self, message):
+        # runs in the joining node, for every chunk of the handoff.
+        ln = self.__local_node
+        proposal = self.__proposal
+        if(proposal == None or proposal.uid != message.transfer):
+            LOGGER.debug("[DBG] dropping %s: no such transfer"%repr(message))
+            return
+
+        if(self.__staging != None and message.seq == self.__staging_next):
+            for space_part, data in message.items():
+                self.__staging.add(space_part, data)
+            self.__staging_next += 1
+
+        ack = STJoinDataAck(ln, message.transfer, self.__staging_next - 1)
+        ln.route_internal(RouteDirect(ack, message.contact_node))
+
+        if(message.last and message.seq < self.__staging_next):
+            if(self.__staging != None):
+                print("0_0 adding data in the local store ...")
+                self.__accept_proposal(self.__staging.items())
+            else:
+                # our acceptance may have been lost with the connection.
+                ln.route_internal(RouteDirect(self.__join_msg, message.contact_node))
+
+    def visit_STJoinDataAck(self, message):
+        # runs in the welcoming node.
+        if(self.__handoff == None or self.__handoff.transfer != message.transfer):
+            LOGGER.debug("[DBG] dropping %s: no such transfer"%repr(message))
+            return
+        self.__handoff.acknowledge(message.seq)
+
+    def __accept_proposal(self, data):
+        """Set the CPE and data received from the contact node, then accept."""
+        ln = self.__local_node
+        message = self.__proposal
+        ln.sign("inserting into local store")
+        ln.partition_id = message.partition_id
+        ln.cpe = message.cpe
+        for space_part, data_item in data:
+            ln.data_store.add(space_part, data_item)
+        self.__staging = None
+
+        # Send a reply to the contact node.
+        self.__join_msg = STJoinRequest(ln, STJoinRequest.STATE_ACCEPT)
+        ln.sign("accepting proposition")
+        route_msg = RouteDirect(self.__join_msg, message.contact_node)
+        ln.route_internal(route_msg)
+
+    def __handoff_failed(self, handoff):
+        """Give up a join whose data couldn't be handed over."""
+        print("0_0 join aborted: %s"%repr(handoff))
+        join_error = STJoinError(self.__join_msg, "Data handoff failed")
+        self.__local_node.route_internal(RouteDirect(join_error, handoff.joining_node))
+        self.__reset_join_state()
+
     def visit_STJoinError(self, message):
         self.__reset_join_state()
         raise JoinException(message.reason)
@@ -633,8 +986,8 @@ class JoinProcessor(VisitorMessage):
         psr = ln.name_id.get_longest_prefix_length(node_right.name_id)
         # Launch the SkipTree joining.
         payload_msg = STJoinRequest(ln, STJoinRequest.STATE_ASK)
-        payload_msg.sign("%s joint SN. Candidates for ST are %s:%f or %s:%f"%(
-            ln.name_id, node_left.name_id, psl, node_right.name_id, psr))
+        payload_msg.sign("%s joint SN. Candidates for ST are %s:%f or %s:%f",
+                         ln.name_id, node_left.name_id, psl, node_right.name_id, psr)
 
         # decide which neighbour we will join.
         print("0_0 %s@%f -vs- %s@%f"%(node_left, psl, node_right, psr));
@@ -644,7 +997,7 @@ class JoinProcessor(VisitorMessage):
         elif(psl < psr and not ng.can_wrap(Direction.RIGHT)):
             contact_node = node_right
         ln.sign("joint the skipnet")
-        payload_msg.sign("prefered %s"%contact_node.name_id)
+        payload_msg.sign("prefered %s", contact_node.name_id)
         print("0_0 joining the skiptree : %s->%s",ln.name_id, contact_node.name_id)
         route_msg = RouteDirect(payload_msg, contact_node)
         ln.route_internal(route_msg)
@@ -703,10 +1056,8 @@ class NeighbourhoodNet(object):
             side = ring.get_side(direction)
             NeighbourhoodNet.ping_half_ring(node, side, ring_level)
 
-    # TODO : the same node may be present in many rings, and we don't need it
-    #   to be ping'd so many times. 
-    #   the .NET code of skipnet simulator seems to ping the *leafset* rather
-    #   than individual rings. We may want to add that layer of bookkeeping.
+    # the same node may be present in many rings: heartbeats go through
+    #   ping_leafset() instead, as the .NET code of skipnet simulator does.
     @staticmethod
     def ping_half_ring(node, half_ring, ring_level):
         """Send ping to all neighbours (telling them this node is alive)."""
@@ -718,3 +1069,16 @@ class NeighbourhoodNet(object):
             route_msg = RouteDirect(payload_msg, neighbour)
             node.route_internal(route_msg)
 
+    @staticmethod
+    def ping_leafset(node, neighbourhood):
+        """Send a single ping to each unique neighbour, listing every ring it
+        shares with this node (telling it this node is alive). Return the
+        number of pings sent."""
+        leafset = neighbourhood.get_leafset()
+        for neighbour, levels in leafset:
+            LOGGER.debug("[DBG] Send a Ping to: %r @%r", neighbour, levels)
+            payload_msg = SNPingMessage(node, levels[-1], levels)
+            route_msg = RouteDirect(payload_msg, neighbour)
+            node.route_internal(route_msg)
+        return len(leafset)
+
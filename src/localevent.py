@@ -4,14 +4,18 @@
 
 
 # System imports
+import asyncio
+import collections
+import concurrent.futures
 import copy
 import logging
-import queue
-import sys
+import threading
+import time
 import pdb
 
 # ResumeNet imports
-from join import JoinProcessor
+from logpipe import LogPipe
+from join import JoinProcessor, STJoinRequest, STJoinData
 from messages import VisitorRoute, VisitorMessage # APIs for handling messages
 from messages import RouteByNameID, RouteDirect
 #from messages import SNJoinRequest, SNJoinReply, SNLeaveReply
@@ -19,17 +23,17 @@ from messages import SNPingMessage, SNPingRequest
 #from messages import STJoinReply, STJoinRequest, STJoinError, JoinException
 from messages import IdentityReply
 #from messages import NeighbourhoodNet
-from messages import LookupRequest, LookupReply
+from messages import LookupRequest, LookupReply, InsertionRequest, BatchInsertionRequest
 
 from routing import Router, RouterReflect, RoutingDeferred
+from metrics import LatencyMetrics, STAGE_QUEUE, STAGE_ROUTE, STAGE_PROCESS
 from nodeid import NodeID, PartitionID
 from util import Direction
 
 # ---------------------------------------------------------------------------
 
 # Module log abilities
-LOG_HANDLER = logging.StreamHandler()
-LOG_HANDLER.setLevel(logging.DEBUG)
+LOG_HANDLER = LogPipe.shared().handler
 
 LOGGER = logging.getLogger("localevent")
 LOGGER.setLevel(logging.DEBUG)
@@ -38,6 +42,28 @@ LOGGER.addHandler(LOG_HANDLER)
 
 
 
+# ---------------------------------------------------------------------------
+
+"""How the application messages delivered to the local node are processed
+when the dispatcher has workers:
+- ORDER_INLINE: on the dispatcher loop, in order with routing;
+- ORDER_NONE: by any worker, concurrently with anything else;
+- ORDER_FIFO: by a worker, one message of the class at a time, in the
+  order they were dispatched;
+- ORDER_EXCLUSIVE: on the dispatcher loop, once the ORDER_FIFO messages
+  dispatched before it are processed; those dispatched after it wait."""
+ORDER_INLINE, ORDER_NONE, ORDER_FIFO, ORDER_EXCLUSIVE = range(4)
+
+"""Processing order of each message class (ORDER_INLINE if not listed)."""
+PROCESSING_ORDER = {
+    LookupRequest: ORDER_NONE,      # only reads the DataStore.
+    LookupReply: ORDER_FIFO,        # results are reported as they came.
+    InsertionRequest: ORDER_FIFO,   # the DataStore keeps the insertion order.
+    BatchInsertionRequest: ORDER_FIFO,
+    STJoinRequest: ORDER_EXCLUSIVE, # splits the DataStore the inserts write to.
+    STJoinData: ORDER_EXCLUSIVE,
+    }
+
 # ---------------------------------------------------------------------------
 # lnode.dispatcher._MessageDispatcher__visitor_routing.debugging=31
 # lnode.dispatcher._MessageDispatcher__visitor_processing._ProcessorVisitor__join_processor.debugging=True
@@ -46,23 +72,142 @@ LOGGER.addHandler(LOG_HANDLER)
 
 class MessageDispatcher(object):
     """Dispatch messages through components of the application.
-    this is typically the .dispatcher of your Node object."""
+    this is typically the .dispatcher of your Node object.
+
+    The dispatcher owns the event loop of the node: incoming connections
+    (network::InRequestManager) and outgoing ones (network::OutRequestManager)
+    are served on the very loop that consumes the message queue, so a
+    received message is processed without crossing any thread boundary.
+
+    Messages wait in a MessageScheduler: unless put() is told otherwise,
+    control messages get PRIO_MAX, bulk messages PRIO_MIN and the others
+    PRIO_DEFAULT.
+
+    With 'workers' threads, the application messages delivered to the local
+    node are processed by them, as PROCESSING_ORDER tells, while routing goes
+    on on the loop: a large DataStore scan no longer holds every other
+    message back.
+
+    Messages received from the network go through admit(): once HIGH_WATER
+    messages are queued, the flow listeners (see add_flow_listener) stop
+    reading from their sockets, so that TCP flow control pushes back on the
+    senders, until the queue is down to LOW_WATER. Beyond CAPACITY, the
+    application and bulk messages that still come in are refused."""
 
     PRIO_MAX, PRIO_DEFAULT, PRIO_MIN = range(0, 30000, 10000)
 
-    def __init__(self, local_node):
+    """Queue length at which the network stops reading."""
+    HIGH_WATER = 2048
+
+    """Queue length at which the network reads again."""
+    LOW_WATER = 512
+
+    """Queue length beyond which application messages from the network are refused."""
+    CAPACITY = 8192
+
+    """Messages dispatched in a row before the loop serves its sockets and
+    callbacks (reads, timers, worker completions, put() from other threads)."""
+    YIELD_EVERY = 16
+
+    def __init__(self, local_node, workers=0):
         # Data
-        self.__queue = queue.Queue()
+        self.__loop = asyncio.new_event_loop()
+        self.__loop_thread = None
+        self.__queue = MessageScheduler()
+        self.__ready = asyncio.Event()
         self.__local_node = local_node
 
         # Handlers
         self.__visitor_routing = RouterVisitor(local_node)
         self.__visitor_processing = ProcessorVisitor(local_node)
 
+        # Workers
+        self.__workers = None
+        if (workers > 0):
+            self.__workers = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="worker")
+        self.__lanes = {}   # class -> deque of messages, the first one running
+        self.__held = collections.deque()   # messages waiting for an ORDER_EXCLUSIVE one
+
+        # Admission control
+        self.__flow_listeners = []
+        self.__paused_since = None
+        self.admitted = 0
+        self.rejected = 0
+        self.pauses = 0
+        self.paused_time = 0.0
 
-    def put(self, event, priority=PRIO_DEFAULT):
-        """Add an event in the dispatcher."""
-        self.__queue.put(event)
+    #
+    # Properties
+
+    @property
+    def loop(self):
+        """Return the event loop messages are dispatched on."""
+        return self.__loop
+
+    def put(self, event, priority=None):
+        """Add an event in the dispatcher (from any thread). By default, the
+        priority depends on whether the event is a control message."""
+        if (priority == None):
+            priority = self.__priority(event)
+        if (threading.get_ident() == self.__loop_thread):
+            self.__enqueue(event, priority)
+        else:
+            self.__loop.call_soon_threadsafe(self.__enqueue, event, priority)
+
+    def __priority(self, event):
+        if (event.control):
+            return self.PRIO_MAX
+        return self.PRIO_MIN if event.bulk else self.PRIO_DEFAULT
+
+    def __enqueue(self, event, priority):
+        self.__queue.put(event, priority)
+        self.__ready.set()
+
+    def add_flow_listener(self, listener):
+        """Register an object whose pause_reading() and resume_reading() are
+        called when the queue crosses HIGH_WATER and LOW_WATER."""
+        self.__flow_listeners.append(listener)
+
+    def admit(self, event):
+        """Queue a message received from the network (on the loop). Return
+        False if it was refused because the queue is full."""
+        if (len(self.__queue) >= self.CAPACITY and not event.control):
+            self.rejected += 1
+            return False
+        self.admitted += 1
+        self.__enqueue(event, self.__priority(event))
+        if (self.__paused_since == None and len(self.__queue) >= self.HIGH_WATER):
+            LOGGER.warning("%i messages queued: pausing the network" % len(self.__queue))
+            self.__paused_since = time.time()
+            self.pauses += 1
+            for listener in self.__flow_listeners:
+                listener.pause_reading()
+        return True
+
+    def __resume_reading(self):
+        self.paused_time += time.time() - self.__paused_since
+        self.__paused_since = None
+        for listener in self.__flow_listeners:
+            listener.resume_reading()
+
+    def admission_stats(self):
+        """Return the admission counters: messages admitted and refused, the
+        number of times the network was paused, and for how long overall."""
+        paused_time = self.paused_time
+        if (self.__paused_since != None):
+            paused_time += time.time() - self.__paused_since
+        return {
+            "depth": len(self.__queue),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "pauses": self.pauses,
+            "paused_time": paused_time,
+            }
+
+    def queue_stats(self):
+        """Return the depth and wait times of each priority class (see MessageScheduler.stats)."""
+        return self.__queue.stats()
 
     def get_destinations(self, message):
         destinations = message.accept(self.__visitor_routing)
@@ -78,8 +223,8 @@ class MessageDispatcher(object):
     def flush2log(self, reason):
         LOGGER.log(logging.WARNING,
                    "flushing %i items of work queue: %s"% (
-                       self.__queue.qsize(),reason))
-        while(self.__queue.qsize()>0):
+                       len(self.__queue),reason))
+        while(len(self.__queue)>0):
             message = self.__queue.get()
             LOGGER.debug(">> %s"%repr(message))
         
@@ -92,15 +237,14 @@ class MessageDispatcher(object):
         
         if destinations != None and len(destinations)>0:
             for next_hop, message in destinations:
-                message.sign("@%s: %i destinations"%(
-                    self.__local_node.partition_id,len(destinations)))
+                message.sign("@%s: %i destinations",
+                             self.__local_node.partition_id, len(destinations))
                 if(next_hop != None):
                     if(next_hop.net_info == self.__local_node.net_info):
-                        hastrace = ('trace' in dir(msgcause))
-                        if not 'trace' in dir(message.payload):
-                            message.payload.trace = msgcause.trace if hastrace else ["no trace"]
+                        if not hasattr(message.payload, 'trace'):
+                            message.payload.trace = getattr(msgcause, 'trace', None)
                             # most messages has no trace, btw.
-                        message.payload.accept(self.__visitor_processing)
+                        self.__process(message.payload)
                     else:
                         self.__local_node.sender.send_msg(message, next_hop)
                 else:
@@ -109,24 +253,207 @@ class MessageDispatcher(object):
                     LOGGER.log(logging.WARNING, "message has been dropped")
         else:
             report = "no destination for %s in %s --tr: %s --at %s" % (
-                repr(msgcause), repr(self.__visitor_routing), repr(msgcause.trace),self.__local_node)
+                repr(msgcause), repr(self.__visitor_routing),
+                repr(getattr(msgcause, 'trace', None)), self.__local_node)
             LOGGER.log(logging.DEBUG,
                        "[DBG:%s] %s"%(self.__local_node.name_id,report))
             if 'routingError' in dir(msgcause.payload):
                 msgcause.payload.routingError(ValueError(report))
         
 
-    def dispatch(self):
+    def __process(self, payload):
+        """Hand a message delivered to the local node to the 'processing' visitor."""
+        order = PROCESSING_ORDER.get(payload.__class__, ORDER_INLINE)
+        if (self.__workers == None or order == ORDER_INLINE):
+            self.__accept(payload)
+        elif (order == ORDER_NONE):
+            self.__run(payload, None)
+        elif (len(self.__held) > 0 or (order == ORDER_EXCLUSIVE and self.__fifo_busy())):
+            # the FIFO messages dispatched before the ORDER_EXCLUSIVE one
+            #   complete first, those dispatched after it wait for it.
+            self.__held.append(payload)
+        elif (order == ORDER_EXCLUSIVE):
+            self.__accept(payload)
+        else:
+            self.__enqueue_fifo(payload)
+
+    def __enqueue_fifo(self, payload):
+        lane = self.__lanes.setdefault(payload.__class__, collections.deque())
+        lane.append(payload)
+        if (len(lane) == 1):
+            self.__run(payload, lane)
+
+    def __fifo_busy(self):
+        return any(len(lane) > 0 for lane in self.__lanes.values())
+
+    def __run(self, payload, lane):
+        future = self.__workers.submit(self.__accept, payload)
+        future.add_done_callback(
+            lambda done: self.__loop.call_soon_threadsafe(self.__processed, done, payload, lane))
+
+    def __accept(self, payload):
+        started = time.perf_counter()
+        try:
+            return payload.accept(self.__visitor_processing)
+        finally:
+            LatencyMetrics.shared().record_since(STAGE_PROCESS, payload, started)
+
+    def __processed(self, future, payload, lane):
+        """Called on the loop once a worker processed 'payload'."""
+        if (future.exception() != None):
+            LOGGER.error(">_< processing %s failed: %s" % (repr(payload), future.exception()))
+        if (lane != None):
+            lane.popleft()
+            if (len(lane) > 0):
+                self.__run(lane[0], lane)
+            elif (len(self.__held) > 0 and not self.__fifo_busy()):
+                self.__release()
+
+    def __release(self):
+        """Process the held messages in order, up to the next ORDER_EXCLUSIVE
+        one that still has FIFO messages to wait for."""
+        while (len(self.__held) > 0):
+            payload = self.__held[0]
+            if (PROCESSING_ORDER.get(payload.__class__) != ORDER_EXCLUSIVE):
+                self.__held.popleft()
+                self.__enqueue_fifo(payload)
+            elif (self.__fifo_busy()):
+                return
+            else:
+                try:
+                    self.__accept(payload)
+                except Exception as e:
+                    LOGGER.error(">_< processing %s failed: %s" % (repr(payload), e))
+                self.__held.popleft()
+
+    def dispatch(self, *services):
+        """Run the event loop and dispatch the messages through components.
+        'services' are coroutines to complete first (e.g. binding the listening
+        socket), their transports then live on the loop along with the queue."""
+        asyncio.set_event_loop(self.__loop)
+        self.__loop_thread = threading.get_ident()
+        for service in services:
+            self.__loop.run_until_complete(service)
+        self.__loop.run_until_complete(self.__consume())
+
+    async def __consume(self):
         """Dispatch the messages through components."""
         #TODO: Change exception management, local_node comparison  
+        in_a_row = 0
         while True:
             message = self.__queue.get()
+            if (message == None):
+                in_a_row = 0
+                self.__ready.clear()
+                await self.__ready.wait()
+                continue
+            if (self.__paused_since != None and len(self.__queue) <= self.LOW_WATER):
+                self.__resume_reading()
             try:
-                self.dispatch_one(message,self.get_destinations(message))
-                sys.stdout.flush()
+                started = time.perf_counter()
+                destinations = self.get_destinations(message)
+                LatencyMetrics.shared().record_since(STAGE_ROUTE, message, started)
+                self.dispatch_one(message, destinations)
             except RoutingDeferred as rd:
                 LOGGER.debug("routing of %s got deferred at %s"%(repr(message),rd.where))
-            self.__queue.task_done()
+            except Exception as e:
+                # one bad message (e.g. from a buggy peer) mustn't stop the
+                #   loop, and the whole networking of the node with it.
+                LOGGER.error(">_< dispatching %s failed: %s" % (repr(message), e), exc_info=True)
+            # with OVERFLOW_BLOCK, a full outgoing queue holds the next message back.
+            await self.__local_node.sender.drained()
+            in_a_row += 1
+            if (in_a_row >= self.YIELD_EVERY):
+                # a backlog mustn't keep the network (and the control messages
+                #   it brings) waiting until it is drained.
+                in_a_row = 0
+                await asyncio.sleep(0)
+
+
+class MessageScheduler(object):
+    """Queues of messages waiting for the dispatcher, one per priority class.
+
+    get() serves the classes by weighted round robin: in every round, each
+    class may hand out as many messages as its weight, the classes with the
+    best (lowest) priority first. Control messages are thus dispatched ahead
+    of a flood of lookups, which still get their share of every round.
+    """
+
+    """Weight of each priority class, by priority."""
+    WEIGHTS = {MessageDispatcher.PRIO_MAX: 8,
+               MessageDispatcher.PRIO_DEFAULT: 2,
+               MessageDispatcher.PRIO_MIN: 1}
+
+    """Names of the priority classes, as reported."""
+    NAMES = {MessageDispatcher.PRIO_MAX: "ctrl",
+             MessageDispatcher.PRIO_DEFAULT: "app",
+             MessageDispatcher.PRIO_MIN: "bulk"}
+
+    def __init__(self, weights=WEIGHTS):
+        self.__priorities = sorted(weights.keys())
+        self.__weights = dict(weights)
+        self.__credits = dict(weights)
+        self.__queues = dict((prio, collections.deque()) for prio in self.__priorities)
+        self.__length = 0
+
+        # Metrics
+        self.__served = dict.fromkeys(self.__priorities, 0)
+        self.__waited = dict.fromkeys(self.__priorities, 0.0)
+        self.__max_wait = dict.fromkeys(self.__priorities, 0.0)
+
+    def __len__(self):
+        return self.__length
+
+    def put(self, event, priority):
+        """Queue 'event' in the class 'priority' (the nearest lower one if
+        there is no such class)."""
+        for prio in reversed(self.__priorities):
+            if (prio <= priority):
+                break
+        self.__queues[prio].append((time.time(), event))
+        self.__length += 1
+
+    def get(self):
+        """Return the next event to dispatch (None if there isn't any)."""
+        if (self.__length == 0):
+            return None
+        prio = self.__next_class()
+        if (prio == None):
+            # every waiting class spent its credits: start a new round.
+            self.__credits.update(self.__weights)
+            prio = self.__next_class()
+        self.__credits[prio] -= 1
+        queued, event = self.__queues[prio].popleft()
+        self.__length -= 1
+
+        wait = time.time() - queued
+        LatencyMetrics.shared().record(STAGE_QUEUE, event.__class__.__name__, wait)
+        self.__served[prio] += 1
+        self.__waited[prio] += wait
+        if (wait > self.__max_wait[prio]):
+            self.__max_wait[prio] = wait
+        return event
+
+    def __next_class(self):
+        for prio in self.__priorities:
+            if (self.__queues[prio] and self.__credits[prio] > 0):
+                return prio
+        return None
+
+    def stats(self):
+        """Return, for each class name, its depth, the number of messages
+        served, and their mean and max wait in seconds."""
+        report = {}
+        for prio in self.__priorities:
+            served = self.__served[prio]
+            report[self.NAMES.get(prio, str(prio))] = {
+                "depth": len(self.__queues[prio]),
+                "served": served,
+                "mean_wait": self.__waited[prio] / served if served > 0 else 0.0,
+                "max_wait": self.__max_wait[prio],
+                }
+        return report
+
 
 # Visitor Message is handling the application-level processing,
 # while the RouterVisitor handles the network-level message.
@@ -137,21 +464,31 @@ class DatastoreProcessor(object):
 
     def insertData(self, message):
         """ expect message ISA InsertionRequest """
-        print(message," has reached ",self.__local_node)
+        LOGGER.debug("%s has reached %s", message, self.__local_node.name_id)
         if (self.debugging):
             import pdb; pdb.set_trace()
         ### XXX test the message.key matches by local CPEs.
         self.__local_node.data_store.add(message.key, message.data)
 
+    def insertBatch(self, message):
+        """ expect message ISA BatchInsertionRequest """
+        LOGGER.debug("%s has reached %s", message, self.__local_node.name_id)
+        if (self.debugging):
+            import pdb; pdb.set_trace()
+        store = self.__local_node.data_store
+        for key, data in message.items():
+            store.add(key, data)
+
     def lookupData(self, message):
         """ expect message ISA LookupRequest """
-        print(message," has reached ",self.__local_node)
+        LOGGER.debug("%s has reached %s", message, self.__local_node.name_id)
         if (self.debugging):
             import pdb; pdb.set_trace()
         values = self.__local_node.data_store.get(message.key)
         reply = LookupReply(values, message.nonce)
-        reply.trace = message.trace
-        reply.trace.append("reading data at %s"%self.__local_node.pname)
+        reply.trace = getattr(message, 'trace', None)
+        if (reply.trace != None):
+            reply.trace.add("reading data at %s", self.__local_node.pname)
         route = RouteDirect(reply, message.originator)
         self.__local_node.route_internal(route)
 
@@ -213,6 +550,14 @@ class RouterVisitor(VisitorRoute):
             return self.__reflector.by_cpe_get_next_hop_forking(self.__local_node, message)
         # MessageDispatcher.dispatch() will be happy with a list of <neighbour, message>
 
+    def visit_RoutePointsByCPE(self, message):
+        # message ISA RoutePointsByCPE
+        # payload ISA BatchInsertionRequest
+        if (self.debugging&16):
+            import pdb; pdb.set_trace()
+        hops = self.__reflector.by_cpe_route_points(self.__local_node, message.payload.points)
+        return [(hop, message.subset(batch.indices)) for hop, batch in hops]
+
     def __repr__(self):
         return "<RouterVisitor:"+repr(self.__reflector.trace)+">"
     @property
@@ -241,6 +586,9 @@ class ProcessorVisitor(VisitorMessage):
     def visit_InsertData(self, message):
         self.__data_processor.insertData(message)
 
+    def visit_InsertBatch(self, message):
+        self.__data_processor.insertBatch(message)
+
     def visit_LookupData(self, message):
         self.__data_processor.lookupData(message)
 
@@ -268,6 +616,12 @@ class ProcessorVisitor(VisitorMessage):
         if (message.successful):
             print("#_# CONNECTED")
 
+    def visit_STJoinData(self, message):
+        self.__join_processor.visit_STJoinData(message)
+
+    def visit_STJoinDataAck(self, message):
+        self.__join_processor.visit_STJoinDataAck(message)
+
     def visit_STJoinError(self, message):
         self.__join_processor.visit_STJoinError(message)
 
@@ -299,12 +653,17 @@ class ProcessorVisitor(VisitorMessage):
     def visit_SNPingMessage(self, message):
         # The source node common bit must be less or equal (because of neighbours selection).
         common_bit = self.__local_node.numeric_id.get_longest_prefix_length(message.src_node.numeric_id)
-        assert message.ring_level <= common_bit
+        levels = message.ring_levels
+        if (not all(level.__class__ is int and 0 <= level <= common_bit for level in levels)):
+            LOGGER.warning(">_< %s rejected: rings %r beyond the %i bits shared with %s"%(
+                repr(message), levels, common_bit, repr(message.src_node.name_id)))
+            return
         lng = self.__local_node.neighbourhood
-        lng.sign("%s @%i"%(
-            repr(message),message.ring_level))
-        # Add the new neighbour.
-        ngh = lng.add_neighbour(message.ring_level, message.src_node)
+        lng.sign("%s @%s"%(
+            repr(message),",".join(str(level) for level in levels)))
+        # Add the new neighbour, in every ring it asks for at once.
+        for level in levels:
+            lng.add_neighbour(level, message.src_node)
         
     #
     # Dispatching "Application" messages.
@@ -0,0 +1,317 @@
+"""
+Logging and console output that never block the node.
+
+Records logged by any module go to a bounded in-memory queue that a
+background thread writes out to stderr. Below WARNING, each logger is
+rate-limited (a token bucket per logger name), and records that find the
+queue full are dropped and counted rather than waited for.
+
+Once installed, the ConsoleWriter does the same for stdout: print() only
+queues the lines, and the MCP reads them as fast as it can without the
+dispatcher waiting for room in the stdout pipe, except for the protocol
+lines the MCP can't do without.
+"""
+
+# System imports
+import atexit
+import collections
+import copy
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+# ResumeNet imports
+
+# ------------------------------------------------------------------------------------------------
+
+
+class RateLimiter(logging.Filter):
+    """RateLimiter lets through at most 'rate' records per second of a given
+    logger, with bursts of 'burst' records. WARNING and above always pass."""
+
+    def __init__(self, rate, burst):
+        logging.Filter.__init__(self)
+        self.__default = (rate, burst)
+        self.__limits = {}      # logger name -> (rate, burst)
+        self.__buckets = {}     # logger name -> [tokens, last refill]
+        self.__suppressed = collections.Counter()
+        self.__lock = threading.Lock()
+
+    def limit(self, name, rate, burst=None):
+        """Set the rate limit of the logger 'name' (None: no limit)."""
+        with self.__lock:
+            if (rate == None):
+                self.__limits[name] = None
+            else:
+                self.__limits[name] = (rate, burst if burst != None else rate)
+            self.__buckets.pop(name, None)
+
+    def filter(self, record):
+        if (record.levelno >= logging.WARNING):
+            return True
+        name = record.name
+        with self.__lock:
+            limit = self.__limits.get(name, self.__default)
+            if (limit == None):
+                return True
+            rate, burst = limit
+            now = record.created
+            bucket = self.__buckets.get(name)
+            if (bucket == None):
+                bucket = self.__buckets[name] = [burst, now]
+            else:
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if (bucket[0] < 1):
+                self.__suppressed[name] += 1
+                return False
+            bucket[0] -= 1
+            return True
+
+    #
+    # Properties
+
+    @property
+    def suppressed(self):
+        """Return the number of records suppressed, per logger name."""
+        with self.__lock:
+            return dict(self.__suppressed)
+
+
+class PipeHandler(logging.handlers.QueueHandler):
+    """PipeHandler queues records for the writer thread, dropping those
+    that find the queue full.
+
+    The message of a record is merged with its arguments before it is
+    queued, while the objects it shows are in the state it was logged in;
+    the rest of the formatting (time, level, traceback) is left to the
+    writer thread, unlike QueueHandler.prepare() which does it all."""
+
+    def __init__(self, records):
+        logging.handlers.QueueHandler.__init__(self, records)
+        self.dropped = 0
+
+    def emit(self, record):
+        # test first: a record that can't be queued isn't worth formatting.
+        if (self.queue.full()):
+            self.dropped += 1
+            return
+        try:
+            snapshot = copy.copy(record)
+            snapshot.msg = record.getMessage()
+            snapshot.args = None
+            self.queue.put_nowait(snapshot)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class ConsoleWriter(object):
+    """ConsoleWriter stands for sys.stdout: the text written by each thread
+    is gathered into lines, those are queued and a background thread copies
+    them to the real stream, flushing whenever it caught up. A line that
+    finds the queue full is dropped and counted: writing never waits. The
+    lines the MCP reads (see PROTOCOL) may still use RESERVE more places,
+    so that they are only lost once the console lags far behind."""
+
+    """Most lines waiting for the console."""
+    CAPACITY = 16384
+
+    """Places kept for the protocol lines beyond CAPACITY."""
+    RESERVE = 1024
+
+    """Prefixes of the lines the MCP parses: they are never dropped."""
+    PROTOCOL = ("0_0", "#_#", "!_!", ">_<")
+
+    def __init__(self, stream, capacity=CAPACITY, reserve=RESERVE):
+        self.__stream = stream
+        self.__capacity = capacity
+        self.__texts = queue.Queue(capacity + reserve)
+        self.__pending = threading.local()  # .text: the line being written
+        self.__written = 0
+        self.__dropped = 0
+        self.__protocol_dropped = 0
+        self.__thread = threading.Thread(target=self.__drain, name="console")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def write(self, text):
+        pending = getattr(self.__pending, "text", "") + text
+        end = pending.rfind("\n") + 1
+        if (end > 0):
+            for line in pending[:end - 1].split("\n"):
+                self.__put(line + "\n")
+            pending = pending[end:]
+        self.__pending.text = pending
+        return len(text)
+
+    def __put(self, line):
+        protocol = line.startswith(self.PROTOCOL)
+        if (not protocol and self.__texts.qsize() >= self.__capacity):
+            self.__dropped += 1
+            return
+        try:
+            self.__texts.put_nowait(line)
+        except queue.Full:
+            self.__dropped += 1
+            if (protocol):
+                self.__protocol_dropped += 1
+
+    def flush(self):
+        """Queue the unfinished line of the calling thread (e.g. a prompt);
+        the writer thread flushes as soon as it has caught up."""
+        pending = getattr(self.__pending, "text", "")
+        if (len(pending) > 0):
+            self.__pending.text = ""
+            self.__put(pending)
+
+    def close(self, timeout=1.0):
+        """Write what is still queued and stop the writer thread."""
+        self.flush()
+        if (self.__thread.is_alive()):
+            try:
+                self.__texts.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self.__thread.join(timeout)
+
+    def __drain(self):
+        texts = self.__texts
+        while True:
+            chunk = [texts.get()]
+            try:
+                while (chunk[-1] != None):
+                    chunk.append(texts.get_nowait())
+            except queue.Empty:
+                pass
+            stop = (chunk[-1] == None)
+            if stop:
+                chunk.pop()
+            try:
+                self.__stream.write("".join(chunk))
+                self.__stream.flush()
+            except (OSError, ValueError):
+                pass # nobody is listening anymore.
+            self.__written += len(chunk)
+            if stop:
+                return
+
+    def __getattr__(self, name):
+        # fileno(), encoding, isatty() ... are those of the real stream.
+        return getattr(self.__stream, name)
+
+    #
+    # Properties
+
+    @property
+    def stream(self):
+        """Return the stream written to."""
+        return self.__stream
+
+    @property
+    def depth(self):
+        """Return the number of lines waiting for the console."""
+        return self.__texts.qsize()
+
+    @property
+    def written(self):
+        """Return the number of lines copied to the console."""
+        return self.__written
+
+    @property
+    def dropped(self):
+        """Return the number of lines dropped because the console lagged."""
+        return self.__dropped
+
+    @property
+    def protocol_dropped(self):
+        """Return the number of protocol lines among the dropped ones."""
+        return self.__protocol_dropped
+
+
+class LogPipe(object):
+    """LogPipe connects the loggers of the node to a background writer."""
+
+    """Most records waiting for the writer thread."""
+    CAPACITY = 8192
+
+    """Default rate limit of a logger, in records per second, and burst."""
+    RATE = 200
+    BURST = 1000
+
+    __shared = None
+
+    def __init__(self, stream=None, capacity=CAPACITY, rate=RATE, burst=BURST):
+        self.__records = queue.Queue(capacity)
+        self.__limiter = RateLimiter(rate, burst)
+        self.__handler = PipeHandler(self.__records)
+        self.__handler.setLevel(logging.DEBUG)
+        self.__handler.addFilter(self.__limiter)
+        self.__output = logging.StreamHandler(stream)
+        self.__listener = logging.handlers.QueueListener(
+            self.__records, self.__output, respect_handler_level=True)
+        self.__listener.start()
+        self.__running = True
+        self.__console = None
+        atexit.register(self.stop)
+
+    @staticmethod
+    def shared():
+        """Return the pipe every module logs through."""
+        if (LogPipe.__shared == None):
+            LogPipe.__shared = LogPipe()
+        return LogPipe.__shared
+
+    def limit(self, name, rate, burst=None):
+        """Set the rate limit of the logger 'name' (None: no limit)."""
+        self.__limiter.limit(name, rate, burst)
+
+    def install_console(self):
+        """Make print() go through a ConsoleWriter."""
+        if (self.__console == None):
+            self.__console = ConsoleWriter(sys.stdout)
+            sys.stdout = self.__console
+        return self.__console
+
+    def stop(self):
+        """Write what is still queued (at exit)."""
+        if (self.__console != None):
+            self.__console.close()
+            if (sys.stdout is self.__console):
+                sys.stdout = self.__console.stream
+            self.__console = None
+        if (self.__running):
+            self.__running = False
+            try:
+                self.__listener.stop()
+            except queue.Full:
+                pass # the writer thread dies with the process.
+
+    def stats(self):
+        """Return the counters of the pipe."""
+        suppressed = self.__limiter.suppressed
+        stats = {
+            "depth": self.__records.qsize(),
+            "dropped": self.__handler.dropped,
+            "suppressed": sum(suppressed.values()),
+            "per_logger": suppressed,
+            "console_depth": 0,
+            "console_dropped": 0,
+            "console_protocol_dropped": 0,
+            }
+        if (self.__console != None):
+            stats["console_depth"] = self.__console.depth
+            stats["console_dropped"] = self.__console.dropped
+            stats["console_protocol_dropped"] = self.__console.protocol_dropped
+        return stats
+
+    #
+    # Properties
+
+    @property
+    def handler(self):
+        """Return the handler loggers should use."""
+        return self.__handler
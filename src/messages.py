@@ -9,17 +9,19 @@ import logging
 import copy
 
 # ResumeNet imports
+from logpipe import LogPipe
+from codec import WireCodec
 from equation import Range
-from equation import SpacePart
+from equation import SpacePart, Component, PointBatch
 import random
 from nodeid import NodeID
+from tracing import TraceLog
 from util import Direction
 
 # ------------------------------------------------------------------------------------------------
 
 # Module log abilities
-LOG_HANDLER = logging.StreamHandler()
-LOG_HANDLER.setLevel(logging.DEBUG)
+LOG_HANDLER = LogPipe.shared().handler
 
 LOGGER = logging.getLogger("messages")
 LOGGER.setLevel(logging.DEBUG)
@@ -69,6 +71,10 @@ class VisitorRoute(object):
     def visit_RouteByCPE(self, message):
         pass
 
+    # give a batch of points, and CPEs split it among the nodes they go to.
+    def visit_RoutePointsByCPE(self, message):
+        pass
+
 
 class VisitorMessage(object):
     """Interface that must be implement by a class that visit Message."""
@@ -100,6 +106,12 @@ class VisitorMessage(object):
     def visit_STJoinReply(self, message):
         pass
 
+    def visit_STJoinData(self, message):
+        pass
+
+    def visit_STJoinDataAck(self, message):
+        pass
+
     def visit_STJoinError(self, message):
         pass
 
@@ -116,6 +128,50 @@ class VisitorMessage(object):
 
 # ------------------------------------------------------------------------------------------------
 
+class WirePayload(object):
+    """The payload of a RouteMessage received from the network, still encoded.
+
+    Routing only reads the envelope, so intermediate hops forward the payload
+    as the bytes it came with; it is decoded by the node that processes it,
+    when RouteMessage.payload is first read there. The label (the repr of the
+    original payload) stands for it in logs and traces meanwhile.
+    """
+
+    def __init__(self, raw, label):
+        self.__raw = raw
+        self.__label = label
+
+    @property
+    def raw(self):
+        """Return the encoded payload (a codec frame)."""
+        return self.__raw
+
+    @property
+    def control(self):
+        """Return True if the encoded message is a control message."""
+        cls = WireCodec.shared().message_class(self.__raw)
+        return cls != None and issubclass(cls, Message) and cls.control
+
+    @property
+    def datagram(self):
+        """Return True if the encoded message may travel as a datagram."""
+        cls = WireCodec.shared().message_class(self.__raw)
+        return cls != None and issubclass(cls, Message) and cls.datagram
+
+    @property
+    def bulk(self):
+        """Return True if the encoded message is a bulk message."""
+        cls = WireCodec.shared().message_class(self.__raw)
+        return cls != None and issubclass(cls, Message) and cls.bulk
+
+    def decode(self):
+        """Return the payload message."""
+        return WireCodec.shared().decode(self.__raw)
+
+    def __repr__(self):
+        return self.__label
+
+
 class RouteMessage(Visitee):
     """RouteMessage wraps a message to be routed."""
 
@@ -124,9 +180,15 @@ class RouteMessage(Visitee):
         self.__payload = payload
         self.__ttl = 16
 
-    def sign(self,line):
+    def sign(self, fmt, *args):
         pass
 
+    @property
+    def traced(self):
+        """Return True if signing the message is worth computing costly
+        arguments (e.g. Node.pname) for."""
+        return False
+
     @property
     def ttl(self):
         return self.__ttl
@@ -138,8 +200,38 @@ class RouteMessage(Visitee):
     @property
     def payload(self):
         """Return the payload wrapped by the RouteMessage."""
+        if (self.__payload.__class__ is WirePayload):
+            self.__payload = self.__payload.decode()
+        return self.__payload
+
+    @property
+    def wire_payload(self):
+        """Return the payload without decoding it: either the message or a
+        WirePayload if it was received from the network and not read yet."""
         return self.__payload
 
+    @property
+    def control(self):
+        """Return True if the message maintains the overlay (see Message.control).
+        A payload received from the network is not decoded to tell."""
+        payload = self.__payload
+        if (payload is self):
+            return isinstance(self, CtrlMessage)
+        return payload.control
+
+    @property
+    def bulk(self):
+        """Return True if the payload is a bulk message (see Message.bulk)."""
+        payload = self.__payload
+        return payload is not self and isinstance(payload, (Message, WirePayload)) and payload.bulk
+
+    @property
+    def datagram(self):
+        """Return True if the message may be sent as a datagram, that is to say
+        if its payload is a message that allows it (see Message.datagram)."""
+        payload = self.__payload
+        return payload is not self and isinstance(payload, (Message, WirePayload)) and payload.datagram
+
     def accept(self, visitor):
         return visitor.visit_RouteMessage(self)
 
@@ -154,7 +246,7 @@ class RouteDirect(RouteMessage):
         self.__dst_node = dst_node
 
     def __repr__(self):
-        return "<RDirect: %s to %s>"%(self.payload,self.__dst_node)
+        return "<RDirect: %s to %s>"%(self.wire_payload,self.__dst_node)
 
     @property
     def destination(self):
@@ -179,7 +271,7 @@ class RouteByNumericID(RouteMessage):
         self.__final_destination = False
 
     def __repr__(self):
-        return "<RNumeric: %s to %s>"%(self.payload,str(self.__dst_num_id))
+        return "<RNumeric: %s to %s>"%(self.wire_payload,str(self.__dst_num_id))
 
 
     @property
@@ -240,7 +332,7 @@ class RouteByNameID(RouteMessage):
         self.__dst_name_id = name_id
 
     def __repr__(self):
-        return "<RNameID: %s to %s>"%(self.payload,self.__dst_name_id)
+        return "<RNameID: %s to %s>"%(self.wire_payload,self.__dst_name_id)
 
     @property
     def dest_name_id(self):
@@ -292,24 +384,35 @@ class RouteByCPE(RouteMessage):
         self.__space_part = copy.deepcopy(space_part)
         self.__limit = Range(None, None, False, False, False)
         self.__forking = False
-        self.__log = None
+        self.__log = TraceLog.sample()
 
     def __repr__(self):
-        return "<RCPE %s to %s>"%(repr(self.payload),repr(self.__space_part))
+        return "<RCPE %s to %s>"%(repr(self.wire_payload),repr(self.__space_part))
 
-    def sign(self, line):
-        LOGGER.debug("[DBG] %s %s"%(self,line))
+    def sign(self, fmt, *args):
+        """Record an event in the trace if the message is traced (and mirror
+        it to the debug log), 'fmt' % 'args' being formatted only if the
+        trace is ever read."""
         if (self.__log!=None):
-            self.__log.append(line)
+            self.__log.add(fmt, *args)
+            if (LOGGER.isEnabledFor(logging.DEBUG)):
+                LOGGER.debug("[DBG] %s %s", self, TraceLog.format(fmt, args))
+
+    @property
+    def traced(self):
+        return self.__log!=None
 
     @property
     def trace(self):
+        """Return the TraceLog of the message, None if it isn't traced."""
         return self.__log
 
     @trace.setter
     def trace(self,v):
-        if v:
-            self.__log=[]
+        if isinstance(v, TraceLog):
+            self.__log=v
+        elif v:
+            self.__log=TraceLog()
         else:
             self.__log=None
 
@@ -346,12 +449,49 @@ class RouteByCPE(RouteMessage):
             return None
 
 
+class RoutePointsByCPE(RouteMessage):
+    """RoutePointsByCPE carries a BatchInsertionRequest. Each hop orients all
+    its points at once and forwards a RoutePointsByCPE with the subset of them
+    that goes through each next hop."""
+
+    def __init__(self, payload):
+        RouteMessage.__init__(self, payload)
+
+    def __repr__(self):
+        return "<RPOINTS %s>"%repr(self.wire_payload)
+
+    def subset(self, indices):
+        """Return a RoutePointsByCPE with the points at 'indices' only."""
+        message = RoutePointsByCPE(self.payload.subset(indices))
+        for i in range(16 - self.ttl):
+            message.decttl()
+        return message
+
+    def accept(self, visitor):
+        # see localevent.py : RouterVisitor.visit_RoutePointsByCPE
+        if self.decttl()>0:
+            return visitor.visit_RoutePointsByCPE(self)
+        else:
+            return None
+
+
 # ------------------------------------------------------------------------------------------------
 
 
 class Message(Visitee):
     """Message represent all meaningful message of the network."""
 
+    """Small, idempotent messages may travel as datagrams (see network::DatagramChannel)."""
+    datagram = False
+
+    """Messages that maintain the overlay are dispatched before application
+    messages (see localevent::MessageScheduler)."""
+    control = False
+
+    """Bulk messages (large transfers) are dispatched after application
+    messages and refused like them when the queue is full."""
+    bulk = False
+
     def __init__(self):
         Visitee.__init__(self)
 
@@ -366,10 +506,11 @@ class AppMessage(Message):
 class CtrlMessage(Message):
     """CtrlMessage represents messages that create and maintain the overlay network."""
     nextuid=0
+    control = True
     
     def __init__(self):
         Message.__init__(self)
-        self.__log=[]
+        self.__log=TraceLog.sample()
         self.uid=CtrlMessage.nextuid
         CtrlMessage.nextuid+=1
 
@@ -377,18 +518,26 @@ class CtrlMessage(Message):
         """This function will be executed by each node that receive it."""
         pass
 
-    def sign(self, line):
+    def sign(self, fmt, *args):
+        """Record an event in the trace if the message is traced."""
         if (self.__log!=None):
-            self.__log.append(line)
+            self.__log.add(fmt, *args)
+
+    @property
+    def traced(self):
+        return self.__log!=None
 
     @property
     def trace(self):
+        """Return the TraceLog of the message, None if it isn't traced."""
         return self.__log
 
     @trace.setter
     def trace(self,v):
-        if v:
-            self.__log=[]
+        if isinstance(v, TraceLog):
+            self.__log=v
+        elif v:
+            self.__log=TraceLog()
         else:
             self.__log=None
 
@@ -437,6 +586,8 @@ class SNPingRequest(CtrlMessage):
        when routing table is incomplete to deliver another message)
        """
 
+    datagram = True
+
     def __init__(self, src, ring_level):
         CtrlMessage.__init__(self)
         self.source=src
@@ -456,29 +607,27 @@ class SNPingMessage(CtrlMessage):
        This will cause the visited node to update its knowledge of the pinger's
        information (e.g. CPE).
     """
-    
 
-    def __init__(self, src_node, ring_level):
+    datagram = True
+
+    # pings from nodes that don't list levels are for 'ring_level' only.
+    __ring_levels = None
+
+    def __init__(self, src_node, ring_level, ring_levels=None):
         CtrlMessage.__init__(self)
         tr = src_node.neighbourhood.trace
         self.__src_node = src_node
         self.__ring_level = ring_level
+        if (ring_levels != None):
+            self.__ring_levels = tuple(ring_levels)
         self.__when = tr[-1]
+        self.sign("%s", self.__when)
 
-    def sign(self, line):
-        if (self.__log!=None):
-            self.__log.append(line)
-
-    @property
-    def trace(self):
-        return self.__log
-
-    @trace.setter
+    @CtrlMessage.trace.setter
     def trace(self,v):
-        if v:
-            self.__log=[self.__when]
-        else:
-            self.__log=None
+        CtrlMessage.trace.fset(self, v)
+        if (v and not isinstance(v, TraceLog)):
+            self.sign("%s", self.__when)
 
 
     @property
@@ -491,6 +640,14 @@ class SNPingMessage(CtrlMessage):
         """Return the ring level that is concerned by this Ping."""
         return self.__ring_level
 
+    @property
+    def ring_levels(self):
+        """Return all the ring levels where the pinging node should be registered
+        (see NeighbourhoodNet.ping_leafset)."""
+        if (self.__ring_levels == None):
+            return (self.__ring_level,)
+        return self.__ring_levels
+
     def accept(self, visitor):
         visitor.visit_SNPingMessage(self)
 
@@ -555,6 +712,69 @@ class InsertionRequest(AppMessage):
         visitor.visit_InsertData(self)
         ## see localevent.py ... DatastoreVisitor
 
+class BatchInsertionRequest(AppMessage):
+    """BatchInsertionRequest inserts many points at once: the keys are kept as
+    one column of values per dimension, the data as a list (one item per point)."""
+
+    def __init__(self, data, columns):
+        AppMessage.__init__(self)
+        self.__data = list(data)
+        self.__columns = dict((dim, list(values)) for dim, values in columns.items())
+
+    @staticmethod
+    def from_items(items):
+        """Return the request inserting the (SpacePart, data) pairs of 'items'.
+        Every key must give a single value along the same dimensions."""
+        data, columns = [], None
+        for key, value in items:
+            if (columns == None):
+                columns = dict((dim, []) for dim in key.dimensions)
+            elif (key.dimensions != set(columns.keys())):
+                raise ValueError("%s doesn't define the dimensions %s"%(
+                    repr(key), repr(sorted(columns.keys()))))
+            for dim, values in columns.items():
+                point = key.get_component(dim).value
+                if (point.__class__ == Range):
+                    if (point.min_unbounded or point.min != point.max):
+                        raise ValueError("%s isn't a point"%repr(key))
+                    point = point.min
+                values.append(point)
+            data.append(value)
+        return BatchInsertionRequest(data, columns if columns != None else {})
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __repr__(self):
+        return "<INSERT %i points>"%len(self.__data)
+
+    @property
+    def data(self):
+        return self.__data
+
+    @property
+    def points(self):
+        """Return the keys as a PointBatch."""
+        return PointBatch(self.__columns)
+
+    def subset(self, indices):
+        """Return a BatchInsertionRequest with the points at 'indices' only."""
+        return BatchInsertionRequest(
+            [self.__data[i] for i in indices],
+            dict((dim, [values[i] for i in indices])
+                 for dim, values in self.__columns.items()))
+
+    def items(self):
+        """Return the (SpacePart, data) pairs to insert."""
+        dimensions = list(self.__columns.keys())
+        return [(SpacePart([Component(dim, self.__columns[dim][i]) for dim in dimensions]),
+                 self.__data[i])
+                for i in range(len(self.__data))]
+
+    def accept(self, visitor):
+        visitor.visit_InsertBatch(self)
+        ## see localevent.py ... DatastoreVisitor
+
 class LookupReply(AppMessage):
     def __init__(self, data, nonce):
         AppMessage.__init__(self)
@@ -619,6 +839,9 @@ class EncapsulatedMessage(AppMessage):
     and routed by the destination node with the appropriate routing method.
     """
 
+    # only used to bring the join request of a new node in.
+    control = True
+
     def __init__(self, payload):
         AppMessage.__init__(self)
 
@@ -0,0 +1,199 @@
+"""
+Latency histograms of the stages a message goes through in a node.
+
+Each (stage, message class) pair has its own Histogram: a fixed array of
+log-linear buckets (16 per power of two, as HDR histograms do) counting
+microseconds, so that recording is a few integer operations and the memory
+used doesn't depend on the number of samples. Percentiles are within 1/16
+(about 6%) of the value they estimate.
+
+The stages are
+ - receive: reading a TCP stream or a datagram, framing and decoding included;
+ - decode: turning a frame into a message;
+ - queue: waiting in the dispatcher queue;
+ - route: asking the RouterVisitor for the destinations of a message;
+ - process: running the ProcessorVisitor on a message delivered here;
+ - send: encoding a message and handing it to the connection pool.
+"""
+
+# System imports
+import json
+import threading
+import time
+
+# ResumeNet imports
+
+# ------------------------------------------------------------------------------------------------
+
+"""Stages of the message pipeline."""
+STAGE_RECEIVE, STAGE_DECODE, STAGE_QUEUE, STAGE_ROUTE, STAGE_PROCESS, STAGE_SEND = \
+    "receive", "decode", "queue", "route", "process", "send"
+
+STAGES = (STAGE_RECEIVE, STAGE_DECODE, STAGE_QUEUE, STAGE_ROUTE, STAGE_PROCESS, STAGE_SEND)
+
+
+class Histogram(object):
+    """Histogram counts latencies in log-linear buckets of microseconds."""
+
+    """Buckets per power of two (as a number of bits)."""
+    SUB_BITS = 4
+    SUB_COUNT = 1 << SUB_BITS
+
+    """The largest latency told apart from the others (in microseconds, about 19 hours)."""
+    HIGHEST = (1 << 36) - 1
+
+    """Percentiles given in reports."""
+    PERCENTILES = (50, 90, 99, 99.9)
+
+    def __init__(self):
+        self.__counts = [0] * (self.__index(self.HIGHEST) + 1)
+        self.reset()
+
+    def reset(self):
+        """Forget every recorded latency."""
+        for i in range(len(self.__counts)):
+            self.__counts[i] = 0
+        self.__count = 0
+        self.__total = 0
+        self.__max = 0
+
+    @staticmethod
+    def __index(value):
+        """Return the bucket of 'value' (in microseconds)."""
+        if (value < Histogram.SUB_COUNT):
+            return value
+        shift = value.bit_length() - Histogram.SUB_BITS - 1
+        return ((shift + 1) << Histogram.SUB_BITS) + (value >> shift) - Histogram.SUB_COUNT
+
+    @staticmethod
+    def __lowest(index):
+        """Return the smallest value counted in the bucket 'index'."""
+        if (index < Histogram.SUB_COUNT):
+            return index
+        shift = (index >> Histogram.SUB_BITS) - 1
+        return ((index & (Histogram.SUB_COUNT - 1)) + Histogram.SUB_COUNT) << shift
+
+    def record(self, seconds):
+        """Count a latency of 'seconds'."""
+        value = int(seconds * 1e6)
+        if (value > self.HIGHEST):
+            value = self.HIGHEST
+        elif (value < 0):
+            value = 0
+        self.__counts[self.__index(value)] += 1
+        self.__count += 1
+        self.__total += value
+        if (value > self.__max):
+            self.__max = value
+
+    def percentile(self, percent):
+        """Return the latency (in seconds) 'percent' % of the samples don't exceed."""
+        if (self.__count == 0):
+            return 0.0
+        rank = max(1, int(self.__count * percent / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.__counts):
+            seen += count
+            if (seen >= rank):
+                # report the middle of the bucket, but never beyond the max.
+                upper = self.__lowest(index + 1) - 1
+                value = (self.__lowest(index) + upper) / 2.0
+                return min(value, self.__max) / 1e6
+        return self.__max / 1e6
+
+    def snapshot(self):
+        """Return the count, mean, max and percentiles (in seconds)."""
+        report = {
+            "count": self.__count,
+            "mean": self.__total / 1e6 / self.__count if self.__count > 0 else 0.0,
+            "max": self.__max / 1e6,
+            }
+        for percent in self.PERCENTILES:
+            report["p%s" % ("%g" % percent).replace(".", "")] = self.percentile(percent)
+        return report
+
+    #
+    # Properties
+
+    @property
+    def count(self):
+        """Return the number of latencies recorded."""
+        return self.__count
+
+
+class LatencyMetrics(object):
+    """LatencyMetrics holds a Histogram per stage and message class.
+
+    Histograms are updated from the dispatcher loop and the worker threads
+    without a lock: under the GIL, a sample may exceptionally be lost, which
+    doesn't matter for a latency distribution.
+    """
+
+    __shared = None
+
+    def __init__(self):
+        self.__histograms = {}      # (stage, class name) -> Histogram
+        self.__lock = threading.Lock()
+        self.__since = time.time()
+        self.enabled = True
+
+    @staticmethod
+    def shared():
+        """Return the metrics of this node."""
+        if (LatencyMetrics.__shared == None):
+            LatencyMetrics.__shared = LatencyMetrics()
+        return LatencyMetrics.__shared
+
+    def histogram(self, stage, name):
+        """Return the Histogram of the messages of class 'name' at 'stage'."""
+        key = (stage, name)
+        histogram = self.__histograms.get(key)
+        if (histogram == None):
+            with self.__lock:
+                histogram = self.__histograms.setdefault(key, Histogram())
+        return histogram
+
+    def record(self, stage, name, seconds):
+        """Count a latency of 'seconds' for class 'name' at 'stage'."""
+        if (self.enabled):
+            self.histogram(stage, name).record(seconds)
+
+    def record_since(self, stage, message, started):
+        """Count the time elapsed since 'started' (a time.perf_counter())
+        for 'message' at 'stage'."""
+        if (self.enabled):
+            self.histogram(stage, message.__class__.__name__).record(time.perf_counter() - started)
+
+    def reset(self):
+        """Forget every recorded latency (e.g. between benchmark runs)."""
+        with self.__lock:
+            for histogram in self.__histograms.values():
+                histogram.reset()
+            self.__since = time.time()
+
+    def report(self):
+        """Return, for each stage, the snapshot of each message class that
+        went through it (see Histogram.snapshot)."""
+        report = dict((stage, {}) for stage in STAGES)
+        with self.__lock:
+            histograms = list(self.__histograms.items())
+        for (stage, name), histogram in histograms:
+            if (histogram.count > 0):
+                report.setdefault(stage, {})[name] = histogram.snapshot()
+        return report
+
+    def dump(self):
+        """Return the report as a line of JSON (times in seconds)."""
+        return json.dumps({"since": self.__since, "stages": self.report()}, sort_keys=True)
+
+    def format(self):
+        """Return the report as a table (times in milliseconds)."""
+        lines = ["%-8s %-22s %8s %8s %8s %8s %8s %8s" % (
+            "stage", "class", "count", "mean", "p50", "p99", "p99.9", "max")]
+        report = self.report()
+        for stage in STAGES:
+            for name, stats in sorted(report[stage].items()):
+                lines.append("%-8s %-22s %8i %8.3f %8.3f %8.3f %8.3f %8.3f" % (
+                    stage, name, stats["count"], stats["mean"] * 1000, stats["p50"] * 1000,
+                    stats["p99"] * 1000, stats["p999"] * 1000, stats["max"] * 1000))
+        return "\n".join(lines)
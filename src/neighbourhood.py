@@ -1,8 +1,11 @@
 # System imports
+import bisect
 import logging
+import time
 
 # ResumeNet imports
-from nodeid import NodeID
+from logpipe import LogPipe
+from equation import Range
 from util import Direction
 
 """
@@ -19,8 +22,7 @@ node must received the request.
 # -----------------------------------------------------------------------------------
 
 # Module log abilities
-LOG_HANDLER = logging.StreamHandler()
-LOG_HANDLER.setLevel(logging.DEBUG)
+LOG_HANDLER = LogPipe.shared().handler
 
 LOGGER = logging.getLogger("neighbourhood")
 LOGGER.setLevel(logging.DEBUG)
@@ -32,19 +34,20 @@ class Neighbourhood(object):
     """Stores a set of pointers to neighbours nodes.
        Yes, that means Node objects, although less complete than the localnode.
        (see Node::__getstate__ to see what the pickling drops)
-    """
 
-    # this approach of neighbourhood is sub-optimal, imho, in the
-    #   fact that it forces enumeration of levels where an enumeration
-    #   of (unique) neighbours would likely be enough.
+    Only the rings that were ever used exist, and a neighbour found in many
+    rings is a single Node, shared by all of them (see PeerTable).
+    """
 
     def __init__(self, local_node):
-        self.__rings = list()
         self.__local_node = local_node
-
-        nb_ring = local_node.numeric_id.get_nb_digit() + 1
-        for i in range(nb_ring):
-            self.__rings.append(RingSet(local_node))
+        self.__nb_level = local_node.numeric_id.get_nb_digit() + 1
+        self.__rings = {}           # level -> RingSet
+        self.__populated = set()    # levels whose ring holds neighbours
+        self.__top = 0
+        self.__regions = RegionIndex()
+        self.__peers = PeerTable(local_node, self.__regions)
+        self.get_ring(0)
         self.trace=[]
         self.lastupdate=dict()
         self.__updateid=0
@@ -55,6 +58,7 @@ class Neighbourhood(object):
         self.__updateid = self.__updateid+1
 
     def update(self, node):
+        self.__peers.share(node)
         if not repr(node.name_id) in self.lastupdate:
             self.lastupdate[repr(node.name_id)]='n'
         self.lastupdate[repr(node.name_id)]+="u%i@%i:%i"%(
@@ -65,17 +69,56 @@ class Neighbourhood(object):
     # Properties
     @property
     def nb_ring(self):
-        """Return the number of neighbours ring."""
-        return len(self.__rings)
+        """Return the number of rings, up to the highest one holding neighbours."""
+        return self.__top + 1
+
+    @property
+    def nb_level(self):
+        """Return the number of rings the local node may have."""
+        return self.__nb_level
+
+    @property
+    def levels(self):
+        """Return the levels of the rings holding neighbours, lowest first."""
+        return sorted(self.__populated)
+
+    @property
+    def regions(self):
+        """Return the RegionIndex of the neighbours."""
+        return self.__regions
+
+    @property
+    def peers(self):
+        """Return the PeerTable of the neighbours."""
+        return self.__peers
 
     def can_wrap(self, direction, skip=None):
         return self.get_ring(0).can_wrap(direction,skip)
 
 
     def get_ring(self, ring_level):
-        """Return the neighbours ring of a level."""
-        assert(0 <= ring_level and ring_level < self.nb_ring)
-        return self.__rings[ring_level]
+        """Return the neighbours ring of a level (created if it doesn't exist yet)."""
+        assert(0 <= ring_level and ring_level < self.__nb_level)
+        ring = self.__rings.get(ring_level)
+        if (ring == None):
+            ring = RingSet(self.__local_node, self.__peers,
+                           lambda: self.__ring_changed(ring_level))
+            rings = dict(self.__rings)
+            rings[ring_level] = ring
+            self.__rings = rings
+        return ring
+
+    def __ring_changed(self, ring_level):
+        """Keep track of the rings holding neighbours."""
+        ring = self.__rings[ring_level]
+        if (ring.size(Direction.LEFT) > 0 or ring.size(Direction.RIGHT) > 0):
+            self.__populated.add(ring_level)
+            if (ring_level > self.__top):
+                self.__top = ring_level
+        else:
+            self.__populated.discard(ring_level)
+            if (ring_level == self.__top):
+                self.__top = max(self.__populated) if len(self.__populated) > 0 else 0
 
     # ultimately used by CPE routing.
     def get_neighbour(self, direction, ring_level,skip=None):
@@ -84,34 +127,49 @@ class Neighbourhood(object):
            to ignore a specific name.
         """
         
-        assert(0 <= ring_level and ring_level < self.nb_ring)
+        assert(0 <= ring_level and ring_level < self.__nb_level)
 
-        ring_set = self.__rings[ring_level]
+        ring_set = self.__rings.get(ring_level)
+        if (ring_set == None):
+            return self.__local_node
         half_ring_set = ring_set.get_side(direction)
 
         return half_ring_set.get_closest(skip)
 
     def size(self, direction, ring_level):
         """Return the closest neighbour in one direction."""
-        assert(0 <= ring_level and ring_level < self.nb_ring)
+        assert(0 <= ring_level and ring_level < self.__nb_level)
 
-        return self.__rings[ring_level].size(direction)
+        ring_set = self.__rings.get(ring_level)
+        return ring_set.size(direction) if ring_set != None else 0
 
     def get_all_unique_neighbours(self):
         """Returns all unique neighbours currently in this neighbourhood."""
-        unique_neighbours = set()
-        for ring in self.__rings:
-            unique_neighbours |= ring.get_all_unique_neighbours()
+        unique_neighbours = set(self.__peers.nodes())
+        unique_neighbours.add(self.__local_node)
         return unique_neighbours
 
+    def get_leafset(self):
+        """Returns the unique neighbours, each with the levels of the rings it
+        is in (lowest first), as a list of (node, levels) pairs."""
+        leafset = {}    # name_id -> (node, levels)
+        for level in self.levels:
+            ring = self.__rings[level]
+            for direction in (Direction.LEFT, Direction.RIGHT):
+                for neighbour in ring.get_side(direction).get_neighbours():
+                    node, levels = leafset.setdefault(neighbour.name_id, (neighbour, []))
+                    if (len(levels) == 0 or levels[-1] != level):
+                        levels.append(level)
+        return list(leafset.values())
+
     # see PingRequest, NeighbourhoodNet::repair_level
     #   PING requests are for a specific ring, so we always know
     #   which ring we should add a neighbour to.
     def add_neighbour(self, level, new_neighbour):
         """Add a neighbour in one of the ring of the neighbourhood."""
         added = False
-        if(0 <= level and level < len(self.__rings)):
-            added = self.__rings[level].add_neighbour(new_neighbour)
+        if(0 <= level and level < self.__nb_level):
+            added = self.get_ring(level).add_neighbour(new_neighbour)
             ## tracking evolution.
             if not repr(new_neighbour.name_id) in self.lastupdate:
                 self.lastupdate[repr(new_neighbour.name_id)]="=%i"%self.__updateid
@@ -123,8 +181,8 @@ class Neighbourhood(object):
     def remove_neighbour(self, old_neighbour):
         """Remove a neighbour from the neighbourhood."""
         removed = False
-        for ring in self.__rings:
-            removed |= ring.remove_neighbour(old_neighbour)
+        for level in self.levels:
+            removed |= self.__rings[level].remove_neighbour(old_neighbour)
         return removed
 
     #
@@ -132,23 +190,195 @@ class Neighbourhood(object):
 
     def __repr__(self):
         rpr = "<Neighbourhood--"
-        for i in range(len(self.__rings)):
-            ring = self.__rings[i]
-            if(1 < len(ring.get_all_unique_neighbours())):
-                rpr += "|"
-                rpr += str(i)
-                rpr += ring.__repr__()
-                rpr += "|"
+        for i in self.levels:
+            rpr += "|"
+            rpr += str(i)
+            rpr += self.__rings[i].__repr__()
+            rpr += "|"
         return rpr + ">"
 
 
+class PeerTable(object):
+    """Holds a single Node per unique neighbour, that every ring refers to,
+    and counts the half rings it is in.
+
+    A newer copy of a neighbour (e.g. from a SNPingMessage) updates that
+    Node rather than replacing it in each ring. Neighbours are told apart by
+    their Node.identity: a node that comes back under the same name at
+    another address is another neighbour.
+    """
+
+    def __init__(self, local_node, regions=None):
+        self.__local_node = local_node
+        self.__regions = regions
+        self.__peers = {}       # identity -> [node, number of half rings]
+
+    def share(self, node):
+        """Return the Node of the neighbour 'node' is a copy of, brought up to
+        date with it ('node' itself if it isn't a neighbour yet)."""
+        record = self.__peers.get(node.identity)
+        if (record == None or record[0] is node):
+            return node
+        shared = record[0]
+        # Always take the latest version of node (CPE may change).
+        shared.cpe = node.cpe
+        shared.partition_id = node.partition_id
+        shared.postprocess(self.__local_node)
+        if (self.__regions != None):
+            self.__regions.update(shared)
+        return shared
+
+    def hold(self, node):
+        """Count one more half ring holding 'node' (a shared Node)."""
+        record = self.__peers.get(node.identity)
+        if (record == None):
+            peers = dict(self.__peers)
+            peers[node.identity] = [node, 1]
+            self.__peers = peers
+            if (self.__regions != None):
+                self.__regions.update(node)
+        else:
+            record[1] += 1
+
+    def release(self, node):
+        """Count one less half ring holding 'node', forgetting it at the last one."""
+        record = self.__peers.get(node.identity)
+        if (record == None):
+            return
+        record[1] -= 1
+        if (record[1] <= 0):
+            peers = dict(self.__peers)
+            del peers[node.identity]
+            self.__peers = peers
+            if (self.__regions != None):
+                self.__regions.remove(record[0])
+
+    def nodes(self):
+        """Return the unique neighbours."""
+        return [record[0] for record in self.__peers.values()]
+
+    def __contains__(self, node):
+        return node.identity in self.__peers
+
+    def __len__(self):
+        return len(self.__peers)
+
+
+class RegionIndex(object):
+    """Indexes the regions of the space the neighbours manage, as told by
+    their CPEs, so that a query that lies within one of them is sent there
+    without scanning the rings.
+
+    There is one region per unique neighbour (a few dozens at most), kept
+    in a flat list of bounds: a region is computed again when the CPE of its
+    node has been replaced or has grown since.
+
+    The CPE of a neighbour is the one of the last copy of it received: the
+    neighbour may have split its region with a joining node since. Regions
+    that weren't refreshed for MAX_AGE seconds are thus left out.
+    """
+
+    """Age (in seconds) beyond which the region of a neighbour isn't trusted:
+    a few heartbeats (see node::NodeStatusPublisher)."""
+    MAX_AGE = 30
+
+    def __init__(self):
+        self.__regions = {}     # identity -> [node, cpe, height, bounds, refreshed]
+
+    def update(self, node):
+        """Record the region of 'node' (a new neighbour, or a newer copy of one)."""
+        region = self.__regions.get(node.identity)
+        if (region == None or region[0] is not node or region[1] is not node.cpe):
+            regions = dict(self.__regions)
+            regions[node.identity] = [node, None, -1, None, time.monotonic()]
+            self.__regions = regions
+        else:
+            region[4] = time.monotonic()
+
+    def remove(self, node):
+        """Forget the region of 'node'."""
+        if (node.identity in self.__regions):
+            regions = dict(self.__regions)
+            del regions[node.identity]
+            self.__regions = regions
+
+    @staticmethod
+    def __bounds(region):
+        """Return the bounds of 'region', computed again if its CPE changed."""
+        node, cpe, height, bounds, refreshed = region
+        if (node.cpe is not cpe or node.cpe.height != height):
+            cpe = node.cpe
+            bounds = cpe.get_bounds() if cpe.height > 0 else None
+            region[1:4] = [cpe, cpe.height, bounds]
+        return bounds
+
+    @staticmethod
+    def contains(bounds, space_part):
+        """Return True if 'space_part' lies within 'bounds' (see CPE.get_bounds)."""
+        for dimension, (low, high) in bounds.items():
+            component = space_part.get_component(dimension)
+            if (component == None):
+                return False
+            value = component.value
+            if (value.__class__ == Range):
+                if (low != None and (value.min_unbounded or value.min < low or
+                                     (value.min == low and value.min_included))):
+                    return False
+                if (high != None and (value.max_unbounded or value.max > high)):
+                    return False
+            elif ((low != None and value <= low) or (high != None and value > high)):
+                return False
+        return True
+
+    def containing(self, space_part, limit=None):
+        """Return the neighbour whose region holds the whole of 'space_part',
+        among those whose partition id is within 'limit' (a PidRange) and
+        whose region is recent enough, if any."""
+        oldest = time.monotonic() - self.MAX_AGE
+        for region in self.__regions.values():
+            node = region[0]
+            if (region[4] < oldest):
+                continue
+            if (limit != None and limit.includes_pid(node.partition_id) == None):
+                continue
+            bounds = self.__bounds(region)
+            try:
+                if (bounds != None and self.contains(bounds, space_part)):
+                    return node
+            except TypeError:
+                pass # values that can't be compared with those of the CPE.
+        return None
+
+    def __len__(self):
+        return len(self.__regions)
+
+
+class _Reversed(object):
+    """Wraps a value so that it sorts in decreasing order."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    __hash__ = None
+
+
 class RingSet(object):
     """Stores a set of pointers to neighbours nodes of a ring."""
 
-    def __init__(self, local_node):
+    def __init__(self, local_node, peers=None, watcher=None):
         self.__local_node = local_node
-        self.__left = HalfRingSet(Direction.LEFT, self.__local_node)
-        self.__right = HalfRingSet(Direction.RIGHT, self.__local_node)
+        self.__left = HalfRingSet(Direction.LEFT, self.__local_node,
+                                  peers=peers, watcher=watcher)
+        self.__right = HalfRingSet(Direction.RIGHT, self.__local_node,
+                                   peers=peers, watcher=watcher)
 
 
     def can_wrap(self,dir,skip):
@@ -221,7 +451,19 @@ class RingSet(object):
 
 
 class HalfRingSet(object):
-    """Stores a set of pointers to neighbours nodes of an half ring."""
+    """Stores a set of pointers to neighbours nodes of an half ring.
+
+    The list of neighbours is copied on write: it is only modified by the
+    dispatcher loop, and replaced as a whole, so that workers may read it
+    (or keep what get_neighbours() returned) without locking.
+
+    With a PeerTable, the half ring holds the shared Node of each neighbour,
+    and 'watcher' is called whenever the neighbours change.
+
+    Neighbours are sorted by their distance from the local node, going
+    in the direction of the half ring (see __key), so that the position of a
+    node is found by bisection, and indexed by name id.
+    """
 
     """The number of neighbours to keep in this half ring."""
     DEFAULT_MAX_SIZE = 16
@@ -229,14 +471,18 @@ class HalfRingSet(object):
     """The special maximum size for unlimited neighbours."""
     UNBOUNDED_SIZE = 0
 
-    def __init__(self, direction, local_node, max_size=DEFAULT_MAX_SIZE):
+    def __init__(self, direction, local_node, max_size=DEFAULT_MAX_SIZE, peers=None, watcher=None):
         self.__direction = direction
         self.__local_node = local_node
+        self.__peers = peers
+        self.__watcher = watcher
 
         if (max_size < 0):
             raise ValueError("The maximum number of neighbours is too small.")
         self.__max_size = max_size
         self.__neighbours = []
+        self.__keys = []        # the __key of each neighbour, in the same order
+        self.__by_identity = {} # Node.identity -> neighbour
 
     #
     # Properties
@@ -257,9 +503,9 @@ class HalfRingSet(object):
 
     def __get_node(self, index):
         """Return the node at a given index or the local node if that index doesn't exist."""
-        upper_bound = len(self.__neighbours)
-        if(0 <= index and index < upper_bound):
-            return self.__neighbours[index]
+        neighbours = self.__neighbours
+        if(0 <= index and index < len(neighbours)):
+            return neighbours[index]
         return self.__local_node
 
     def get_neighbours(self):
@@ -277,76 +523,92 @@ class HalfRingSet(object):
         """Add a neighbour in this half ring."""
         return self.__try_add_neighbour(new_neighbour)
 
+    def __key(self, node):
+        """Return the sort key of 'node': names are met in increasing order
+        going right from the local node (decreasing going left), then in the
+        same order again after wrapping around, up to the local name itself.
+        Nodes sharing a name are ordered by address."""
+        name_id, address = node.identity
+        local = self.__local_node.name_id
+        if (self.__direction == Direction.RIGHT):
+            return (name_id <= local, name_id, address)
+        return (name_id >= local, _Reversed(name_id), address)
+
     def __try_add_neighbour(self, node_to_add):
         """Try to add a node in the neighbours of this half ring."""
         added = False
 
         if (node_to_add != self.__local_node):
-            # Find the position of the new node.
-            prev = self.__local_node
-            position = len(self.__neighbours)
-
-            for i in range(len(self.__neighbours)):
-                current = self.__neighbours[i]
-
-                if (current.name_id == node_to_add.name_id):
-                    # WARNING: Node.__eq__ not only compares the nameID and numeric_ID,
-                    #  but also partition_id and net_info.
-                    # Always take the latest version of node (CPE may change).
-                    self.__neighbours[i].cpe=node_to_add.cpe
-                    self.__neighbours[i].postprocess(self.__local_node)
-                    self.__neighbours[i] = node_to_add
-                    return False
-                else:
-                    if(self.__lies_between(prev, node_to_add, current)):
-                        position = i
-                        break
-
-                prev = current
+            if (self.__peers != None):
+                node_to_add = self.__peers.share(node_to_add)
+
+            identity = node_to_add.identity
+            key = self.__key(node_to_add)
+            position = bisect.bisect_left(self.__keys, key)
+
+            current = self.__by_identity.get(identity)
+            if (current != None):
+                if (current is node_to_add):
+                    return False # the shared Node is already up to date.
+                # Node.__eq__ only compares the identity (nameID, address):
+                #  a newer copy may carry another CPE or partition_id.
+                # Always take the latest version of node (CPE may change).
+                current.cpe=node_to_add.cpe
+                current.postprocess(self.__local_node)
+                neighbours = list(self.__neighbours)
+                neighbours[position] = node_to_add
+                by_identity = dict(self.__by_identity)
+                by_identity[identity] = node_to_add
+                self.__neighbours, self.__by_identity = neighbours, by_identity
+                self.__changed(node_to_add, current)
+                return False
 
             # Add the new node.
             if(self.is_unbounded() or position < self.__max_size):
-                self.__neighbours.insert(position, node_to_add)
+                neighbours = list(self.__neighbours)
+                keys = list(self.__keys)
+                by_identity = dict(self.__by_identity)
+                neighbours.insert(position, node_to_add)
+                keys.insert(position, key)
+                by_identity[identity] = node_to_add
                 added = True
+                evicted = None
 
-                if (self.__max_size < len(self.__neighbours) and not self.is_unbounded()):
+                if (self.__max_size < len(neighbours) and not self.is_unbounded()):
                     # Remove the farthest neighbour.
-                    self.__neighbours.pop()
-
-# -- the following holds for neighbourhood controlled by skiptree join messages.
-#  for i in range(len(self.__neighbours)):
-#                 if (i!=position) :
-#                     assert self.__neighbours[i].name_id != node_to_add.name_id,"node %s already in ringset %s" % (str(node_to_add),str(self.__neighbours))
-                          
+                    evicted = neighbours.pop()
+                    keys.pop()
+                    del by_identity[evicted.identity]
+                self.__neighbours, self.__keys, self.__by_identity = neighbours, keys, by_identity
+                self.__changed(node_to_add, evicted)
 
         return added
 
-    def __lies_between(self, node_a, node_b, node_c):
-        """Determine if b is located between a and c, when going in some direction.
-           a and c are assumed to be already direction-sorted, so if they wrap,
-           b can wrap. If not, do not insert a new wrap.
-        """
-        a, b, c = node_a.name_id, node_b.name_id, node_c.name_id
-        wrap = (a>c) if self.__direction==Direction.RIGHT else (a<c)
-        return NodeID.lies_between_direction(self.__direction, a, b, c, wrap)
-
     def remove_neighbour(self, old_neighbour):
         """Remove a neighbour from this half ring."""
-        # Find the position of the neighbour.
-        position = -1
-        for i in range(len(self.__neighbours)):
-            current_node = self.__neighbours[i]
-
-            if (current_node == old_neighbour):
-                position = i
-                break
+        current_node = self.__by_identity.get(old_neighbour.identity)
+        if (current_node == None):
+            return False
 
         # Remove the found neighbour.
-        removed = False
-        if (-1 < position):
-            del self.__neighbours[i]
-            removed = True
-        return removed
+        position = bisect.bisect_left(self.__keys, self.__key(current_node))
+        by_identity = dict(self.__by_identity)
+        del by_identity[current_node.identity]
+        self.__neighbours = self.__neighbours[:position] + self.__neighbours[position + 1:]
+        self.__keys = self.__keys[:position] + self.__keys[position + 1:]
+        self.__by_identity = by_identity
+        self.__changed(None, current_node)
+        return True
+
+    def __changed(self, added, removed):
+        """Tell the PeerTable and the watcher about a change of neighbours."""
+        if (self.__peers != None):
+            if (added != None):
+                self.__peers.hold(added)
+            if (removed != None):
+                self.__peers.release(removed)
+        if (self.__watcher != None):
+            self.__watcher()
 
     #
     # Overwritten
@@ -356,10 +618,11 @@ class HalfRingSet(object):
         return len(self.__neighbours)
 
     def __repr__(self):
-        rpr = str(len(self.__neighbours))+"#"
-        for i in range(len(self.__neighbours)):
-            rpr += "%s"%(self.__neighbours[i].name_id.__repr__())
-            if (i != len(self.__neighbours) - 1):
+        neighbours = self.__neighbours
+        rpr = str(len(neighbours))+"#"
+        for i in range(len(neighbours)):
+            rpr += "%s"%(neighbours[i].name_id.__repr__())
+            if (i != len(neighbours) - 1):
                 rpr += ", "
                 # assert (self.__neighbours[i].name_id < self.__neighbours[i+1].name_id),"neighbours ordered."+str(i)+" "+str(self.__neighbours)+"\n"+self.__local_node.status
         return rpr
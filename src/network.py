@@ -1,19 +1,21 @@
 # System imports
-import asyncore
+import asyncio
+import collections
 import logging
-import pickle
-import select
-import socket
+import random
+import struct
+import tempfile
 import time
-import pdb
 
 # ResumeNet imports
+from logpipe import LogPipe
+from codec import WireCodec
+from metrics import LatencyMetrics, STAGE_RECEIVE, STAGE_DECODE, STAGE_SEND
 
 # ------------------------------------------------------------------------------------------------
 
 # Module log abilities
-LOG_HANDLER = logging.StreamHandler()
-LOG_HANDLER.setLevel(logging.DEBUG)
+LOG_HANDLER = LogPipe.shared().handler
 
 LOGGER = logging.getLogger("network")
 LOGGER.setLevel(logging.DEBUG)
@@ -28,190 +30,272 @@ class NetStringParseError(ValueError):
         ValueError.__init__(self, *args, **kwargs)
 
 
-class NetStringTools(object):
-    """This uses NetStrings protocol to break up the input into strings."""
+class FrameTools(object):
+    """This breaks up a stream into frames, and frames messages.
+
+    Three formats are accepted, told apart by their first byte:
+    - NetStrings, '<length>;<payload>,', starting with an ASCII digit;
+    - binary frames, BINARY_MARK followed by the payload length as a 4-byte
+      big-endian integer, then the payload;
+    - batch frames, BATCH_MARK followed by the length of the body as in binary
+      frames, the body being a sequence of messages, each one preceded by its
+      own 4-byte length.
+    The receiving end of a connection announces the formats it accepts beyond
+    NetStrings by sending their marks (ANNOUNCE) as soon as the connection is
+    made (older nodes read and ignore anything coming back on their outgoing
+    connections), and the sending end uses them once it has seen them.
+
+    Reception goes through the asyncio.BufferedProtocol interface: small
+    frames are parsed in place in a preallocated staging bytearray, and the
+    payload of a large frame is received straight into a bytearray of its
+    final size.
+    """
 
     """The maximum length (in bytes) of accepted message."""
     MAX_LENGTH = 16*1024*1024
 
-    """The state in witch this object could be."""
-    STATE_LENGTH, STATE_DATA, STATE_END = range(3)
+    """The size of the staging buffer. Larger frames get their own buffer."""
+    STAGING_SIZE = 64*1024
 
-    """The ASCII representation of number. Used to extract message length."""
-    NUMBER_ASCII = frozenset([ord(e) for e in ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']])
+    """The first byte of binary and batch frames, also announcing a receiver accepts them."""
+    BINARY_MARK = 0xb1
+    BATCH_MARK = 0xb2
+    BINARY_HEADER = struct.Struct(">BI")
+    BATCH_ITEM = struct.Struct(">I")
+    ANNOUNCE = bytes((BINARY_MARK, BATCH_MARK))
 
     """The delimiter used in order to separate length and payload"""
-    DEL_LENGTH = ";"
+    DEL_LENGTH = b";"
 
     """The delimiter used in order to separate payload and next message"""
-    DEL_DATA = ","
+    DEL_DATA = b","
+
+    """The longest NetString length field accepted."""
+    MAX_LENGTH_DIGITS = len(str(MAX_LENGTH))
 
     def __init__(self):
+        self.__staging = bytearray(self.STAGING_SIZE)
+        self.__held = False         # frames are kept staged, not delivered
         self.reset_state()
 
     def reset_state(self):
         """Reset the objects state."""
-        self.__buffer = bytes()     # Receiving data
-        self.__data = bytes()       # Completed received data
-
-        self.__reader_length = 0
-        self.__reader_state = self.STATE_LENGTH
-
-    def format_data(self, payload):
-        """Format a message in the NetString format."""
-        data_to_send = bytes(str(len(payload)), "Utf8") # the length
-        data_to_send += self.DEL_LENGTH.encode("Utf8")  #  ;
-        data_to_send += payload                         # the data (bytes(), already)
-        data_to_send += self.DEL_DATA.encode("Utf8")    #  ,
-
-        return data_to_send
-
-    def recv_data(self, data):
-        """Call to process a message."""
-        self.__buffer = data
-        l = len(data)
-        # print("NET> received",l,"bytes to process")
-        if (l==0):
-            pdb.set_trace()
-            raise RuntimeError("connection terminated?",self)
+        self.__staged = 0           # bytes of __staging holding received data
+        self.__frame = None         # payload of a large frame being received
+        self.__filled = 0           # bytes of __frame already received
+        self.__batch = False        # __frame is the body of a batch frame
+        self.__trailer = False      # a NetString ',' is expected next
+
+    @classmethod
+    def format_data(cls, payload, binary=False):
+        """Return the buffers framing 'payload', to be written in sequence."""
+        if (binary):
+            return (cls.BINARY_HEADER.pack(cls.BINARY_MARK, len(payload)), payload)
+        return (b"%i;" % len(payload), payload, cls.DEL_DATA)
+
+    @classmethod
+    def format_batch(cls, payloads):
+        """Return the buffers of a batch frame carrying every payload."""
+        buffers = [None]
+        length = 0
+        for payload in payloads:
+            buffers.append(cls.BATCH_ITEM.pack(len(payload)))
+            buffers.append(payload)
+            length += cls.BATCH_ITEM.size + len(payload)
+        buffers[0] = cls.BINARY_HEADER.pack(cls.BATCH_MARK, length)
+        return buffers
+
+    def get_buffer(self, sizehint):
+        """Return where the next received bytes must be written."""
+        if (self.__frame != None):
+            return memoryview(self.__frame)[self.__filled:]
+        return memoryview(self.__staging)[self.__staged:]
+
+    def buffer_updated(self, nbytes):
+        """Call when 'nbytes' have been written in the last get_buffer()."""
         try:
-            while self.__buffer:
-                if self.__reader_state == self.STATE_DATA:
-                    self.__do_data()
-                elif self.__reader_state == self.STATE_END:
-                    self.__do_comma()
-                elif self.__reader_state == self.STATE_LENGTH:
-                    self.__do_length()
-                else:
-                    raise RuntimeError("State is not DATA, END or LENGTH.")
+            if (self.__frame != None):
+                self.__filled += nbytes
+                if (self.__filled == len(self.__frame)):
+                    frame, self.__frame = self.__frame, None
+                    if (self.__batch):
+                        self.__deliver_batch(frame, 0, len(frame))
+                    else:
+                        self.__deliver(frame)
+                return
+            self.__staged += nbytes
+            self.__parse_staging()
 
         except NetStringParseError as e:
-            LOGGER.log(logging.WARNING, "A buggy message have been received.",e)
-            self.reset_state()
+            self._parse_error(e)
 
-    def _data_received(self, data):
-        """Override this to process data."""
-        raise NotImplementedError
-
-    def __do_length(self):
-        """Process the beginning of a message looking for the length."""
-        length, data = self.__get_length_data(self.__buffer)
-        self.__buffer = bytes()
-
-        if length == None:
-            raise NetStringParseError("Message length expected.")
+    def hold(self):
+        """Stop delivering frames: those received meanwhile stay staged."""
+        self.__held = True
 
-        if 0 < len(length):
+    def release(self):
+        """Deliver frames again, starting with the staged ones."""
+        self.__held = False
+        if (self.__frame == None):
             try:
-                self.__reader_length = self.__reader_length * (10 ** len(length)) + int(length)
-            except OverflowError:
-                raise NetStringParseError("Message length too long."+str(length,"ASCII"))
-            if self.__reader_length > 65536:
-                print("NET> large message ahead:",str(self.__reader_length),"bytes.")
-
-            if self.__reader_length > self.MAX_LENGTH:
-                raise NetStringParseError("Message length too long."+str(length,"ASCII"))
-
-        if data != None:
-            self.__data = bytes()
-            self.__buffer = data
-            self.__reader_state = self.STATE_DATA
-
-    def __get_length_data(self, p_data):
-        """Separate the length from the beginning of the data in a message."""
-        length, data = None, None
-        for i in range(len(p_data)):
-            if p_data[i] in self.NUMBER_ASCII:
-                if length == None:
-                    length = bytes()
-                length += bytes([p_data[i]])
+                self.__parse_staging()
+            except NetStringParseError as e:
+                self._parse_error(e)
+
+    def __parse_staging(self):
+        """Deliver the complete frames of the staging buffer."""
+        staging, staged = self.__staging, self.__staged
+        pos = 0
+        while pos < staged and not self.__held:
+            if (self.__trailer):
+                if (staging[pos] != self.DEL_DATA[0]):
+                    raise NetStringParseError("Message end expected.")
+                self.__trailer = False
+                pos += 1
+                continue
+
+            first = staging[pos]
+            batch = (first == self.BATCH_MARK)
+            if (first == self.BINARY_MARK or batch):
+                if (staged - pos < self.BINARY_HEADER.size):
+                    break
+                length = self.BINARY_HEADER.unpack_from(staging, pos)[1]
+                start = pos + self.BINARY_HEADER.size
+                netstring = False
+            else:
+                separator = staging.find(self.DEL_LENGTH, pos, min(staged, pos + self.MAX_LENGTH_DIGITS + 1))
+                if (separator < 0):
+                    if (staged - pos > self.MAX_LENGTH_DIGITS):
+                        raise NetStringParseError("Message length expected.")
+                    break
+                digits = staging[pos:separator]
+                if (not digits.isdigit()):
+                    # int() would also take signs, blanks and underscores.
+                    raise NetStringParseError("Message length expected.")
+                length = int(digits)
+                start = separator + 1
+                netstring = True
+
+            if (length > self.MAX_LENGTH):
+                raise NetStringParseError("Message length too long: %i" % length)
+
+            available = staged - start
+            if (available >= length):
+                pos = start + length
+                self.__trailer = netstring
+                if (batch):
+                    self.__deliver_batch(staging, start, pos)
+                else:
+                    self.__deliver(bytes(staging[start:pos]))
+            elif (length > self.STAGING_SIZE // 2):
+                # a large frame: the rest of it is received in its own buffer.
+                LOGGER.debug("large message ahead: %i bytes.", length)
+                self.__frame = bytearray(length)
+                self.__frame[:available] = staging[start:staged]
+                self.__filled = available
+                self.__batch = batch
+                self.__trailer = netstring
+                pos = staged
+                break
             else:
-                if(p_data[i] == ord(self.DEL_LENGTH)):
-                    data = bytes()
-                    if (i + 1 < len(p_data)):
-                        data = p_data[i + 1 :]
-
-                    if(length == None):
-                        length = bytes()
                 break
-        return (length, data)
 
-    def __do_data(self):
-        """Process the payload of a message."""
-        buf, self.__buffer = self.__buffer[:int(self.__reader_length)], self.__buffer[int(self.__reader_length):]
-        self.__reader_length = self.__reader_length - len(buf)
-        self.__data = self.__data + buf
+        # keep the beginning of the next frame at the start of the buffer.
+        rest = staged - pos
+        if (rest > 0 and pos > 0):
+            staging[:rest] = staging[pos:staged]
+        self.__staged = rest
+
+    def __deliver(self, frame):
+        if (len(frame) > 0):
+            self._data_received(frame)
+
+    def __deliver_batch(self, buffer, start, end):
+        """Deliver, in order, the messages of the batch body buffer[start:end]."""
+        while start < end:
+            length = self.BATCH_ITEM.unpack_from(buffer, start)[0]
+            start += self.BATCH_ITEM.size
+            if (start + length > end):
+                raise NetStringParseError("Batch item overflows its frame.")
+            self.__deliver(bytes(buffer[start:start + length]))
+            start += length
 
-        if self.__reader_length == 0:
-            self._data_received(self.__data)
-            self.__reader_state = self.STATE_END
-        else:
-            print("NET> ",str(self.__reader_length)," bytes still pending")
+    def _data_received(self, data):
+        """Override this to process data."""
+        raise NotImplementedError
 
-    def __do_comma(self):
-        """Process the ending of a message looking for the comma delimiter."""
-        self.__reader_state = self.STATE_LENGTH
-        if self.__buffer[0] != ord(self.DEL_DATA):
-            raise NetStringParseError("Message end expected.")
-        self.__buffer = self.__buffer[1:]
+    def _parse_error(self, error):
+        """Called when the stream can't be framed: nothing that follows can
+        be trusted either. Override this to close the connection."""
+        LOGGER.log(logging.WARNING, "A buggy message have been received: %s" % error)
+        self.reset_state()
 
 # ------------------------------------------------------------------------------------------------
 
-class ClientChannel(asyncore.dispatcher, NetStringTools):
+class ClientChannel(FrameTools, asyncio.BufferedProtocol):
     """Manage the client communication channel with the local node."""
 
+    def __init__(self, channel_map, deliver_callback, accept_callback=None):
+        FrameTools.__init__(self)
+        asyncio.BufferedProtocol.__init__(self)
 
-    """The buffer size used to read from socket."""
-    RECV_SIZE = 65536
-
-    def __init__(self, conn_sock, channel_map, deliver_callback):
-        asyncore.dispatcher.__init__(self, sock=conn_sock, map=channel_map)
-        NetStringTools.__init__(self)
-
-        self._data_to_send = bytes()
         self.__deliver_callback = deliver_callback
+        self.__accept_callback = accept_callback
         self.__channel_map = channel_map
+        self.__transport = None
 
         self.__closed = False
 
-    def readable(self):
-        """Called to determine if this handler should receive information."""
-        return True
-
-    def handle_read(self):
-        """Called when data could be received."""
-        data = self.recv(self.RECV_SIZE)
-        self.recv_data(data)
+    def connection_made(self, transport):
+        """Called when a remote end-point connected to the local node."""
+        self.__transport = transport
+        if (self.__accept_callback != None and not self.__accept_callback(self, transport)):
+            self.handle_close()
+        else:
+            self.__channel_map.add(self)
+            transport.write(self.ANNOUNCE)
 
     def _data_received(self, data):
-        """Called when data have been received."""
+        """Called when a complete message have been received."""
         self.__deliver_callback(data)
 
-    def writable(self):
-        """Called to determine if this handler should send information."""
-        return 0 < len(self._data_to_send)
+    def _parse_error(self, error):
+        FrameTools._parse_error(self, error)
+        self.handle_close()
 
-    def handle_write(self):
-        """Called when data could be sent."""
-        send = self.send(self._data_to_send)
-        self._data_to_send = self._data_to_send[send:]
+    def buffer_updated(self, nbytes):
+        started = time.perf_counter()
+        FrameTools.buffer_updated(self, nbytes)
+        LatencyMetrics.shared().record(STAGE_RECEIVE, "stream", time.perf_counter() - started)
 
-    def _data_send(self, data):
-        """Called when data have to be sent."""
-        self._data_to_send = data
+    def connection_lost(self, exc):
+        """Called when the socket is closed."""
+        self.__closed = True
+        self.__channel_map.discard(self)
 
     def handle_close(self):
-        """Called when the socket is closed."""
+        """Close the channel."""
         if(not self.__closed):
             self.__closed = True
-            self.shutdown(socket.SHUT_RDWR)
-            self.close()
+            self.__transport.close()
+
+    def pause_reading(self):
+        """Stop reading from the socket (the remote end-point soon stops sending)."""
+        if(not self.__closed):
+            self.hold()
+            self.__transport.pause_reading()
+
+    def resume_reading(self):
+        """Read from the socket again."""
+        if(not self.__closed):
+            self.__transport.resume_reading()
+            self.release()
 
 
 class ClientChannelTimed(ClientChannel):
 
-    def __init__(self, conn_sock, channel_map, received_callback):
-        ClientChannel.__init__(self, conn_sock, channel_map, received_callback)
+    def __init__(self, channel_map, received_callback, accept_callback=None):
+        ClientChannel.__init__(self, channel_map, received_callback, accept_callback)
         self.last_received = time.time()
 
     def get_time(self):
@@ -220,13 +304,9 @@ class ClientChannelTimed(ClientChannel):
     def _set_time(self):
         self.last_received = time.time()
 
-    def handle_read(self):
-        self._set_time()
-        ClientChannel.handle_read(self)
-
-    def handle_write(self):
+    def buffer_updated(self, nbytes):
         self._set_time()
-        ClientChannel.handle_write(self)
+        ClientChannel.buffer_updated(self, nbytes)
 
 
 class ClientChannelCleaner(object):
@@ -246,12 +326,16 @@ class ClientChannelCleaner(object):
     def try_clean(self):
         current_time = time.time()
         if(self.TIME_BTW_VERIFY < current_time - self.last_clean):
-            self.__clean(current_time)
-            self.last_clean = current_time
+            self.clean()
+
+    def clean(self):
+        """Close the channels that timed out, right now."""
+        self.last_clean = time.time()
+        self.__clean(self.last_clean)
 
     def __clean(self, reference_time):
         expired_clients = set()
-        for client_channel in self.uncleaned_client.values():
+        for client_channel in self.uncleaned_client:
             if (isinstance(client_channel, ClientChannelTimed)):
                 if (self.timeout < reference_time - client_channel.get_time()):
                     expired_clients.add(client_channel)
@@ -261,146 +345,678 @@ class ClientChannelCleaner(object):
 
 # ------------------------------------------------------------------------------------------------
 
-class InRequestManager(asyncore.dispatcher):
-    """Listens and distributes clients connections management"""
+class InRequestManager(object):
+    """Listens and distributes clients connections management.
 
-    """The time (in second) between dispatching of new events."""
-    LOOP_UPDATE = 0.1       #0.01 # Could still be OK
+    The listening socket and every accepted connection live on the event loop
+    of the MessageDispatcher: decoded messages are handed to the dispatcher on
+    that very loop, without any polling interval or extra thread.
+    """
 
     """The maximum queue length of the server socket."""
     REQUEST_QUEUE_SIZE = 10
 
-    """The type of the server socket."""
-    SOCKET_TYPE = socket.SOCK_STREAM
-
-    def __init__(self, address, dispatcher, handler_class=ClientChannelTimed):
+    def __init__(self, address, dispatcher, handler_class=ClientChannelTimed, datagrams=True):
         """Initializes a server that manage clients' connection."""
-        # Asynchronous task
-        self.channel_map = {}
-        asyncore.dispatcher.__init__(self, map=self.channel_map)
-
         # Server fields
         self.__address = address
         self.__handler_class = handler_class
         self.__dispatcher = dispatcher
+        self.__codec = WireCodec.shared()
+        self.__server = None
+
+        # Datagrams are received on the same address, and delivered alike.
+        self.__datagram_channel = DatagramChannel(self.receiving_complete) if datagrams else None
+
+        # Flow control: the dispatcher pauses us when its queue is full.
+        self.__reading = True
+        dispatcher.add_flow_listener(self)
 
         length = len(address)
-        if(length == 2):
-            self.create_socket(socket.AF_INET, self.SOCKET_TYPE)
-            self.set_reuse_addr()
-        else:
+        if(length != 2):
             raise TypeError()
 
+        # Accepted channels
+        self.channel_map = set()
+
         # Cleaner task
         self.cleaner = ClientChannelCleaner(self.channel_map)
 
     def __repr__(self):
-        return '<InRequestManager %s>'%self.__address
+        return '<InRequestManager %s>'%repr(self.__address)
+
+    @property
+    def address(self):
+        """Return the address the server listens to."""
+        return self.__address
+
+    @property
+    def datagram_channel(self):
+        """Return the DatagramChannel bound to the server address (or None)."""
+        return self.__datagram_channel
 
     def serve_forever(self):
-        """Launches the server proceeding."""
-        self.bind(self.__address)
-        self.listen(self.REQUEST_QUEUE_SIZE)
+        """Launches the server proceeding: runs the dispatcher's event loop
+        with the listening socket registered on it."""
+        self.__dispatcher.dispatch(self.start_serving())
+
+    async def start_serving(self):
+        """Bind and listen on the running event loop."""
+        loop = asyncio.get_running_loop()
+        self.__server = await loop.create_server(
+            self.__create_channel, self.__address[0], self.__address[1],
+            backlog=self.REQUEST_QUEUE_SIZE, reuse_address=True)
         LOGGER.log(logging.DEBUG, "bind: address=%s:%s" % (self.__address[0], self.__address[1]))
+        if (self.__datagram_channel != None):
+            await loop.create_datagram_endpoint(lambda: self.__datagram_channel,
+                                                local_addr=self.__address)
+        loop.call_later(self.cleaner.TIME_BTW_VERIFY, self.__clean_channels, loop)
+
+    def __clean_channels(self, loop):
+        """Close the accepted connections the remote end-point no longer uses."""
+        self.cleaner.clean()
+        loop.call_later(self.cleaner.TIME_BTW_VERIFY, self.__clean_channels, loop)
+
+    def __create_channel(self):
+        return self.__handler_class(self.channel_map, self.receiving_complete, self.handle_accept)
+
+    def handle_accept(self, channel, transport):
+        """Called when a connection have been established with a new remote end-point."""
+        client_address = transport.get_extra_info("peername")
+        if self._verify_access(transport, client_address):
+            LOGGER.debug("conn_made: client_address=%s:%s", client_address[0], client_address[1])
+            if (not self.__reading):
+                transport.pause_reading()
+            return True
+        return False
+
+    def _verify_access(self, transport, client_address):
+        """Indicates if the processing of the request is allowed."""
+        return True
 
-        while True:
-            asyncore.loop(timeout=self.LOOP_UPDATE, map=self.channel_map, count=1)
-            #self.cleaner.try_clean()
+    def receiving_complete(self, raw_msg):
+        """Unpack the request obtained from a client socket. Return False if
+        the dispatcher refused it."""
+        started = time.perf_counter()
+        msg = self.__codec.decode(raw_msg)
+        LatencyMetrics.shared().record_since(STAGE_DECODE, msg, started)
+        return self.__dispatcher.admit(msg)
+
+    def pause_reading(self):
+        """Stop reading from every accepted connection and datagram."""
+        self.__reading = False
+        for channel in list(self.channel_map):
+            channel.pause_reading()
+        if (self.__datagram_channel != None):
+            self.__datagram_channel.pause_reading()
+
+    def resume_reading(self):
+        """Read from the accepted connections and datagrams again."""
+        self.__reading = True
+        for channel in list(self.channel_map):
+            channel.resume_reading()
+        if (self.__datagram_channel != None):
+            self.__datagram_channel.resume_reading()
 
-    def handle_accept(self):
-        """Called when a connection can be established with a new remote end-point."""
-        (client_sock, client_address) = self.accept()
-        if self._verify_access(client_sock, client_address):
-            self.__handler_class(client_sock, self.channel_map, self.receiving_complete)
+# ------------------------------------------------------------------------------------------------
 
-            print("conn_made: client_address=%s:%s" % (client_address[0], client_address[1]))
+class DatagramChannel(asyncio.DatagramProtocol):
+    """Small control messages sent as single UDP datagrams.
 
-    def handle_close(self):
-        """Called when the socket is closed."""
-        self.close()
+    A datagram is a HEADER (DATA, sequence number) followed by a codec frame,
+    and is acknowledged by a HEADER alone (ACK, same sequence number). A
+    datagram that isn't acknowledged within RETRY_DELAY seconds is sent again;
+    after MAX_RETRIES, the 'fallback' given to send() is called so that the
+    message travels over TCP instead. Received messages go to
+    'deliver_callback', as the frames of accepted TCP connections do; those
+    it refuses, or that come while reading is paused, aren't acknowledged.
+    """
 
-    def _verify_access(self, conn_sock, client_address):
-        """Indicates if the processing of the request is allowed."""
-        return True
+    HEADER = struct.Struct(">BI")
 
-    def receiving_complete(self, raw_msg):
-        """Unpack the request obtained from a client socket."""
-        msg = pickle.loads(raw_msg)
-        self.__dispatcher.put(msg)
+    """Kinds of datagram."""
+    DATA, ACK = 0xd1, 0xd2
+
+    """The largest frame sent as a datagram: stays below common path MTUs."""
+    MAX_SIZE = 1200
+
+    RETRY_DELAY = 0.25
+    MAX_RETRIES = 3
+
+    """How long (in seconds) a received (sender, sequence number) pair is kept
+    to drop duplicates: the last retry of the sender, plus some slack."""
+    RECENT_DELAY = MAX_RETRIES * RETRY_DELAY + 1.0
+
+    """How many such pairs are kept at most, however recent."""
+    RECENT_SIZE = 1024
+
+    """How many addresses that acknowledged a datagram are remembered."""
+    REACHED_SIZE = 1024
+
+    def __init__(self, deliver_callback):
+        asyncio.DatagramProtocol.__init__(self)
+        self.__deliver_callback = deliver_callback
+        self.__transport = None
+        self.__seq = random.getrandbits(32)
+        self.__pending = {}     # seq -> [datagram, address, retries, timer, fallback]
+        self.__recent = collections.OrderedDict()   # (address, seq) -> received at, oldest first
+        self.__reached = collections.OrderedDict()  # addresses that acknowledged something, LRU first
+        self.__reading = True
+
+        # Metrics
+        self.sent = 0
+        self.resent = 0
+        self.fallbacks = 0
+        self.received = 0
+        self.duplicates = 0
+        self.refused = 0
+
+    def pause_reading(self):
+        """Leave the datagrams received from now on unacknowledged."""
+        self.__reading = False
+
+    def resume_reading(self):
+        """Accept datagrams again."""
+        self.__reading = True
+
+    def reached(self, address):
+        """Return True if a datagram sent to 'address' was ever acknowledged."""
+        return address in self.__reached
+
+    def send(self, payload, address, fallback):
+        """Send an encoded message to 'address'; 'fallback' is called if it doesn't get through."""
+        if (self.__transport == None):
+            fallback()
+            return
+        self.__seq = (self.__seq + 1) & 0xffffffff
+        datagram = self.HEADER.pack(self.DATA, self.__seq) + payload
+        timer = asyncio.get_running_loop().call_later(self.RETRY_DELAY, self.__retry, self.__seq)
+        self.__pending[self.__seq] = [datagram, address, 0, timer, fallback]
+        self.__transport.sendto(datagram, address)
+        self.sent += 1
+
+    def __retry(self, seq):
+        pending = self.__pending[seq]
+        datagram, address, retries, timer, fallback = pending
+        if (retries >= self.MAX_RETRIES):
+            del self.__pending[seq]
+            self.fallbacks += 1
+            LOGGER.debug("no ack from %s for datagram %i, falling back" % (repr(address), seq))
+            fallback()
+            return
+        pending[2] = retries + 1
+        pending[3] = asyncio.get_running_loop().call_later(self.RETRY_DELAY, self.__retry, seq)
+        self.__transport.sendto(datagram, address)
+        self.resent += 1
+
+    def connection_made(self, transport):
+        self.__transport = transport
+
+    def datagram_received(self, data, address):
+        if (len(data) < self.HEADER.size):
+            return
+        kind, seq = self.HEADER.unpack_from(data)
+        if (kind == self.ACK):
+            pending = self.__pending.pop(seq, None)
+            if (pending != None):
+                pending[3].cancel()
+                self.__reached[pending[1]] = None
+                self.__reached.move_to_end(pending[1])
+                if (len(self.__reached) > self.REACHED_SIZE):
+                    self.__reached.popitem(last=False)
+        elif (kind == self.DATA):
+            started = time.perf_counter()
+            key = (address, seq)
+            if (key in self.__recent):
+                self.duplicates += 1   # our ack was lost.
+            elif (not self.__reading):
+                self.refused += 1
+                return
+            else:
+                try:
+                    if (self.__deliver_callback(data[self.HEADER.size:]) == False):
+                        self.refused += 1
+                        return
+                except Exception as e:
+                    LOGGER.error(">_< Couldn't read datagram from %s, reason: %s" % (repr(address), e))
+                    return
+                self.received += 1
+                self.__remember(key)
+                LatencyMetrics.shared().record(STAGE_RECEIVE, "datagram", time.perf_counter() - started)
+            self.__transport.sendto(self.HEADER.pack(self.ACK, seq), address)
+
+    def __remember(self, key):
+        """Keep 'key' to drop its duplicates, forgetting the expired ones."""
+        now = time.time()
+        recent = self.__recent
+        recent[key] = now
+        limit = now - self.RECENT_DELAY
+        while (recent and (len(recent) > self.RECENT_SIZE or next(iter(recent.values())) <= limit)):
+            recent.popitem(last=False)
+
+    def error_received(self, exc):
+        # e.g. the peer has no datagram socket: the retries will fall back on TCP.
+        LOGGER.debug("datagram error: %s" % exc)
+
+    def connection_lost(self, exc):
+        self.__transport = None
+        for datagram, address, retries, timer, fallback in self.__pending.values():
+            timer.cancel()
+            fallback()
+        self.__pending.clear()
 
 # ------------------------------------------------------------------------------------------------
 
-class OutRequestManager(object):
-    """This managed clients' connections."""
+class SpillFile(object):
+    """Frames set aside on disk when an outgoing queue overflows, read back
+    in the order they were written."""
+
+    def __init__(self):
+        self.__file = tempfile.TemporaryFile()
+        self.__lengths = collections.deque()
+        self.__read_pos = 0
+        self.__write_pos = 0
+
+    def __len__(self):
+        return len(self.__lengths)
+
+    def push(self, frame):
+        self.__file.seek(self.__write_pos)
+        self.__file.write(frame)
+        self.__write_pos += len(frame)
+        self.__lengths.append(len(frame))
+
+    def pop(self):
+        length = self.__lengths.popleft()
+        self.__file.seek(self.__read_pos)
+        frame = self.__file.read(length)
+        self.__read_pos += length
+        if (len(self.__lengths) == 0):
+            # everything has been read back: reuse the file from its start.
+            self.__file.truncate(0)
+            self.__read_pos = self.__write_pos = 0
+        return frame
+
+    def close(self):
+        self.__file.close()
+
+
+class PeerChannel(asyncio.Protocol):
+    """An outgoing connection towards one node.
+
+    Encoded messages wait in a bounded queue and are framed and handed to the
+    transport only while it accepts more data: the transport reports
+    write-readiness through pause_writing()/resume_writing() and retries partial
+    writes itself, so the dispatcher never waits for a slow peer. What happens
+    when the queue is full is decided by the overflow policy (see
+    OutRequestManager).
+
+    Header and payload are given to the transport as separate buffers
+    (writelines), and binary frames are used once the node announced it
+    accepts them (see FrameTools). Messages are not written as soon as they
+    are queued, but by a flush scheduled at the end of the current loop
+    iteration, or 'coalesce_window' microseconds later: when the node accepts
+    batch frames, every message queued meanwhile goes in a single frame.
+    """
+
+    """Overflow policies."""
+    OVERFLOW_DROP, OVERFLOW_BLOCK, OVERFLOW_SPILL = range(3)
+
+    """The amount of bytes the transport may buffer before pausing us."""
+    WRITE_HIGH_WATER = 64 * 1024
+
+    """The most bytes of messages put in one batch frame."""
+    BATCH_SIZE = 256 * 1024
+
+    def __init__(self, manager, node, queue_size, overflow, coalesce_window=0):
+        asyncio.Protocol.__init__(self)
+        self.__manager = manager
+        self.__node = node
+        self.__loop = None
+        self.__transport = None
+        self.__writable = False
+        self.__binary = False   # the node accepts binary frames
+        self.__batch = False    # the node accepts batch frames
+        self.__coalesce_window = coalesce_window
+        self.__flush_handle = None
+
+        # Outgoing queue
+        self.__queue = collections.deque()
+        self.__queue_size = queue_size
+        self.__overflow = overflow
+        self.__spill = None
+        self.__room = None      # future awaited by blocked producers
+
+        # Metrics
+        self.dropped = 0
+        self.spilled = 0
+        self.frames = 0
+        self.messages = 0
+        self.last_used = time.time()
+
+        self.__closed = False
+
+    #
+    # Properties
+
+    @property
+    def node(self):
+        """Return the latest Node object the connection was used for."""
+        return self.__node
 
-    def __init__(self, local_node):
-        self.__connections = {}
+    @node.setter
+    def node(self, value):
+        """Set the Node object the connection reports failures for."""
+        self.__node = value
+
+    @property
+    def depth(self):
+        """Return the number of messages waiting to be written."""
+        return len(self.__queue) + (len(self.__spill) if self.__spill != None else 0)
+
+    @property
+    def is_full(self):
+        """Return True when the queue reached its limit."""
+        return len(self.__queue) >= self.__queue_size
+
+    def connect(self, loop):
+        """Start connecting to the node (the connection completes on 'loop')."""
+        self.__loop = loop
+        loop.create_task(self.__connect(loop))
+
+    async def __connect(self, loop):
+        address = self.__node.net_info.get_address()
+        try:
+            await loop.create_connection(lambda: self, address[0], address[1])
+        except OSError as e:
+            LOGGER.error(">_< Couldn't connect to %s, reason: %s" % (repr(address), e))
+            self.connection_lost(e)
+
+    def send(self, payload):
+        """Queue an encoded message, applying the overflow policy if the queue is full."""
+        self.last_used = time.time()
+        if (self.__spill != None and len(self.__spill) > 0):
+            # messages are already on disk: keep them in order.
+            self.__spill.push(payload)
+            self.spilled += 1
+        elif (not self.is_full):
+            self.__queue.append(payload)
+        elif (self.__overflow == self.OVERFLOW_SPILL):
+            if (self.__spill == None):
+                self.__spill = SpillFile()
+            self.__spill.push(payload)
+            self.spilled += 1
+        elif (self.__overflow == self.OVERFLOW_BLOCK):
+            # accepted anyway, the dispatcher waits for room before going on.
+            self.__queue.append(payload)
+        else:
+            self.dropped += 1
+            LOGGER.warning(">_< outgoing queue to %s is full, message dropped" % self.__node.name_id)
+        self.__schedule_flush()
+
+    async def wait_room(self):
+        """Wait until the queue is below its limit."""
+        while (self.is_full and not self.__closed):
+            if (self.__room == None):
+                self.__room = asyncio.get_running_loop().create_future()
+            await self.__room
+
+    def __schedule_flush(self):
+        if (self.__flush_handle == None and self.__writable):
+            if (self.__coalesce_window > 0):
+                self.__flush_handle = self.__loop.call_later(self.__coalesce_window / 1e6, self.__flush)
+            else:
+                self.__flush_handle = self.__loop.call_soon(self.__flush)
+
+    def __pop(self):
+        payload = self.__queue.popleft()
+        if (self.__spill != None and len(self.__spill) > 0):
+            self.__queue.append(self.__spill.pop())
+        return payload
+
+    def __flush(self):
+        """Hand queued messages to the transport while it is writable."""
+        if (self.__flush_handle != None):
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+        while (self.__writable and self.__queue):
+            if (self.__batch and len(self.__queue) > 1):
+                batch = [self.__pop()]
+                size = len(batch[0])
+                while (self.__queue and size + len(self.__queue[0]) <= self.BATCH_SIZE):
+                    batch.append(self.__pop())
+                    size += len(batch[-1])
+                self.__transport.writelines(FrameTools.format_batch(batch))
+                self.messages += len(batch)
+            else:
+                self.__transport.writelines(FrameTools.format_data(self.__pop(), self.__binary))
+                self.messages += 1
+            self.frames += 1
+        if (not self.is_full):
+            self.__wake_producers()
+
+    def __wake_producers(self):
+        if (self.__room != None):
+            if (not self.__room.done()):
+                self.__room.set_result(None)
+            self.__room = None
+
+    def connection_made(self, transport):
+        self.__transport = transport
+        transport.set_write_buffer_limits(high=self.WRITE_HIGH_WATER)
+        self.__writable = True
+        self.__flush()
+
+    def pause_writing(self):
+        self.__writable = False
+
+    def resume_writing(self):
+        self.__writable = True
+        self.__flush()
+
+    def data_received(self, data):
+        # In this system the outgoing connection can't receive normal message,
+        # only the announce that binary frames are accepted.
+        if (FrameTools.BINARY_MARK in data):
+            self.__binary = True
+        if (FrameTools.BATCH_MARK in data):
+            self.__batch = True
+
+    def connection_lost(self, exc):
+        if(not self.__closed):
+            self.__closed = True
+            self.__manager.node_disconnected(self.__node, self)
+
+    def close(self):
+        """Close the connection (without reporting the node as failed)."""
+        self.__closed = True
+        self.__writable = False
+        if (self.__flush_handle != None):
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+        self.__wake_producers()
+        if (self.__spill != None):
+            self.__spill.close()
+        if (self.__transport != None):
+            self.__transport.close()
+
+
+class OutRequestManager(object):
+    """This managed clients' connections.
+
+    Connections are PeerChannel objects living on the dispatcher's event loop,
+    that is to say send_msg must be called from the dispatcher. Each of them
+    holds at most 'queue_size' frames in memory; beyond that, 'overflow' tells
+    whether new frames are dropped (OVERFLOW_DROP), written to a temporary file
+    (OVERFLOW_SPILL), or accepted while the dispatcher waits in drained() for
+    the queue to shrink (OVERFLOW_BLOCK). Messages for the same node queued
+    within 'coalesce_window' microseconds (0: within the same loop iteration)
+    share one frame.
+
+    Connections are pooled by network address, so that a Node object replaced
+    after a CPE or partition id update keeps using the same socket. At most
+    'max_connections' are kept open: opening one more closes the least
+    recently used connection that has nothing left to send. Connections that
+    haven't been used for 'idle_timeout' seconds are closed as well.
+
+    Once use_datagrams() was called, the messages that allow it (see
+    RouteMessage.datagram) and are small enough skip the connection and go
+    through the DatagramChannel, unless the node never acknowledged one.
+    """
+
+    OVERFLOW_DROP = PeerChannel.OVERFLOW_DROP
+    OVERFLOW_BLOCK = PeerChannel.OVERFLOW_BLOCK
+    OVERFLOW_SPILL = PeerChannel.OVERFLOW_SPILL
+
+    """The default amount of frames queued for one node."""
+    DEFAULT_QUEUE_SIZE = 256
+
+    """The default amount of outgoing connections kept open."""
+    DEFAULT_MAX_CONNECTIONS = 64
+
+    """The default time after which an unused connection is closed."""
+    DEFAULT_IDLE_TIMEOUT = 5 * 60
+
+    def __init__(self, local_node, queue_size=DEFAULT_QUEUE_SIZE, overflow=OVERFLOW_DROP,
+                 coalesce_window=0, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.__connections = collections.OrderedDict()  # address -> PeerChannel, LRU first
         self.__local_node = local_node
+        self.__codec = WireCodec.shared()
+        self.__idle_handle = None
+        self.__datagram_channel = None
+        self.__no_datagram = set()  # addresses that didn't answer datagrams
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.coalesce_window = coalesce_window
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+
+        # Pool metrics
+        self.hits = 0
+        self.opened = 0
+        self.evicted = 0
+        self.expired = 0
 
     def send_msg(self, msg, dst_node):
         """Send a message to a destination node (ISA NetNodeInfo).
     destination is usually the 'next hop' in a (hop, message pair)
     as returned by the 'routing visitor'.
         """
-        client_socket=False
+        started = time.perf_counter()
         try:
-            #LOGGER.log(logging.DEBUG, "%s to %s" %
-            #           (repr(msg), dst_node.net_info.__repr__()))
-            payload = pickle.dumps(msg)
-            net_string_msg = NetStringTools().format_data(payload)
-            # fix1181403
-  
-            client_socket = self.__get_connection(dst_node)
-            if (len(net_string_msg)>8192):
-                print("NET> large message ahead: turns blocking on")
-                client_socket.setblocking(True)
-
-            if (self.__is_online(client_socket)):
-                client_socket.sendall(net_string_msg)
-            else:
-                self.node_disconnected(dst_node)
-                LOGGER.error(">_< : Connection is not online !")
-                
-        except BaseException as e:
-            #TOOD: Add Timeout management.            
+            payload = self.__codec.encode(msg)
+            if (self.__datagram_channel != None and msg.datagram and
+                len(payload) <= DatagramChannel.MAX_SIZE):
+                address = self.__address(dst_node)
+                if (address not in self.__no_datagram):
+                    self.__datagram_channel.send(payload, address,
+                                                 lambda: self.__datagram_failed(dst_node, payload))
+                    LatencyMetrics.shared().record_since(STAGE_SEND, msg, started)
+                    return
+            self.__get_connection(dst_node).send(payload)
+            LatencyMetrics.shared().record_since(STAGE_SEND, msg, started)
+
+        except Exception as e:
             LOGGER.error(">_< Couldn't send %s, reason: %s"%(msg,e))
-            self.__del_connection(dst_node)
-            import pdb;pdb.set_trace()
-            if (client_socket!=False):
-                client_socket.setblocking(False)
+            self.__del_connection(self.__address(dst_node))
 
-    def node_disconnected(self, disconnected_node):
+    def use_datagrams(self, channel):
+        """Send small control messages through 'channel' (a DatagramChannel)."""
+        self.__datagram_channel = channel
+
+    def __datagram_failed(self, node, payload):
+        """Send over TCP a message whose datagram wasn't acknowledged."""
+        address = self.__address(node)
+        if (not self.__datagram_channel.reached(address)):
+            self.__no_datagram.add(address)
+        try:
+            self.__get_connection(node).send(payload)
+        except Exception as e:
+            LOGGER.error(">_< Couldn't send to %s, reason: %s"%(repr(address),e))
+            self.__del_connection(address)
+
+    async def drained(self):
+        """Wait until no outgoing queue is over its limit."""
+        if (self.overflow == self.OVERFLOW_BLOCK):
+            for channel in list(self.__connections.values()):
+                await channel.wait_room()
+
+    def queue_depths(self):
+        """Return the number of frames waiting for each node."""
+        return dict((channel.node, channel.depth) for channel in list(self.__connections.values()))
+
+    def pool_stats(self):
+        """Return the pool metrics: open connections, hit rate and churn."""
+        requests = self.hits + self.opened
+        return {
+            "open": len(self.__connections),
+            "hits": self.hits,
+            "opened": self.opened,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "hit_rate": float(self.hits) / requests if requests > 0 else 1.0,
+            }
+
+    def node_disconnected(self, disconnected_node, channel=None):
         """Mark a node as disconnected."""
-        self.__del_connection(disconnected_node)
-        self.__local_node.node_fail(disconnected_node)
-
-    def __is_online(self, conn_sock):
-        """Verify if the socket is still online."""
-        result = True
-        res = select.select([conn_sock], [conn_sock], [conn_sock], 0.5)
-        if(0 < len(res[0])):
-            # The idea is that connection that have been close will receive an empty message.
-            # In this system the outgoing connection can't receive normal message.
-            response = conn_sock.recv(1024)
-            result = (len(response) != 0)
-        return result
+        address = self.__address(disconnected_node)
+        if (channel == None or self.__connections.get(address) is channel):
+            self.__del_connection(address)
+            self.__local_node.node_fail(disconnected_node)
+
+    @staticmethod
+    def __address(node):
+        return tuple(node.net_info.get_address())
 
     def __get_connection(self, node):
         """Get a connection (or create it if it doesn't exists)."""
-        if (node not in self.__connections):
-            client_socket = node.net_info.get_socket()
-            client_socket.connect(node.net_info.get_address())
-            client_socket.setblocking(False)
-
-            self.__connections[node] = client_socket
-
-        return self.__connections[node]
-
-    def __del_connection(self, node):
+        address = self.__address(node)
+        channel = self.__connections.get(address)
+        if (channel != None):
+            self.hits += 1
+            self.__connections.move_to_end(address)
+            channel.node = node
+            return channel
+
+        if (len(self.__connections) >= self.max_connections):
+            self.__evict()
+        loop = self.__local_node.dispatcher.loop
+        channel = PeerChannel(self, node, self.queue_size, self.overflow, self.coalesce_window)
+        self.__connections[address] = channel
+        self.opened += 1
+        channel.connect(loop)
+        if (self.__idle_handle == None and self.idle_timeout > 0):
+            self.__idle_handle = loop.call_later(self.idle_timeout, self.__close_idle)
+        return channel
+
+    def __evict(self):
+        """Close the least recently used connection that has nothing to send."""
+        for address, channel in self.__connections.items():
+            if (channel.depth == 0):
+                LOGGER.debug("closing connection to %s: pool is full" % repr(address))
+                self.__del_connection(address)
+                self.evicted += 1
+                return
+        LOGGER.warning(">_< %i connections open, none of them idle" % len(self.__connections))
+
+    def __close_idle(self):
+        """Close the connections left unused for idle_timeout, then check again later."""
+        self.__idle_handle = None
+        limit = time.time() - self.idle_timeout
+        for address, channel in list(self.__connections.items()):
+            if (channel.last_used > limit):
+                break   # the most recently used ones come last.
+            if (channel.depth == 0):
+                LOGGER.debug("closing idle connection to %s" % repr(address))
+                self.__del_connection(address)
+                self.expired += 1
+        if (len(self.__connections) > 0):
+            self.__idle_handle = self.__local_node.dispatcher.loop.call_later(
+                self.idle_timeout / 2, self.__close_idle)
+
+    def __del_connection(self, address):
         """Remove a connection."""
-        if (node in self.__connections):
-            client_socket = self.__connections[node]
-            client_socket.shutdown(socket.SHUT_RDWR)
-            client_socket.close()
-
-            del self.__connections[node]
+        channel = self.__connections.pop(address, None)
+        if (channel != None):
+            channel.close()
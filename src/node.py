@@ -6,6 +6,7 @@ import threading
 import logging
 
 # ResumeNet imports
+from logpipe import LogPipe
 from equation import CPE
 from equation import DataStore
 from join import NeighbourhoodNet, SNJoinRequest
@@ -18,8 +19,7 @@ from network import OutRequestManager
 from neighbourhood import Neighbourhood
 
 # Module log abilities
-LOG_HANDLER = logging.StreamHandler()
-LOG_HANDLER.setLevel(logging.DEBUG)
+LOG_HANDLER = LogPipe.shared().handler
 
 LOGGER = logging.getLogger("localevent")
 LOGGER.setLevel(logging.DEBUG)
@@ -102,6 +102,7 @@ class Node(object):
         self.__name_id = name_id                    #SkipNet "Name identifier"
         self.__numeric_id = numeric_id              #SkipNet "Numeric identifier"
         self.__net_info = net_info                  #Interface to network layer                
+        self.__set_identity()                       #What makes two Node copies "the same node"
 
         partition_id = PartitionID.gen()
         self.__partition_id = partition_id          #SkipTree "Partition identifier" (this Node among the Partition Tree)
@@ -120,6 +121,29 @@ class Node(object):
         self.__pending=[]   # messages waiting to be delivered.
         #self.__status_up.start()
 
+    @classmethod
+    def remote(cls, name_id, numeric_id, net_info, partition_id, cpe=None):
+        """Build the local copy of a node running in another process.
+
+        Like an unpickled Node, it has no dispatcher, sender, neighbourhood
+        nor data store."""
+        node = cls.__new__(cls)
+        node.__name_id = name_id
+        node.__numeric_id = numeric_id
+        node.__net_info = net_info
+        node.__set_identity()
+        node.__partition_id = partition_id
+        node.__cpe = cpe if cpe != None else CPE()
+        node.__data_store = None
+        node.__dispatcher = None
+        node.__send = None
+        node.__neighbourhood = None
+        node.__status_up = None
+        node.__running_op = None
+        node.__major_state = None
+        node.__pending = []
+        return node
+
     #
     # Properties
     @property
@@ -147,9 +171,17 @@ class Node(object):
         """Return the "Name identifier" of the Node."""
         return self.__name_id
 
-    @name_id.setter
-    def name_id(self,value):
-        self.__name_id=value
+    @property
+    def identity(self):
+        """Return the immutable key (name identifier, address) of the Node.
+
+        Copies of a Node that only differ by their CPE, partition or numeric
+        identifier share the same identity."""
+        return self.__identity
+
+    def __set_identity(self):
+        self.__identity = (self.__name_id, self.__net_info.get_address())
+        self.__identity_hash = hash(self.__identity)
 
     @property
     def numeric_id(self):
@@ -268,13 +300,15 @@ class Node(object):
         """hold a message until a node is updated (new CPE)
            message must be for the RouteVisitor, not app message"""
         self.__pending.append(message)
-        message.sign("queued until %s is updated"%(self.pname))
+        if (message.traced):
+            message.sign("queued until %s is updated", self.pname)
 
     # neighbourhood replaces one instance of Node by the one in SNPingMessage
     #  during routing table (skipnet) update. That's when this one is called.
     def postprocess(self, lnode):
         for m in self.__pending:
-            m.sign("released after update of %s"%(self.pname))
+            if (m.traced):
+                m.sign("released after update of %s", self.pname)
             lnode.route_internal(m)
         self.__pending=[] # they've all been unlocked.
 
@@ -296,23 +330,25 @@ class Node(object):
     # Default comparison
 
     def __lt__(self, other):
-        less = self.name_id < other.name_id
-        less &= self.numeric_id < other.numeric_id
-        less &= self.partition_id < other.partition_id
-        less &= self.net_info < other.net_info
-        return less
+        # by address first: a contact only known by its address (see join())
+        #   has no name identifier to compare.
+        name, address = self.__identity
+        other_name, other_address = other.__identity
+        if (address != other_address):
+            return address < other_address
+        if (name is None or other_name is None):
+            return name is None and other_name is not None
+        return name < other_name
 
     def __le__(self, other):
         return self.__lt__(other) or self.__eq__(other)
 
     def __eq__(self, other):
-        if(other == None):
+        if(self is other):
+            return True
+        if(other is None):
             return False
-        equality = self.name_id == other.name_id
-        equality &= self.numeric_id == other.numeric_id
-        equality &= self.partition_id == other.partition_id
-        equality &= self.net_info == other.net_info
-        return equality
+        return self.__identity_hash == other.__identity_hash and self.__identity == other.__identity
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -324,7 +360,7 @@ class Node(object):
         return not self.__lt__(other) or self.__eq__(other)
 
     def __hash__(self):
-        return self.name_id.__hash__() * self.numeric_id.__hash__() * self.partition_id.__hash__() * self.net_info.__hash__()
+        return self.__identity_hash
 
     #
     # Define special pickling behaviour.
@@ -343,9 +379,15 @@ class Node(object):
         state['_Node__running_op'] = None
         state['_Node__major_state'] = None
         state['_Node__pending'] = []
+        # str hashes differ from one process to another.
+        del state['_Node__identity_hash']
 
         return state
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__identity_hash = hash(self.__identity)
+
 
 class NodeStatusPublisher(threading.Thread):
     """Regularly publish the status of a node."""
@@ -384,13 +426,10 @@ class NodeStatusPublisher(threading.Thread):
     def __update_status(self):
         """Ping current neighbours and repair locals rings."""
         neighbourhood = self.__local_node.neighbourhood
-        nb_ring_level = neighbourhood.nb_ring
         neighbourhood.sign("update_status()")
 
-        print("0_0 updating rings: ",nb_ring_level);
-        for ring_level in range(nb_ring_level):
-            # Say that the node is still in life.
-            ring = neighbourhood.get_ring(ring_level)
-            NeighbourhoodNet.ping_ring(self.__local_node, ring, ring_level)
+        print("0_0 updating rings: ",len(neighbourhood.levels));
+        # Say that the node is still in life, once to each neighbour.
+        NeighbourhoodNet.ping_leafset(self.__local_node, neighbourhood)
 
         NeighbourhoodNet.fix_from_level(self.__local_node, 0)
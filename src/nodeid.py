@@ -1,7 +1,10 @@
 # System imports
+import fractions
 import hashlib
 import os
 import random
+import threading
+import weakref
 
 # ResumeNet imports
 from util import Direction
@@ -11,6 +14,8 @@ from util import Direction
 
 class NodeID(object):
 
+    __slots__ = ()
+
     @staticmethod
     def lies_between_direction(direction, a, b, c, wrap):
         """Determine if b is located between a and c, when going in some direction.
@@ -35,10 +40,29 @@ class NodeID(object):
 
 
 class NameID(NodeID):
-    """This class represents a name identifier."""
-
-    def __init__(self, name):
-        self.__name = name
+    """This class represents a name identifier.
+
+    Name identifiers are interned: building a NameID for a name that is already
+    known returns the existing object, so that equality is usually decided by
+    identity. The encoded name and the hash are computed once.
+    """
+
+    __slots__ = ("__name", "__encoded", "__hash", "__weakref__")
+
+    # name -> NameID, only while someone still holds the NameID.
+    __interned = weakref.WeakValueDictionary()
+    __interning = threading.Lock()
+
+    def __new__(cls, name):
+        with NameID.__interning:
+            name_id = NameID.__interned.get(name)
+            if(name_id == None):
+                name_id = object.__new__(cls)
+                name_id.__name = name
+                name_id.__encoded = name.encode("utf8")
+                name_id.__hash = hash(name)
+                NameID.__interned[name] = name_id
+        return name_id
 
     #
     # Properties
@@ -47,17 +71,25 @@ class NameID(NodeID):
     def name(self):
         return self.__name
 
+    @property
+    def encoded(self):
+        """Return the UTF-8 encoding of the name."""
+        return self.__encoded
+
     def get_longest_prefix_length(self, alt):
-        """Return the length of the longest common prefix."""
-        length, up_bound = 0, min(len(self), len(alt))
-        for i in range(up_bound):
-            if(self.name[i] != alt.name[i]):
-                break
-            else:
-                length += 1
+        """Return the length of the longest common prefix (in bytes).
+
+        The prefix is found by comparing both encoded names as big integers:
+        the highest differing bit tells the first differing byte.
+        """
+        a, b = self.__encoded, alt.__encoded
+        up_bound = min(len(a), len(b))
+        diff = int.from_bytes(a[:up_bound], "big") ^ int.from_bytes(b[:up_bound], "big")
+        if(diff == 0):
+            return up_bound
+        length = up_bound - 1 - (diff.bit_length() - 1) // 8
         # tie-breaking useful when 3 names have no common prefix.
-        length+=abs(ord(self.name[i])-ord(alt.name[i]))/1024
-        return length
+        return length + abs(a[length] - b[length]) / 1024
 
     #
     # Overwritten    
@@ -75,48 +107,60 @@ class NameID(NodeID):
     # Default comparison
 
     def __lt__(self, other):
-        return self.name < other.name
+        return self.__name < other.name
 
     def __le__(self, other):
-        return self.__lt__(other) or self.__eq__(other)
+        return self is other or self.__name <= other.name
 
     def __eq__(self, other):
-        if(other == None):
+        if(self is other):
+            return True
+        if(other is None or other.__class__ is not NameID):
             return False
-        return self.name == other.name
+        return self.__name == other.__name
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __gt__(self, other):
-        return not self.__lt__(other) and not self.__eq__(other)
+        return self.__name > other.name
 
     def __ge__(self, other):
-        return not self.__lt__(other) or self.__eq__(other)
+        return self is other or self.__name >= other.name
 
     def __hash__(self):
-        return self.__name.__hash__()
+        return self.__hash
+
+    #
+    # Pickling goes through the interning table again.
+
+    def __reduce__(self):
+        return (NameID, (self.__name,))
 
 
 class NumericID(NodeID):
-    """This represents a numeric identifier."""
+    """This represents a numeric identifier.
+
+    The identifier is kept as a single integer together with its width in bits,
+    so that digit access, comparisons and prefix computation are plain integer
+    operations. Digit 0 is the most significant bit.
+    """
+
+    __slots__ = ("__value", "__nb_digit", "__hash")
 
     RANDOM_STRING = 1024
     HASH_ALGO = "md5"
 
-    def __init__(self, id_seed=None, hash=False):
-        self.m_bytes = []
+    def __init__(self, id_seed=None, hash=False, nb_digit=None):
         if(id_seed == None):
-            bytes_tmp = self.__hash_bytes(os.urandom(self.RANDOM_STRING))
-            self.__set_from_bytes(bytes_tmp)
+            self.__set_from_bytes(self.__hash_bytes(os.urandom(self.RANDOM_STRING)))
+        elif(isinstance(id_seed, int)):
+            self.__set_from_int(id_seed, nb_digit)
+        elif(hash):
+            self.__set_from_bytes(self.__hash_bytes(id_seed.encode()))
         else:
-            if(hash):
-                bytes_tmp = self.__hash_bytes(id_seed.encode())
-                self.__set_from_bytes(bytes_tmp)
-            else:
-                m_int = int(id_seed, 16)
-                self.__set_from_int(m_int)
-
+            self.__set_from_int(int(id_seed, 16), nb_digit)
+        self.__hash = int.__hash__(self.__value)   # "hash" is shadowed here
 
     def __hash_bytes(self, bytes_seed):
         """Get hash from bytes."""
@@ -126,14 +170,19 @@ class NumericID(NodeID):
 
     def __set_from_bytes(self, p_bytes):
         """Set numeric id from bytes."""
-        for i in range(len(p_bytes)):
-            self.m_bytes.append(BitifiedByte(p_bytes[i]))
-
-    def __set_from_int(self, p_int):
-        """Set numeric id from integer."""
-        factors = self._dec_to_factors_of_base(256, p_int)
-        for i in range(len(factors)):
-            self.m_bytes.append((BitifiedByte(factors[i])))
+        self.__value = int.from_bytes(p_bytes, "big")
+        self.__nb_digit = len(p_bytes) * 8
+
+    def __set_from_int(self, p_int, nb_digit=None):
+        """Set numeric id from integer (using as many whole bytes as needed by default)."""
+        if(p_int < 0):
+            raise ValueError("A numeric ID can't be negative.")
+        if(nb_digit == None):
+            nb_digit = max(1, (p_int.bit_length() + 7) // 8) * 8
+        elif(p_int.bit_length() > nb_digit):
+            raise ValueError("%x doesn't fit in %i digits." % (p_int, nb_digit))
+        self.__value = p_int
+        self.__nb_digit = nb_digit
 
     @staticmethod
     def _dec_to_factors_of_base(base, number):
@@ -154,37 +203,44 @@ class NumericID(NodeID):
 
     def get_digit(self, index):
         """Return the index'th digit."""
-        return self.m_bytes[index // 8][index % 8]
+        if(not 0 <= index < self.__nb_digit):
+            raise IndexError("digit %i out of %i" % (index, self.__nb_digit))
+        return (self.__value >> (self.__nb_digit - 1 - index)) & 1
 
     def get_nb_digit(self):
         """Return the number of digits in the numeric ID."""
-        return len(self.m_bytes) * 8
+        return self.__nb_digit
 
     def get_numeric_id_hex(self):
         """Return a hex representation of the numeric ID."""
-        id_hex = ""
-        for i in range(len(self.m_bytes)):
-            id_hex += str(self.m_bytes[i])
-        return id_hex
+        return "%0*x" % (self.__nb_digit // 4, self.__value)
 
     #
     #
 
     def get_longest_prefix_length(self, numeric_id):
-        """Return the length of the longest common prefix."""
-        length, up_bound = 0, max(self.get_nb_digit(), numeric_id.get_nb_digit())
-        for i in range(up_bound):
-            if(self.get_digit(i) != numeric_id.get_digit(i)):
-                break
+        """Return the length of the longest common prefix.
+
+        Identifiers of different width are compared left-aligned.
+        """
+        a, b = self.__value, numeric_id.__value
+        width = self.__nb_digit
+        if(width != numeric_id.__nb_digit):
+            if(width < numeric_id.__nb_digit):
+                a <<= numeric_id.__nb_digit - width
+                width = numeric_id.__nb_digit
             else:
-                length += 1
-        return length
+                b <<= width - numeric_id.__nb_digit
+        return width - (a ^ b).bit_length()
 
     #
     # Overwritten 
 
     def __int__(self):
-        return int(self.get_numeric_id_hex(), 16)
+        return self.__value
+
+    def __index__(self):
+        return self.__value
 
     def __repr__(self):
         return "<NumID::" + self.get_numeric_id_hex() + ">"
@@ -193,27 +249,35 @@ class NumericID(NodeID):
     # Default comparison
 
     def __lt__(self, other):
-        return int(self) < int(other)
+        return self.__value < int(other)
 
     def __le__(self, other):
-        return self.__lt__(other) or self.__eq__(other)
+        return self.__value <= int(other)
 
     def __eq__(self, other):
-        if(other == None):
+        if(other is None):
             return False
-        return int(self) == int(other)
+        if(other.__class__ is NumericID):
+            return self.__value == other.__value
+        return self.__value == int(other)
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __gt__(self, other):
-        return not self.__lt__(other) and not self.__eq__(other)
+        return self.__value > int(other)
 
     def __ge__(self, other):
-        return not self.__lt__(other) or self.__eq__(other)
+        return self.__value >= int(other)
 
     def __hash__(self):
-        return int(self)
+        return self.__hash
+
+    #
+    # Pickling: only the value and its width travel.
+
+    def __reduce__(self):
+        return (NumericID, (self.__value, False, self.__nb_digit))
 
 
 class BitifiedByte(object):
@@ -268,8 +332,6 @@ class BitifiedByte(object):
         return string
 
 
-import sys
-
 class PartitionID(NodeID):
     """ Each node is assigned a random partition ID (PID) when it is created.
         upon joining another node, it will receive a new one (join_partition_id)
@@ -277,23 +339,65 @@ class PartitionID(NodeID):
 
         compute_partition_id then takes into account the welcoming node's PID,
         it's immediate neighbour PID and the neighbour's direction in order
-        to generate an appropriate (random) PID in the desired area.
+        to generate an appropriate PID in the desired area.
+
+        A PID is a binary fraction of unbounded length: numerator / 2**bits,
+        kept in lowest terms. Splitting between two PIDs takes their exact
+        midpoint, which costs at most one more bit, so a region can be split
+        again and again without running out of room. The nearest float is
+        kept alongside and decides most comparisons on its own.
+        PIDs mix freely with ints and floats in comparisons and additions
+        (see PidRange, which linearizes the circle over -1..2).
         """
-    LOW, UP = 0.0, 1.0
 
-    EPSILON = sys.float_info.epsilon
+    __slots__ = ("__numerator", "__bits", "__approx", "__hash")
+
+    """The number of random bits of a PID picked by gen()."""
+    RANDOM_BITS = 32
+
+    def __init__(self, numerator=0, bits=0):
+        if(numerator == 0):
+            bits = 0
+        elif(bits > 0):
+            # lowest terms: drop trailing zero bits of the numerator.
+            shift = min(bits, (numerator & -numerator).bit_length() - 1)
+            numerator >>= shift
+            bits -= shift
+        self.__numerator = numerator
+        self.__bits = bits
+        self.__approx = numerator / (1 << bits)
+        self.__hash = None
+
+    @staticmethod
+    def from_value(value):
+        """Return the PID that is exactly equal to a PID, an int or a float."""
+        if(value.__class__ is PartitionID):
+            return value
+        if(isinstance(value, float)):
+            numerator, denominator = value.as_integer_ratio()
+            return PartitionID(numerator, denominator.bit_length() - 1)
+        return PartitionID(int(value), 0)
+
+    #
+    # Properties
+
+    @property
+    def numerator(self):
+        return self.__numerator
 
-#     def __init__(self,v):
-#         self.__v=v
+    @property
+    def bits(self):
+        """Return the number of binary digits after the point."""
+        return self.__bits
 
-#     @property
-#     def v(self):
-#         return self.__v
+    #
+    # Generation
 
     @staticmethod
     def gen():
         """Return a random 'Partition ID'."""
-        return PartitionID.gen_btw(PartitionID.LOW, PartitionID.UP)
+        bits = PartitionID.RANDOM_BITS
+        return PartitionID(random.randrange(1, 1 << bits), bits)
 
     @staticmethod
     def gen_bef(ref):
@@ -302,19 +406,102 @@ class PartitionID(NodeID):
 
     @staticmethod
     def gen_btw(lower, upper):
-        """Return a 'Partition ID' that resides in closed range (Lower, Upper).
+        """Return the 'Partition ID' in the middle of the open range (Lower, Upper).
            (it still works with Upper<Lower)
         """
-        # random.uniform(2,1) happily returns a number between 1 and 2
-        pick = lower
-        while(pick == lower or pick == upper):
-            new_pid = random.uniform(lower, upper)
-            if (abs(new_pid - pick) <= PartitionID.EPSILON):
-                raise ValueError
-            pick = new_pid
-        return pick
+        lower, upper = PartitionID.from_value(lower), PartitionID.from_value(upper)
+        if(lower == upper):
+            raise ValueError("There is no partition ID between %s and %s." % (lower, upper))
+        return (lower + upper).__half()
 
     @staticmethod
     def gen_aft(ref):
         """Return a 'Partition ID' that stands after 'ref'."""
         return PartitionID.gen_btw(ref, PartitionID.UP)
+
+    #
+    # Arithmetic
+
+    def __half(self):
+        return PartitionID(self.__numerator, self.__bits + 1)
+
+    def __add__(self, other):
+        other = PartitionID.from_value(other)
+        bits = max(self.__bits, other.__bits)
+        return PartitionID((self.__numerator << (bits - self.__bits)) +
+                           (other.__numerator << (bits - other.__bits)), bits)
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return PartitionID(-self.__numerator, self.__bits)
+
+    def __sub__(self, other):
+        return self + (-PartitionID.from_value(other))
+
+    def __rsub__(self, other):
+        return PartitionID.from_value(other) + (-self)
+
+    #
+    # Overwritten
+
+    def __float__(self):
+        return self.__approx
+
+    def __repr__(self):
+        return repr(self.__approx)
+
+    def __format__(self, spec):
+        return format(self.__approx, spec)
+
+    #
+    # Default comparison
+
+    def __cmp(self, other):
+        """Return -1, 0 or 1 as 'self' is below, equal to or above 'other'."""
+        if(other.__class__ is not PartitionID):
+            other = PartitionID.from_value(other)
+        if(self.__approx != other.__approx):
+            # rounding to the nearest float never reverses an order.
+            return -1 if self.__approx < other.__approx else 1
+        a, b = self.__numerator, other.__numerator
+        if(self.__bits < other.__bits):
+            a <<= other.__bits - self.__bits
+        else:
+            b <<= self.__bits - other.__bits
+        return (a > b) - (a < b)
+
+    def __lt__(self, other):
+        return self.__cmp(other) < 0
+
+    def __le__(self, other):
+        return self.__cmp(other) <= 0
+
+    def __eq__(self, other):
+        if(other is None):
+            return False
+        return self.__cmp(other) == 0
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __gt__(self, other):
+        return self.__cmp(other) > 0
+
+    def __ge__(self, other):
+        return self.__cmp(other) >= 0
+
+    def __hash__(self):
+        # must match the hash of an equal int or float.
+        if(self.__hash == None):
+            self.__hash = hash(fractions.Fraction(self.__numerator, 1 << self.__bits))
+        return self.__hash
+
+    #
+    # Pickling: the numerator and the number of bits are enough.
+
+    def __reduce__(self):
+        return (PartitionID, (self.__numerator, self.__bits))
+
+
+PartitionID.LOW, PartitionID.UP = PartitionID(0), PartitionID(1)
@@ -3,17 +3,17 @@ import copy
 import logging
 
 # ResumeNet imports
+from logpipe import LogPipe
 from nodeid import NodeID
 from util import Direction
 from equation import InternalNode, DataStore
-from equation import Component, Range
+from equation import Component, Range, PointBatch
 from equation import CPEMissingDimension
 from messages import SNPingRequest, RouteDirect # for late-fill of the tables.
 # ------------------------------------------------------------------------------
 
 # Module log abilities
-LOG_HANDLER = logging.StreamHandler()
-LOG_HANDLER.setLevel(logging.DEBUG)
+LOG_HANDLER = LogPipe.shared().handler
 
 LOGGER = logging.getLogger("routing")
 LOGGER.setLevel(logging.DEBUG)
@@ -129,7 +129,7 @@ class Router(object):
         the destination name.  
         """
         LOGGER.log(logging.DEBUG, "route_by_name %s"%message)
-        message.sign("reached "+local_node.__repr__())
+        message.sign("reached %s", local_node.name_id)
         neighbourhood = local_node.neighbourhood
         ln = local_node.name_id
         dn = message.dest_name_id
@@ -138,10 +138,9 @@ class Router(object):
 
         # Loop from the highest ring to the smallest one. 
         for height in range(neighbourhood.nb_ring - 1, -1, -1):
-            half_ring = neighbourhood.get_ring(height).get_side(direction)
-            next_hop = half_ring.get_closest()
+            next_hop = neighbourhood.get_neighbour(direction, height)
 
-            message.sign("next hop "+next_hop.__repr__())
+            message.sign("next hop %s", next_hop.name_id)
             if (local_node != next_hop and
                 NodeID.lies_between_direction(direction, ln, next_hop.name_id, dn, canwrap)):
                 # The farthest node that doesn't jump after the destination node have been found.                
@@ -217,6 +216,22 @@ class RouterReflect(object):
         self.__lastcall=['bycpe+f']
         dest = []
         left, here, right = lnode.cpe.which_side_space(message.space_part, True)
+        if (not here):
+            # a neighbour whose region holds the whole query is the only node
+            #   that manages any of it: no need to scan the rings. Regions
+            #   not refreshed lately are left out, and the rings scanned.
+            ngh = lnode.neighbourhood.regions.containing(message.space_part, message.limit)
+            if (ngh != None and ngh.name_id != lnode.name_id):
+                dirx = (Direction.RIGHT if ngh.partition_id > lnode.partition_id
+                        else Direction.LEFT)
+                self.__lastcall.append("%s holds %s"%(ngh.pname, message.space_part))
+                newmsg = copy.copy(message)
+                if (newmsg.traced):
+                    newmsg.trace = copy.copy(message.trace)
+                    newmsg.sign("routed to %s by region", ngh.pname)
+                newmsg.limit = message.limit.restrict(
+                    Direction.get_opposite(dirx), lnode.partition_id)
+                return [(ngh, newmsg)]
         if (here) :
             # NOTE: it cannot be 'naked' message, but must be a clone with 
             #   search range that has been 'constraint' to stick here.
@@ -228,8 +243,8 @@ class RouterReflect(object):
         # create 'directions', that identifies sub-rings to be scanned
         #   and the sub-range of PartitionID that should be taken into account.
 
-        message.sign("routing %s%s with %s"%(
-            'L' if left else '', 'R' if right else '', repr(message.limit)))
+        message.sign("routing %s%s with %r",
+                     'L' if left else '', 'R' if right else '', message.limit)
 
         directions = list()
         if (left):
@@ -280,7 +295,9 @@ class RouterReflect(object):
                             "%s is %s compared to %s"%
                             (part, 'here' if here else 'forw', repr(ngh.cpe)))
                         newmsg = copy.copy(message)
-                        newmsg.sign("routed to %s at h=%i"%(ngh.pname, height))
+                        if (newmsg.traced):
+                            newmsg.trace = copy.copy(message.trace)
+                            newmsg.sign("routed to %s at h=%i", ngh.pname, height)
                         newmsg.limit = prange.restrict(Direction.get_opposite(dirx),epid)
                         dest.append((ngh, newmsg))
                     else:
@@ -303,6 +320,49 @@ class RouterReflect(object):
 #  own node will stall, waiting for room to appear in STDOUT buffer.
         return dest
                     
+    #
+    # Route by CPE, many points at once (for bulk *DATA* Insertion)
+    #  each point goes where by_cpe_get_next_hop_insertion would send it.
+
+    def by_cpe_route_points(self, lnode, batch):
+        """Return the (next hop, PointBatch) pairs sharing the points of 'batch'
+        among the local node and its neighbours."""
+        self.__lastcall=['bycpe*%i'%len(batch)]
+        for dim in lnode.cpe.dimensions.difference(batch.dimensions):
+            # virtual dimension, as for a single point.
+            (m_min, m_max) = lnode.cpe.get_range(dim)
+            assert (m_min != None or m_max != None), "Bounds in an internal node can't be both undefined."
+            batch = batch.with_value(dim, m_max if m_min == None else m_min)
+
+        dest = []
+        left, here, right = lnode.cpe.which_side_points(batch)
+        found, batch = batch.split(here)
+        if (len(found) > 0):
+            dest.append((lnode, found))
+
+        # the points that aren't here meet the neighbours in the order a single
+        #   point would, and stay with the first one that would take it.
+        last_pid_checked = None
+        neigbourhood = lnode.neighbourhood
+        for dirx in (Direction.LEFT, Direction.RIGHT):
+            for height in range(neigbourhood.nb_ring - 1, -1, -1):
+                if (len(batch) == 0):
+                    return dest
+                neighbour = neigbourhood.get_neighbour(dirx, height)
+                neighbour_pid = neighbour.partition_id
+                if(RouterReflect.check_position_partition_tree(dirx, last_pid_checked, neighbour_pid, lnode.partition_id)):
+                    last_pid_checked = neighbour_pid
+                    left, here, right = neighbour.cpe.which_side_points(batch)
+                    last = left if dirx == Direction.LEFT else right
+                    found, batch = batch.split(PointBatch.either(here, last))
+                    if (len(found) > 0):
+                        self.__lastcall.append("%i to %s (%i,%s)"%(
+                            len(found), neighbour.pname, height, repr(dirx)))
+                        dest.append((neighbour, found))
+        if (len(batch) > 0):
+            LOGGER.warning("%i points have no next hop at %s"%(len(batch), lnode.name_id))
+        return dest
+
     #
     # Route by CPE
     # Point and Node have same dimension defined.   
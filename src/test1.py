@@ -1,15 +1,74 @@
 import sys # for exceptions
 import traceback
+import threading
+import asyncio
 
 from util import Direction
 
-from equation import CPE, Dimension, SpacePart, InternalNode, Component, Range
+from equation import CPE, Dimension, SpacePart, InternalNode, Component, Range, DataStore
+from equation import CPEMissingDimension
 from nodeid import NodeID, NameID, NumericID
 from node import NetNodeInfo, Node, PartitionID
 
-from messages import LookupRequest, RouteByCPE
-from localevent import MessageDispatcher
+from messages import LookupRequest, RouteByCPE, RouteDirect, SNPingMessage, WirePayload
+from messages import BatchInsertionRequest, AppMessage, InsertionRequest
+from codec import WireCodec
+from join import DataHandoff, JoinProcessor, STJoinReply, STJoinData, STJoinDataAck
+from localevent import MessageDispatcher, PROCESSING_ORDER, ORDER_EXCLUSIVE
+from network import FrameTools, OutRequestManager, DatagramChannel
+from logpipe import ConsoleWriter
+from neighbourhood import PeerTable, RegionIndex, HalfRingSet
 from routing import PidRange, RouterReflect
+from tracing import TraceLog
+
+class Probe(AppMessage):
+    """ records the order in which the dispatcher delivers it """
+    def __init__(self, tag, delivered, hook=None):
+        AppMessage.__init__(self)
+        self.tag, self.delivered, self.hook = tag, delivered, hook
+
+    def accept(self, visitor):
+        self.delivered.append(self.tag)
+        if (self.hook != None):
+            self.hook()
+
+class CtrlProbe(Probe):
+    control = True
+
+class SplitProbe(Probe):
+    """ processed like a join: the DataStore changes under the inserts """
+PROCESSING_ORDER[SplitProbe] = ORDER_EXCLUSIVE
+
+class Framer(FrameTools):
+    """ records the frames and errors of a stream """
+    def __init__(self):
+        FrameTools.__init__(self)
+        self.frames, self.errors = [], []
+
+    def _data_received(self, data):
+        self.frames.append(bytes(data))
+
+    def _parse_error(self, error):
+        self.errors.append(error)
+        self.reset_state()
+
+    def feed(self, data):
+        buf = self.get_buffer(len(data))
+        buf[:len(data)] = data
+        self.buffer_updated(len(data))
+
+class SlowStream(object):
+    """ a console that reads nothing until it is opened """
+    def __init__(self):
+        self.opened, self.entered, self.text = threading.Event(), threading.Event(), []
+
+    def write(self, text):
+        self.entered.set()
+        self.opened.wait()
+        self.text.append(text)
+
+    def flush(self):
+        pass
 
 class Tester(object):
 
@@ -46,12 +105,16 @@ class Tester(object):
         self.__dispatch = MessageDispatcher(lnode)
 
 
-    def resolve(self,rq):
+    def resolve(self,rq,received=False):
         route = RouteByCPE(rq,rq.key)
         # you need to enable forking explicitly so that dispatching
         #   and a range is required for forking.
         route.forking=True
         route.limit=PidRange(lnode.partition_id-.5,lnode.partition_id+.5)
+        if (received):
+            # as if it came from the network: the payload is left encoded.
+            codec = WireCodec.shared()
+            route = codec.decode(codec.encode(route))
         return self.__dispatch.get_destinations(route)
 
     def test_bare_bones(self):
@@ -74,6 +137,283 @@ class Tester(object):
         print("#0 : directions tests passed")
         return True
 
+    def test_identifiers(self):
+        a = NumericID("f0", nb_digit=8)
+        b = NumericID("f8", nb_digit=8)
+        assert [a.get_digit(i) for i in range(8)] == [1,1,1,1,0,0,0,0]
+        assert a.get_longest_prefix_length(b) == 4, "f0/f8 share 4 bits"
+        assert a.get_longest_prefix_length(a) == a.get_nb_digit()
+        assert NumericID(0xf0, nb_digit=8) == a and hash(a) == hash(0xf0)
+
+        import pickle
+        c = NumericID()
+        assert pickle.loads(pickle.dumps(c)) == c
+        assert c.get_numeric_id_hex() == "%032x" % c
+
+        n = NameID("WorldUp")
+        assert NameID("WorldUp") is n, "equal names should be interned"
+        assert pickle.loads(pickle.dumps(n)) is n
+        assert n.get_longest_prefix_length(NameID("World")) == 5
+        assert 1 < NameID("World").get_longest_prefix_length(NameID("WakeUp")) < 2
+
+        # a float PID would run out of room after ~50 splits.
+        low, up = PartitionID.gen_bef(lnode.partition_id), PartitionID.gen_aft(lnode.partition_id)
+        for i in range(200):
+            pid = PartitionID.gen_btw(low, up)
+            assert PartitionID.gen_btw(low, up) == pid, "split should be deterministic"
+            assert low < pid < up
+            up = pid
+        assert RouterReflect.check_position_partition_tree(Direction.RIGHT, None, up, low)
+        assert PidRange(low - .5, low + .5).includes_pid(up) == up
+        assert pickle.loads(pickle.dumps(up)) == up
+
+        print("#0 : identifier tests passed")
+        return True
+
+    def test_codec(self):
+        import pickle
+        codec = WireCodec.shared()
+        lnode.neighbourhood.sign("codec test")
+        key = self.createSpacePart([('a','cx','cz'), ('c','ks','ks')])
+        rq = RouteByCPE(LookupRequest(key, lnode), key)
+        rq.limit = PidRange(lnode.partition_id-.5, lnode.partition_id+.5)
+        rq.trace = True
+        rq.sign("codec test")
+        copy = codec.decode(codec.encode(rq))
+        assert repr(copy) == repr(rq) and copy.trace == rq.trace
+        assert isinstance(copy.wire_payload, WirePayload), "payload left encoded"
+        hop = codec.decode(codec.encode(copy))
+        assert hop.wire_payload.raw == copy.wire_payload.raw, "forwarded untouched"
+        assert copy.limit.includes_pid(lnode.partition_id) == lnode.partition_id
+        assert copy.payload.originator == lnode, "originator travels by identity"
+        assert copy.payload.originator.cpe.k == 0, "... without its CPE"
+        assert sorted(d.dimension for d in copy.payload.key.dimensions) == ['a', 'c']
+        assert all(d is Dimension.get(d.dimension) for d in copy.payload.key.dimensions), "dimensions interned"
+        assert codec.decode(pickle.dumps(rq)).payload.nonce == rq.payload.nonce
+        for hop in range(2 * TraceLog.MAX_EVENTS):
+            rq.sign("hop %i at %s", hop, lnode.name_id)
+        copy = codec.decode(codec.encode(rq))
+        assert len(copy.trace) == TraceLog.MAX_EVENTS and copy.trace == rq.trace
+        assert copy.trace.lines()[0] == "codec test", "origin of the trace kept"
+        assert TraceLog.sample(0) == None and TraceLog.sample(1) != None
+
+        ping = RouteDirect(SNPingMessage(lnode, 3), lnode)
+        copy = codec.decode(codec.encode(ping))
+        assert copy.payload.src_node.cpe.pname == lnode.cpe.pname
+        assert copy.destination == copy.payload.src_node
+        assert copy.payload.ring_level == 3 and copy.payload.ring_levels == (3,)
+        ping = RouteDirect(SNPingMessage(lnode, 3, [0, 2, 3]), lnode)
+        copy = codec.decode(codec.encode(ping))
+        assert copy.datagram and isinstance(copy.wire_payload, WirePayload), "datagram told encoded"
+        assert copy.payload.ring_levels == (0, 2, 3)
+        print("#0 : codec tests passed")
+        return True
+
+    def test_pool(self):
+        host = self.createNode("host", '127.0.0.4')
+        host.dispatcher = MessageDispatcher(host)
+        sender = OutRequestManager(host)
+        host.neighbourhood.sign("pool test")
+        peer = self.createNode("peer", '127.0.0.3')
+        moved = Node.remote(peer.name_id, peer.numeric_id, peer.net_info,
+                            PartitionID.gen_aft(peer.partition_id), peer.cpe)
+        contact = Node(None, NumericID(), peer.net_info)  # as join() makes it
+        assert moved == peer and contact != peer and contact < peer and not peer < contact
+        assert sorted([host, peer, contact]) == [contact, peer, host]
+        for node in (peer, moved):
+            sender.send_msg(RouteDirect(SNPingMessage(host, 0), node), node)
+        stats = sender.pool_stats()
+        assert stats["opened"] == 1 and stats["hits"] == 1, "a new PID opened a channel: %r"%stats
+        assert list(sender.queue_depths()) == [moved], "channel still bound to the old copy"
+        loop = host.dispatcher.loop
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()   # the connections were never meant to be made.
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        print("#0 : one channel per node, whatever its PID")
+        return True
+
+    def test_framing(self):
+        framer = Framer()
+        framer.feed(b"5;hello,")
+        assert framer.frames == [b"hello"] and framer.errors == [], framer.frames
+        for bad in (b"-5;hello,", b"+5;hello,", b" 5;hello,", b"5_0;hello,",
+                    b"%i;" % (FrameTools.MAX_LENGTH + 1)):
+            framer = Framer()
+            framer.feed(bad)
+            assert framer.frames == [] and len(framer.errors) == 1, "%r got framed"%bad
+        print("#0 : malformed netstring lengths refused")
+        return True
+
+    def test_datagrams(self):
+        import time
+        received, sent = [], []
+        channel = DatagramChannel(received.append)
+        channel.connection_made(type("Transport", (object,), {
+            "sendto": lambda self, data, address: sent.append((data, address))})())
+        channel.RECENT_DELAY, channel.REACHED_SIZE = 0.05, 1
+        data = lambda seq, text: DatagramChannel.HEADER.pack(DatagramChannel.DATA, seq) + text
+        channel.datagram_received(data(1, b"one"), "a")
+        channel.datagram_received(data(1, b"one"), "a")
+        assert received == [b"one"] and channel.duplicates == 1
+        time.sleep(0.1)
+        channel.datagram_received(data(2, b"two"), "a")
+        channel.datagram_received(data(1, b"one"), "a")   # forgotten by now
+        assert received == [b"one", b"two", b"one"] and channel.duplicates == 1
+
+        async def send():
+            for address in ("a", "b"):
+                channel.send(b"ping", address, None)
+                seq = DatagramChannel.HEADER.unpack_from(sent[-1][0])[1]
+                channel.datagram_received(DatagramChannel.HEADER.pack(DatagramChannel.ACK, seq), address)
+        asyncio.run(send())
+        assert channel.reached("b") and not channel.reached("a"), "reached addresses bounded"
+        print("#0 : datagram duplicates and peers forgotten")
+        return True
+
+    def test_console(self):
+        stream = SlowStream()
+        console = ConsoleWriter(stream, capacity=2, reserve=2)
+        console.write("noise 0\n")
+        stream.entered.wait()   # the writer thread is stuck with it.
+        for i in range(1, 8):
+            console.write("noise ")
+            console.write(str(i))
+            console.write("\n")
+        console.write("#_# beat\n0_0 ")
+        console.write("done\n!_! lost\n")   # the reserve is full too.
+        assert console.dropped == 6 and console.protocol_dropped == 1, console.dropped
+        stream.opened.set()
+        console.close()
+        lines = "".join(stream.text).splitlines()
+        assert lines == ["noise 0", "noise 1", "noise 2", "#_# beat", "0_0 done"], lines
+        print("#0 : console drops whole lines, and never waits")
+        return True
+
+    def test_handoff(self):
+        codec = WireCodec.shared()
+        joiner = self.createNode("joiner", '127.0.0.2')
+        sent, acks = [], []
+        lnode.route_internal = lambda route: sent.append(codec.encode(route))
+        joiner.route_internal = lambda route: acks.append(codec.encode(route))
+        data = [(SpacePart([Component(Dimension.get('a'), 'k%03i'%i)]), ['v', i]) for i in range(300)]
+
+        proposal = STJoinReply(lnode, STJoinReply.STATE_PROPOSE)
+        proposal.partition_id, proposal.cpe, proposal.data = .25, lnode.cpe, []
+        lnode.route_internal(RouteDirect(proposal, joiner))
+        handoff = DataHandoff(lnode, joiner, proposal, data)
+        handoff.CHUNK_SIZE = 1024
+        handoff.start()
+        processor = JoinProcessor(joiner)
+        while sent:
+            codec.decode(sent.pop(0)).payload.accept(processor)
+            while acks:
+                ack = codec.decode(acks.pop(0)).payload
+                if (hasattr(ack, "seq")):
+                    handoff.acknowledge(ack.seq)
+        del lnode.route_internal
+        assert handoff.complete, "every chunk acknowledged"
+        assert len(joiner.data_store) == len(data) and joiner.partition_id == .25
+        print("#0 : data handoff tests passed")
+        return True
+
+    def test_dispatch(self):
+        dispatcher = MessageDispatcher(lnode)
+        loop = dispatcher.loop
+        flood = 20 * dispatcher.YIELD_EVERY
+        delivered, ticks = [], []
+
+        def stop():
+            if (len(delivered) == flood + 1):
+                loop.stop()
+
+        def arrive():
+            # what the network does while the flood is dispatched: a timer
+            #   fires, then a control message is read from a socket.
+            loop.call_soon(lambda: ticks.append(len(delivered)))
+            loop.call_soon(lambda: dispatcher.admit(
+                RouteDirect(CtrlProbe("ctrl", delivered, stop), lnode)))
+
+        for i in range(flood):
+            dispatcher.put(RouteDirect(Probe(i, delivered, arrive if i == 0 else stop), lnode))
+        try:
+            dispatcher.dispatch()
+        except RuntimeError:
+            pass # the loop was stopped.
+        assert len(ticks) == 1 and ticks[0] < flood, "timer held back by the flood: %r"%ticks
+        ctrl = delivered.index("ctrl")
+        assert ctrl <= 2 * dispatcher.YIELD_EVERY, "control message served %ith"%ctrl
+        print("#0 : dispatcher yields to the network")
+
+        # handoff chunks are bulk, even undecoded; their acks are control.
+        codec = WireCodec.shared()
+        chunk = codec.decode(codec.encode(RouteDirect(STJoinData(lnode, 1, 0, b""), lnode)))
+        ack = codec.decode(codec.encode(RouteDirect(STJoinDataAck(lnode, 1, 0), lnode)))
+        assert chunk.bulk and not chunk.control and ack.control and not ack.bulk
+        assert dispatcher.admit(chunk) and dispatcher.queue_stats()["bulk"]["depth"] == 1
+        dispatcher.CAPACITY = 0
+        assert not dispatcher.admit(chunk) and dispatcher.admit(ack)
+        assert dispatcher.queue_stats()["ctrl"]["depth"] == 1
+        print("#0 : handoff chunks are bulk")
+        return True
+
+    def test_dispatch_errors(self):
+        dispatcher = MessageDispatcher(lnode)
+        loop = dispatcher.loop
+        delivered = []
+
+        def fail():
+            raise ValueError("a buggy message")
+
+        far = self.createNode("far", '127.0.0.5')
+        far.neighbourhood.sign("far")
+        bits = lnode.numeric_id.get_longest_prefix_length(far.numeric_id)
+        dispatcher.put(RouteDirect(Probe("bad", delivered, fail), lnode))
+        dispatcher.put(RouteDirect(SNPingMessage(far, 0, [bits + 1]), lnode))
+        dispatcher.put(RouteDirect(Probe("good", delivered, loop.stop), lnode))
+        try:
+            dispatcher.dispatch()
+        except RuntimeError:
+            pass # the loop was stopped.
+        assert delivered == ["bad", "good"], "dispatching stopped at %r"%delivered
+        assert far not in lnode.neighbourhood.peers, "ping for a ring it isn't in accepted"
+        print("#0 : dispatcher survives bad messages")
+        return True
+
+    def test_split_inserts(self):
+        dispatcher = MessageDispatcher(lnode, workers=2)
+        loop = dispatcher.loop
+        kept, delivered, seen = lnode.data_store, [], []
+        lnode.data_store = DataStore()
+        n = 4 * dispatcher.YIELD_EVERY
+
+        def split():
+            # what join.py does once the joining node accepts.
+            seen.append(len(lnode.data_store))
+            moved = lnode.data_store.items(0)
+            lnode.data_store = DataStore(moved)
+
+        def insert(i):
+            key = self.createSpacePart([['a', 'k%03i'%i, 'k%03i'%i]])
+            dispatcher.put(RouteDirect(InsertionRequest(i, key), lnode))
+
+        for i in range(n):
+            insert(i)
+        dispatcher.put(RouteDirect(SplitProbe("split", delivered, split), lnode))
+        for i in range(n, 2 * n):
+            insert(i)
+        dispatcher.put(RouteDirect(SplitProbe("done", delivered, loop.stop), lnode))
+        try:
+            dispatcher.dispatch()
+        except RuntimeError:
+            pass # the loop was stopped.
+        stored = len(lnode.data_store)
+        lnode.data_store = kept
+        assert seen == [n], "split saw %r of the %i earlier inserts"%(seen, n)
+        assert stored == 2 * n, "%i of %i inserts kept across the split"%(stored, 2 * n)
+        print("#0 : no insert lost across a split")
+        return True
+
     def test_open_split(self):
         # this CPE exclude some part of the space, but does not
         #  capture a closed space.
@@ -150,6 +490,31 @@ class Tester(object):
         assert left,"%s should be forked left of %s on Dim(g)"%(t1,cpe)
 
         print("#A4 : incomplete space-part")
+
+        for part in (t1, t2, t3):
+            for forking in (True, False):
+                try:
+                    expected = cpe.interpret_side_space(part, forking)
+                except CPEMissingDimension:
+                    expected = None
+                try:
+                    compiled = cpe.compiled.which_side_space(part, forking)
+                except CPEMissingDimension:
+                    compiled = None
+                assert compiled == expected, "compiled %s disagrees on %s"%(cpe.pname, part)
+        print("#A5 : compiled CPE")
+
+        values = ['aa', 'girl', 'kiss', 'kx', 'soft', 'tu', 'wish', 'zz']
+        points = [SpacePart([Component(Dimension.get(d), values[(i * k) % len(values)])
+                             for k, d in enumerate('aceg', 1)])
+                  for i in range(len(values) * 3)]
+        batch = BatchInsertionRequest.from_items([(p, i) for i, p in enumerate(points)])
+        masks = cpe.which_side_points(batch.points)
+        for i, part in enumerate(points):
+            expected = cpe.which_side_space(part)
+            assert [bool(m[i]) for m in masks] == list(expected), (
+                "%s disagrees on %s"%(cpe.pname, part))
+        print("#A6 : batch of points")
         return cpe
 
     def test_ring(self):
@@ -236,9 +601,10 @@ class Tester(object):
             lid.get_longest_prefix_length(n3.numeric_id)):
             n = n2 ; n2 = n3 ; n3 = n
 
-        # nameIDs are used in the neighbourhood ordering
-        n2.name_id = NameID("right")
-        n3.name_id = NameID("_left")
+        # nameIDs are used in the neighbourhood ordering. The identity of a
+        #   Node can't change: renamed copies are built instead.
+        n2 = Node.remote(NameID("right"), n2.numeric_id, n2.net_info, n2.partition_id)
+        n3 = Node.remote(NameID("_left"), n3.numeric_id, n3.net_info, n3.partition_id)
 
         ave.add_neighbour(0,n2)
         ave.add_neighbour(0,n3)
@@ -279,6 +645,20 @@ class Tester(object):
         
 
         ave.add_neighbour(1,n3)
+        assert ave.levels == [0, 1] and len(ave.peers) == 2, (
+            "%s should hold 2 neighbours in rings 0 and 1"%repr(ave))
+
+        peers = PeerTable(lnode, RegionIndex())
+        ring = HalfRingSet(Direction.RIGHT, lnode, peers=peers)
+        twin = Node(n3.name_id, NumericID(), NetNodeInfo('127.0.0.9'))
+        twin.cpe = self.createCPE([['a','>','zz']])
+        cpe = n3.cpe
+        ring.add_neighbour(n3)
+        ring.add_neighbour(twin)
+        assert ring.size == 2 and n3.cpe is cpe, "%s took the CPE of %s"%(repr(n3), repr(twin))
+        ring.remove_neighbour(n3)
+        assert ring.get_neighbours() == [twin] and twin in peers and n3 not in peers, (
+            "%s and %s are different neighbours"%(repr(n3), repr(twin)))
 
         #  assert ave.nb_ring<3, "how comes %s has %i rings?"%(repr(ave),ave.nb_ring)
         #>>  there is automatic creation of one ring per 'bit' in the numeric ID. Here we
@@ -315,7 +695,7 @@ class Tester(object):
             rq.key,lnode.cpe)
         
         try:
-            dests = self.resolve(rq)
+            dests = self.resolve(rq, True)
             assert len(dests)==1, "single match expected in %s (i.e. %s) for %s::%s"%(
                 repr(dests),repr(n2),repr(rq),repr(rq.key))
             
@@ -323,11 +703,30 @@ class Tester(object):
             assert hop != None , "there should be a next hop for %s"%(repr(msg))
             assert hop.name_id == n2.name_id, "msg %s should be for %s, not %s"%(
                 repr(msg), repr(n2), repr(hop))
+            assert isinstance(msg.wire_payload, WirePayload), "payload decoded to forward it"
             
             print(repr(ave))
             for ln in self.__dispatch.routing_trace():
                 print("##> ",ln)
             
+            assert ave.regions.containing(rq.key) == n2, "%s should hold %s"%(
+                repr(n2), repr(rq.key))
+
+            # a region that wasn't refreshed lately may be stale: the rings
+            #   are scanned instead.
+            max_age, RegionIndex.MAX_AGE = RegionIndex.MAX_AGE, -1
+            hop, msg = self.resolve(rq)[0]
+            assert hop == n2 and "holds" not in "".join(self.__dispatch.routing_trace())
+            RegionIndex.MAX_AGE = max_age
+
+            # n2 split its region with a joining node, and tells it.
+            split = Node.remote(n2.name_id, n2.numeric_id, n2.net_info, n2.partition_id,
+                                self.createCPE([['a','>','girl'], ['b','>','cute'],
+                                                ['c','>','soft'], ['g','<','talk'],
+                                                ['g','>','kt']]))
+            ave.add_neighbour(0, split)
+            assert ave.regions.containing(rq.key) == None, "%s no longer holds %s"%(
+                repr(n2), repr(rq.key))
             print("#B2: route-to-right")
         except:
             inf=sys.exc_info()
@@ -342,6 +741,16 @@ class Tester(object):
 t = Tester()
 print("*-- testing preliminaries --*")
 t.test_bare_bones()
+t.test_identifiers()
+t.test_codec()
+t.test_pool()
+t.test_framing()
+t.test_datagrams()
+t.test_console()
+t.test_handoff()
+t.test_dispatch()
+t.test_dispatch_errors()
+t.test_split_inserts()
 
 print("*-- testing open split --*")
 lnode.cpe = t.test_open_split()
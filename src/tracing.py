@@ -0,0 +1,113 @@
+"""
+Sampled tracing of the journey of messages.
+
+Whether a message is traced is decided once, by the node that creates it
+(TraceLog.sample()), and the decision travels with the message: a message
+that isn't sampled has no TraceLog and signing it costs a single test.
+
+A TraceLog records events as (format, arguments) pairs. Nothing is turned
+into text until the trace is dumped, so arguments should be cheap, compact
+values (names, partition ids, counters) rather than whole nodes, which would
+travel in the trace. The number of events a trace keeps is capped so that a
+trace never grows a message on the wire beyond a few hundred bytes.
+"""
+
+# System imports
+import random
+
+# ResumeNet imports
+
+# ------------------------------------------------------------------------------------------------
+
+
+class TraceLog(object):
+    """TraceLog holds the events met by one (sampled) message."""
+
+    """Fraction of the newly created messages that are traced."""
+    SAMPLE_RATE = 0.01
+
+    """The most events a trace keeps. The first one (where the message comes
+    from) is always kept, then the most recent ones."""
+    MAX_EVENTS = 32
+
+    def __init__(self, events=None):
+        self.__events = list(events) if events != None else []
+        self.__dropped = 0
+
+    @staticmethod
+    def sample(rate=None):
+        """Return a new TraceLog for a message created here if it is sampled,
+        None otherwise."""
+        if (rate == None):
+            rate = TraceLog.SAMPLE_RATE
+        if (rate >= 1 or (rate > 0 and random.random() < rate)):
+            return TraceLog()
+        return None
+
+    def add(self, fmt, *args):
+        """Record an event: 'fmt' % 'args', formatted when dumped."""
+        events = self.__events
+        if (len(events) >= TraceLog.MAX_EVENTS):
+            del events[1]
+            self.__dropped += 1
+        events.append((fmt, args))
+
+    def append(self, line):
+        """Record an event that is already a line of text."""
+        self.add(line)
+
+    #
+    # Properties
+
+    @property
+    def dropped(self):
+        """Return the number of events dropped to keep the trace short."""
+        return self.__dropped
+
+    #
+    # Dumping
+
+    @staticmethod
+    def format(fmt, args):
+        """Return the line of text of an event."""
+        if (len(args) == 0):
+            return str(fmt)
+        try:
+            return fmt % args
+        except (TypeError, ValueError):
+            return "%s %s" % (fmt, repr(args))
+
+    def lines(self):
+        """Return the events as lines of text."""
+        lines = [TraceLog.format(fmt, args) for fmt, args in self.__events]
+        if (self.__dropped > 0):
+            lines.insert(1, "(%i events dropped)" % self.__dropped)
+        return lines
+
+    def __iter__(self):
+        return iter(self.lines())
+
+    def __len__(self):
+        return len(self.__events)
+
+    def __eq__(self, other):
+        if (not isinstance(other, TraceLog)):
+            return NotImplemented
+        return self.lines() == other.lines()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __copy__(self):
+        clone = TraceLog(self.__events)
+        clone.__dropped = self.__dropped
+        return clone
+
+    def __repr__(self):
+        return repr(self.lines())
+
+    def __str__(self):
+        return str(self.lines())